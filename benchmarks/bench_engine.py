@@ -0,0 +1,279 @@
+"""Benchmark suite of the Engine hot paths on synthetic videos
+
+For every combination of resolution, length and container (VIDEO_FORMATS)
+it writes a synthetic video (see synth.py), and drives an Engine headless:
+no Tk, no pygame window, no Engine process. Queues are queue.Queue, and
+the Engine methods are called directly in a fresh process per case, so
+that peak RSS belongs to that case only.
+
+Measured per case
+    load_vid : opening the video, `--loads` times
+    next_frame : labeling forward, one frame at a time
+    put_datum : sending the new frame and markers to the (absent) Viewer
+    save_data : saving all labeled frames, `--saves` times
+Results are latency percentiles (ms), throughput (calls per second) and
+peak RSS (MB), written as json.
+
+Seek indices are built before measuring, so that a background build does
+not compete with the measured calls.
+
+Usage
+-----
+    python -m benchmarks.bench_engine run [--quick] [--out results.json]
+        [--resolutions 640x360 1280x720] [--lengths 300 1800]
+        [--containers .mp4 .mpg] [--frames 300]
+    python -m benchmarks.bench_engine compare base.json new.json
+        [--threshold 0.1]
+
+compare prints every metric that got worse by more than threshold
+(relative), and exits with 1 if there is any.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+from multiprocessing import get_context
+
+DEFAULT_RESOLUTIONS = ('640x360', '1280x720', '1920x1080')
+DEFAULT_LENGTHS = (300, 1800)
+QUICK_RESOLUTIONS = ('320x240', '640x360')
+QUICK_LENGTHS = (120,)
+
+PERCENTILES = (50, 95, 99)
+# Metric -> True if higher is better
+HIGHER_IS_BETTER = {
+    'fps' : True,
+    'mean_ms' : False,
+    'p50_ms' : False,
+    'p95_ms' : False,
+    'p99_ms' : False,
+    'peak_rss_mb' : False,
+}
+
+def containers():
+    """Extensions of VIDEO_FORMATS, e.g. 'mp4' -> '.mp4'"""
+    from sources.common.constants import VIDEO_FORMATS
+    return tuple(f if f.startswith('.') else '.'+f for f in VIDEO_FORMATS)
+
+def case_name(width:int, height:int, n_frames:int, ext:str):
+    return f'{width}x{height}_{n_frames}{ext}'
+
+def stats(seconds:list):
+    """Latency percentiles and throughput of a list of call times"""
+    lat = np.array(seconds) * 1000
+    result = {'n' : len(lat), 'mean_ms' : float(lat.mean())}
+    for p in PERCENTILES:
+        result[f'p{p}_ms'] = float(np.percentile(lat, p))
+    result['fps'] = float(len(lat) / max(lat.sum() / 1000, 1e-9))
+    return result
+
+def peak_rss_mb():
+    """Peak resident memory of this process, None if unknown"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak / 1024
+
+def run_case(vid_name:str, n_frames:int, loads:int, saves:int):
+    """Measures one video with a headless Engine. Runs in its own process"""
+    import queue
+    from sources.engine import Engine
+    from sources.common.queues import drain
+
+    to_EngineQ, to_ConsoleQ, imageQ, eventQ, etcQ = \
+        (queue.Queue() for _ in range(5))
+    engine = Engine(to_EngineQ, to_ConsoleQ, imageQ, eventQ, etcQ,
+                    journal=False)
+    timings = {'load_vid':[], 'next_frame':[], 'put_datum':[],
+               'save_data':[]}
+    try:
+        for _ in range(loads):
+            start = time.perf_counter()
+            frame_num = engine.load_vid(vid_name)
+            timings['load_vid'].append(time.perf_counter() - start)
+        engine.put_datum()
+
+        for _ in range(min(n_frames, frame_num) - 1):
+            start = time.perf_counter()
+            engine.next_frame()
+            timings['next_frame'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            engine.put_datum()
+            timings['put_datum'].append(time.perf_counter() - start)
+            # Nobody reads them; only keep the queues from growing
+            for q in (imageQ, to_ConsoleQ):
+                for _ in drain(q):
+                    pass
+
+        with tempfile.TemporaryDirectory() as vid_folder:
+            for _ in range(saves):
+                start = time.perf_counter()
+                engine.save_data(vid_folder)
+                timings['save_data'].append(time.perf_counter() - start)
+    finally:
+        engine.stop_prefetcher()
+        engine.close_ring()
+        if hasattr(engine._frames, 'release'):
+            engine._frames.release()
+
+    result = {name : stats(t) for name, t in timings.items() if t}
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+def _case_worker(resultQ, *args):
+    try:
+        resultQ.put(run_case(*args))
+    except Exception as e:
+        resultQ.put({'error' : f'{type(e).__name__}: {e}'})
+
+def run(args):
+    from benchmarks.synth import make_video
+    from sources.seek_index import SeekIndex
+    os.makedirs(args.video_dir, exist_ok=True)
+    resolutions = args.resolutions or \
+        (QUICK_RESOLUTIONS if args.quick else DEFAULT_RESOLUTIONS)
+    lengths = args.lengths or (QUICK_LENGTHS if args.quick else
+                               DEFAULT_LENGTHS)
+    exts = args.containers or containers()
+    ctx = get_context('spawn')
+
+    cases = []
+    for resolution in resolutions:
+        width, height = (int(v) for v in resolution.split('x'))
+        for length in lengths:
+            for ext in exts:
+                name = case_name(width, height, length, ext)
+                case = {'name':name, 'width':width, 'height':height,
+                        'frames':length, 'container':ext}
+                cases.append(case)
+                vid_name = os.path.join(args.video_dir, 'engine_'+name)
+                try:
+                    make_video(vid_name, width, height, length)
+                    SeekIndex.load_or_build(vid_name)
+                except (IOError, KeyError) as e:
+                    # e.g. no H264 encoder in this build of OpenCV
+                    case['skipped'] = str(e)
+                    print(f'{name:>24} : skipped, {e}')
+                    continue
+                resultQ = ctx.Queue()
+                worker = ctx.Process(target=_case_worker,
+                                     args=(resultQ, vid_name, args.frames,
+                                           args.loads, args.saves))
+                worker.start()
+                result = resultQ.get()
+                worker.join()
+                if 'error' in result:
+                    case['skipped'] = result['error']
+                    print(f'{name:>24} : failed, {result["error"]}')
+                    continue
+                case.update(result)
+                print(f'{name:>24} : ' + '  '.join(
+                    f'{k} {case[k]["p50_ms"]:.2f}ms'
+                    for k in ('load_vid', 'next_frame', 'put_datum',
+                              'save_data') if k in case)
+                    + f'  rss {case["peak_rss_mb"] or 0:.0f}MB')
+
+    import cv2
+    results = {
+        'meta' : {
+            'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python' : platform.python_version(),
+            'platform' : platform.platform(),
+            'cpus' : os.cpu_count(),
+            'opencv' : cv2.__version__,
+            'numpy' : np.__version__,
+            'frames' : args.frames,
+            'loads' : args.loads,
+            'saves' : args.saves,
+        },
+        'cases' : cases,
+    }
+    out = args.out or time.strftime('bench_engine-%Y%m%d-%H%M%S.json')
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f'results : {out}')
+    return 0
+
+def compare(base:dict, new:dict, threshold:float=0.1, min_ms:float=0.05):
+    """Metrics of new that are worse than base by more than threshold
+
+    Latencies that differ by less than min_ms are noise, and ignored.
+
+    Return
+    ------
+    regressions : list
+        (case name, metric, base value, new value, relative change)
+        Relative change is positive when it got worse
+    """
+    base_cases = {c['name'] : c for c in base['cases'] if 'skipped' not in c}
+    regressions = []
+    for case in new['cases']:
+        old = base_cases.get(case['name'])
+        if old is None or 'skipped' in case:
+            continue
+        pairs = [('peak_rss_mb', old.get('peak_rss_mb'),
+                  case.get('peak_rss_mb'))]
+        for call, values in case.items():
+            if not isinstance(values, dict) or call not in old:
+                continue
+            for metric in HIGHER_IS_BETTER:
+                if metric in values:
+                    pairs.append((f'{call}.{metric}', old[call][metric],
+                                  values[metric]))
+        for name, a, b in pairs:
+            if not a or b is None:
+                continue
+            metric = name.rsplit('.', 1)[-1]
+            if metric.endswith('_ms') and abs(b - a) < min_ms:
+                continue
+            change = (b - a) / a
+            if HIGHER_IS_BETTER[metric]:
+                change = -change
+            if change > threshold:
+                regressions.append((case['name'], name, a, b, change))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.bench_engine')
+    sub = parser.add_subparsers(dest='command', required=True)
+    run_parser = sub.add_parser('run')
+    run_parser.add_argument('--quick', action='store_true',
+                            help='small videos only')
+    run_parser.add_argument('--resolutions', nargs='+')
+    run_parser.add_argument('--lengths', type=int, nargs='+')
+    run_parser.add_argument('--containers', nargs='+')
+    run_parser.add_argument('--frames', type=int, default=300,
+                            help='frames to label per case')
+    run_parser.add_argument('--loads', type=int, default=3)
+    run_parser.add_argument('--saves', type=int, default=5)
+    run_parser.add_argument('--video-dir', default='bench_videos')
+    run_parser.add_argument('--out')
+    compare_parser = sub.add_parser('compare')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+    compare_parser.add_argument('--min-ms', type=float, default=0.05)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        sys.exit(run(args))
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    regressions = compare(base, new, args.threshold, args.min_ms)
+    for name, metric, a, b, change in regressions:
+        print(f'REGRESSION {name} {metric} : {a:.3f} -> {b:.3f} '
+              f'({change*100:+.1f}%)')
+    if not regressions:
+        print(f'No regressions over {args.threshold*100:.0f}%')
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,81 @@
+"""Memory per frame and access time of the compressed frame store
+
+For each codec, frames of a synthetic video are decoded into a FrameSource
+with a compressed store (see sources/compressed_store.py), and then read
+back through a small hot set, as Engine does when stepping.
+Memory of a whole recording is projected from the compressed frame size.
+
+Synthetic frames have a static noise background, which compresses much
+worse than real recordings, so sizes here are an upper bound.
+
+Usage
+-----
+    python -m benchmarks.bench_frame_store [--codecs zlib lz4 png jpeg]
+        [--frames 300] [--width 1280] [--height 720] [--hours 1]
+"""
+import argparse
+import os
+import time
+
+def bench(vid_name, codec, n_frames, hot_frames):
+    from sources.frame_source import FrameSource
+    source = FrameSource(vid_name, cache_frames=hot_frames, compress=codec)
+    n_frames = min(n_frames, len(source))
+    start = time.perf_counter()
+    for idx in range(n_frames):
+        source.fetch(idx)
+    fill = time.perf_counter() - start
+    # Steps back through frames that are only in the store
+    steps = []
+    for idx in range(n_frames-1, -1, -1):
+        start = time.perf_counter()
+        source.fetch(idx)
+        steps.append(time.perf_counter() - start)
+    store = source.store
+    result = {
+        'kb_per_frame' : store.bytes_per_frame / 1024,
+        'ratio' : store.ratio,
+        'encode_ms' : store.encode_ms,
+        'decode_p50_ms' : store.decode_percentile(50),
+        'decode_p95_ms' : store.decode_percentile(95),
+        'fill_fps' : n_frames / fill,
+        'step_fps' : len(steps) / sum(steps),
+    }
+    source.release()
+    return result
+
+if __name__ == '__main__':
+    from benchmarks.synth import make_video
+    from sources.compressed_store import CODECS
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--codecs', nargs='+', default=list(CODECS))
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--hours', type=float, default=1.0)
+    parser.add_argument('--hot-frames', type=int, default=64)
+    parser.add_argument('--video-dir', default='bench_videos')
+    args = parser.parse_args()
+    os.makedirs(args.video_dir, exist_ok=True)
+    vid_name = make_video(
+        os.path.join(args.video_dir,
+                     f'store_{args.width}x{args.height}_{args.frames}.mp4'),
+        args.width, args.height, args.frames, args.fps)
+    recording = int(args.hours * 3600 * args.fps)
+    raw_gb = recording * args.width * args.height * 3 / (1<<30)
+    print(f'{vid_name}, {args.hours:g}h at {args.fps}fps = {recording} '
+          f'frames, {raw_gb:.1f}GB raw')
+    for codec in args.codecs:
+        try:
+            r = bench(vid_name, codec, args.frames, args.hot_frames)
+        except ImportError as e:
+            print(f'{codec:>5} : skipped, {e}')
+            continue
+        total_gb = r['kb_per_frame'] * recording / (1<<20)
+        print(f'{codec:>5} : {r["kb_per_frame"]:7.0f}KB/frame '
+              f'(x{r["ratio"]:.1f})  {total_gb:6.1f}GB per recording  '
+              f'encode {r["encode_ms"]:5.1f}ms  '
+              f'decode p50 {r["decode_p50_ms"]:5.1f}ms '
+              f'p95 {r["decode_p95_ms"]:5.1f}ms  '
+              f'fill {r["fill_fps"]:5.0f}fps  step {r["step_fps"]:5.0f}fps')
@@ -0,0 +1,98 @@
+"""Latency from a keypress to the updated frame
+
+Runs a real Engine process on a synthetic video and plays the Viewer:
+puts K_2 (next frame) events on eventQ and waits until a datum showing
+the expected frame is blitted to a pygame Surface.
+
+    single : one K_2, wait for the frame, repeat
+    burst : `--burst` K_2 at once (a held key), wait for the last frame
+
+Usage
+-----
+    python -m benchmarks.bench_latency [--presses 200] [--burst 10]
+"""
+import argparse
+import os
+import time
+import numpy as np
+from multiprocessing import Queue, set_start_method
+
+def _wait_frame(imageQ, rings, surface, target):
+    """Blocks until a datum showing frame `target` is blitted"""
+    import pygame
+    from sources.common.frame_ring import FrameRing
+    from benchmarks.synth import frame_index
+    while True:
+        datum = imageQ.get()
+        ring_info, slot, _ = datum.pop('slot')
+        name = ring_info[0]
+        if name not in rings:
+            rings[name] = FrameRing(ring_info[1], ring_info[2], name=name)
+        image = rings[name].view(slot)
+        pygame.surfarray.blit_array(surface, image)
+        idx = frame_index(image)
+        del image
+        if idx == target:
+            return
+
+def bench(vid_name, presses, burst):
+    import pygame
+    from sources.engine import Engine
+    from sources.common.constants import NEWVID, TERMINATE, K_2, K_R
+    to_EngineQ, to_ConsoleQ, imageQ, eventQ, etcQ = (Queue() for _ in range(5))
+    engine = Engine(to_EngineQ, to_ConsoleQ, imageQ, eventQ, etcQ,
+                    journal=False)
+    engine.start()
+    to_EngineQ.put({NEWVID:vid_name})
+    rings = {}
+    # First datum arrives with the first marker update
+    eventQ.put({K_R:(0,0)})
+    datum = imageQ.get()
+    shape = datum['slot'][0][1]
+    surface = pygame.Surface(shape[0:2])
+
+    idx = 0
+    single = []
+    for _ in range(presses):
+        start = time.perf_counter()
+        eventQ.put({K_2:None})
+        idx += 1
+        _wait_frame(imageQ, rings, surface, idx)
+        single.append(time.perf_counter() - start)
+
+    bursts = []
+    for _ in range(max(presses // burst, 1)):
+        start = time.perf_counter()
+        for _ in range(burst):
+            eventQ.put({K_2:None})
+        idx += burst
+        _wait_frame(imageQ, rings, surface, idx)
+        bursts.append(time.perf_counter() - start)
+
+    to_EngineQ.put({TERMINATE:None})
+    engine.join(5)
+    for ring in rings.values():
+        ring.close()
+    return np.array(single)*1000, np.array(bursts)*1000
+
+if __name__ == '__main__':
+    set_start_method('spawn')
+    from benchmarks.synth import make_video
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--presses', type=int, default=200)
+    parser.add_argument('--burst', type=int, default=10)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--video-dir', default='bench_videos')
+    args = parser.parse_args()
+    os.makedirs(args.video_dir, exist_ok=True)
+    n_frames = args.presses + args.presses // args.burst * args.burst + 10
+    vid_name = make_video(
+        os.path.join(args.video_dir,
+                     f'latency_{args.width}x{args.height}_{n_frames}.mp4'),
+        args.width, args.height, n_frames)
+    single, bursts = bench(vid_name, args.presses, args.burst)
+    for name, lat in (('single', single), (f'burst{args.burst}', bursts)):
+        print(f'{name:>8} : mean {lat.mean():7.2f}ms  '
+              f'p50 {np.percentile(lat,50):7.2f}ms  '
+              f'p95 {np.percentile(lat,95):7.2f}ms')
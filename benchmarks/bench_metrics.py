@@ -0,0 +1,94 @@
+"""Vectorized metrics against per-frame loops over marker dicts
+
+Builds a random session, converts it to the old list of marker dicts,
+and times sources/analysis.py against the loops show_data.ipynb style
+code would use. Results are checked to be the same.
+
+Usage
+-----
+    python -m benchmarks.bench_metrics [--frames 100000] [--repeat 3]
+"""
+import argparse
+import time
+import math
+import numpy as np
+
+def random_session(n_frames, max_food=6, size=(1280, 720), seed=0):
+    """Arrays in the layout of sources/saves.py with random markers"""
+    from sources.common.constants import SINGLE_MARKERS
+    rng = np.random.default_rng(seed)
+    arrays = {}
+    for name in SINGLE_MARKERS:
+        # A random walk, so that speeds look like a moving mouse
+        walk = np.cumsum(rng.integers(-3, 4, (n_frames, 2)), axis=0)
+        arrays[name] = (np.abs(walk) % size).astype(np.int32)
+    counts = rng.integers(0, max_food+1, n_frames)
+    offsets = np.zeros(n_frames+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    arrays['food'] = rng.integers(0, min(size), (offsets[-1], 2)) \
+        .astype(np.int32)
+    arrays['food_offsets'] = offsets
+    return arrays
+
+def loop_metrics(data, radius):
+    """Per-frame loops over marker dicts"""
+    food_n = []
+    nose_food = []
+    head_speed = []
+    near_water = 0
+    prev = None
+    for datum in data:
+        food_n.append(len(datum['food']))
+        nose = datum['nose']
+        best = float('nan')
+        for food in datum['food']:
+            d = math.hypot(food[0]-nose[0], food[1]-nose[1])
+            if not d >= best:
+                best = d
+        nose_food.append(best)
+        water = datum['water']
+        if math.hypot(water[0]-nose[0], water[1]-nose[1]) <= radius:
+            near_water += 1
+        head = datum['head']
+        if prev is None:
+            head_speed.append(float('nan'))
+        else:
+            head_speed.append(math.hypot(head[0]-prev[0], head[1]-prev[1]))
+        prev = head
+    return np.array(food_n), np.array(nose_food), \
+        np.array(head_speed), near_water
+
+def vector_metrics(arrays, radius):
+    from sources import analysis
+    return (analysis.food_count(arrays),
+            analysis.nearest_pin_distance(arrays, 'nose', 'food'),
+            analysis.speed(arrays, 'head'),
+            analysis.time_near(arrays, 'nose', 'water', radius))
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == '__main__':
+    from sources.saves import arrays_to_data
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--radius', type=float, default=20.0)
+    args = parser.parse_args()
+
+    arrays = random_session(args.frames)
+    data = arrays_to_data(arrays)
+    loop_t, loop_r = best_time(lambda: loop_metrics(data, args.radius),
+                               args.repeat)
+    vec_t, vec_r = best_time(lambda: vector_metrics(arrays, args.radius),
+                             args.repeat)
+    for a, b in zip(loop_r, vec_r):
+        assert np.allclose(a, b, equal_nan=True)
+    print(f'{args.frames} frames')
+    print(f'  dict loop  : {loop_t*1000:9.2f}ms')
+    print(f'  vectorized : {vec_t*1000:9.2f}ms  ({loop_t/vec_t:.0f}x)')
@@ -0,0 +1,73 @@
+"""Load time of a whole video against the number of decode workers
+
+Decodes a synthetic video with sources/parallel_decode.py into a raw
+buffer for each worker count, and checks that every frame is identical
+to the sequential (1 worker) result.
+
+Usage
+-----
+    python -m benchmarks.bench_parallel_decode [--workers 1 2 4 8]
+        [--frames 900] [--width 1280] [--height 720] [--threads]
+"""
+import argparse
+import os
+import time
+import tempfile
+import numpy as np
+
+def decode_once(vid_name, frame_num, frame_shape, workers, use_threads,
+                folder):
+    from sources.parallel_decode import decode_parallel
+    frames_name = os.path.join(folder, f'{workers}.frames')
+    filled_name = os.path.join(folder, f'{workers}.filled')
+    np.memmap(frames_name, dtype=np.uint8, mode='w+',
+              shape=(frame_num,)+frame_shape).flush()
+    np.memmap(filled_name, dtype=np.uint8, mode='w+',
+              shape=(frame_num,)).flush()
+    start = time.perf_counter()
+    n_frames, n_redone = decode_parallel(vid_name, frames_name, filled_name,
+                                         frame_num, frame_shape, workers,
+                                         use_threads)
+    elapsed = time.perf_counter() - start
+    frames = np.memmap(frames_name, dtype=np.uint8, mode='r',
+                       shape=(frame_num,)+frame_shape)
+    return elapsed, n_frames, n_redone, frames
+
+if __name__ == '__main__':
+    import cv2
+    from benchmarks.synth import make_video
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    parser.add_argument('--frames', type=int, default=900)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--threads', action='store_true')
+    parser.add_argument('--video-dir', default='bench_videos')
+    args = parser.parse_args()
+    os.makedirs(args.video_dir, exist_ok=True)
+    vid_name = make_video(
+        os.path.join(args.video_dir,
+                     f'decode_{args.width}x{args.height}_{args.frames}.mp4'),
+        args.width, args.height, args.frames)
+    frame_shape = (args.width, args.height, 3)
+
+    print(f'{vid_name}, {os.cpu_count()} cpus, '
+          f'{"threads" if args.threads else "processes"}')
+    with tempfile.TemporaryDirectory() as folder:
+        reference = None
+        base_time = None
+        for workers in sorted(set([1] + args.workers)):
+            elapsed, n_frames, n_redone, frames = decode_once(
+                vid_name, args.frames, frame_shape, workers, args.threads,
+                folder)
+            if reference is None:
+                reference, base_time = frames, elapsed
+                same = True
+            else:
+                same = n_frames == len(reference) and \
+                    np.array_equal(frames[:n_frames], reference[:n_frames])
+            print(f'{workers:3d} workers : {elapsed:7.2f}s '
+                  f'({n_frames/elapsed:6.1f} fps, x{base_time/elapsed:.2f})'
+                  f'  redone {n_redone}  identical {same}')
+            del frames
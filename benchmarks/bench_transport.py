@@ -0,0 +1,112 @@
+"""Per-update latency of sending a frame from Engine to Viewer
+
+Compares the old transport (whole datum with the image pickled through a
+Queue) against the FrameRing transport (image in shared memory, only the
+slot and markers through the Queue).
+Latency is measured from building the datum in the sender (for the ring,
+that includes copying the frame into shared memory) until the receiver has
+blitted the frame to a pygame Surface and acknowledged it.
+
+Usage
+-----
+    python -m benchmarks.bench_transport [--updates 200]
+"""
+import argparse
+import time
+import numpy as np
+from multiprocessing import Process, Queue, set_start_method
+
+RESOLUTIONS = {
+    '720p' : (1280, 720),
+    '1080p' : (1920, 1080),
+    '4K' : (3840, 2160),
+}
+
+MARKERS = {
+    'nose' : (10,10),
+    'head' : (20,20),
+    'tail' : (30,30),
+    'food' : [(0,0),(5,5)],
+    'water' : (40,40),
+    'block' : (50,50),
+}
+
+def _receiver(dataQ:Queue, ackQ:Queue):
+    import pygame
+    from sources.common.frame_ring import FrameRing
+    ring = None
+    surface = None
+    while True:
+        datum = dataQ.get()
+        if datum is None:
+            break
+        if 'image' in datum:
+            image = datum.pop('image')
+        else:
+            ring_info, slot = datum.pop('slot')
+            if ring is None or ring.name != ring_info[0]:
+                if ring is not None:
+                    ring.close()
+                name, shape, n_slots = ring_info
+                ring = FrameRing(shape, n_slots, name=name)
+            image = ring.view(slot)
+        if surface is None or surface.get_size() != image.shape[0:2]:
+            surface = pygame.Surface(image.shape[0:2])
+        pygame.surfarray.blit_array(surface, image)
+        del image
+        ackQ.put(None)
+    if ring is not None:
+        ring.close()
+
+def _measure(dataQ, ackQ, make_datum, updates):
+    latencies = []
+    for i in range(updates):
+        # Building the datum is timed too; for the ring, it is the copy
+        start = time.perf_counter()
+        datum = make_datum(i)
+        dataQ.put(datum)
+        ackQ.get()
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies) * 1000
+
+def bench(width, height, updates):
+    from sources.common.frame_ring import FrameRing
+    # (WIDTH, HEIGHT, 3) -> Pygame notation
+    frames = [np.random.randint(0, 256, (width, height, 3), dtype=np.uint8)
+              for _ in range(2)]
+    dataQ = Queue()
+    ackQ = Queue()
+    receiver = Process(target=_receiver, args=(dataQ, ackQ), daemon=True)
+    receiver.start()
+
+    def pickled(i):
+        return dict(MARKERS, image=frames[i%2])
+    ring = FrameRing(frames[0].shape)
+    def shared(i):
+        slot = ring.write(frames[i%2])
+        return dict(MARKERS, slot=(ring.info, slot))
+
+    # Warm up both paths once
+    _measure(dataQ, ackQ, pickled, 3)
+    _measure(dataQ, ackQ, shared, 3)
+    result = {
+        'pickle' : _measure(dataQ, ackQ, pickled, updates),
+        'shared' : _measure(dataQ, ackQ, shared, updates),
+    }
+    dataQ.put(None)
+    receiver.join()
+    ring.close()
+    return result
+
+if __name__ == '__main__':
+    set_start_method('spawn')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=200)
+    args = parser.parse_args()
+    print(f'{"resolution":>10} {"transport":>9} '
+          f'{"mean(ms)":>9} {"p50(ms)":>8} {"p95(ms)":>8}')
+    for res_name, (width, height) in RESOLUTIONS.items():
+        for transport, lat in bench(width, height, args.updates).items():
+            print(f'{res_name:>10} {transport:>9} {lat.mean():9.2f} '
+                  f'{np.percentile(lat,50):8.2f} '
+                  f'{np.percentile(lat,95):8.2f}')
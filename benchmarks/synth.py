@@ -0,0 +1,77 @@
+"""Synthetic test videos for benchmarks
+
+Every frame has its index written on it and a moving circle, so that
+decoders have some real work to do. The index is also encoded in gray
+blocks at the top-left corner, which survive lossy compression and can be
+read back with frame_index().
+"""
+import numpy as np
+import cv2
+import os
+
+# Index is encoded as INDEX_DIGITS base-16 digits, one per block
+INDEX_DIGITS = 4
+INDEX_BLOCK = 16
+
+FOURCC = {
+    '.mp4' : 'mp4v',
+    '.mpg' : 'PIM1',
+    '.h264' : 'H264',
+}
+
+def make_video(vid_name, width:int, height:int, n_frames:int, fps:int=30):
+    """Writes a synthetic video with cv2.VideoWriter
+
+    The codec is chosen by the extension, see FOURCC.
+    If the video already exists with the same parameters, it is reused.
+
+    Return
+    ------
+    vid_name : str
+    """
+    ext = os.path.splitext(vid_name)[1]
+    if os.path.exists(vid_name):
+        cap = cv2.VideoCapture(vid_name)
+        same = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) == width
+                and int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) == height
+                and int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) == n_frames)
+        cap.release()
+        if same:
+            return vid_name
+    writer = cv2.VideoWriter(vid_name, cv2.VideoWriter_fourcc(*FOURCC[ext]),
+                             fps, (width, height))
+    if not writer.isOpened():
+        raise IOError(f'Cannot write {vid_name}, codec {FOURCC[ext]}')
+    rng = np.random.default_rng(0)
+    # Static noise background, so that frames are not trivially compressible
+    background = rng.integers(0, 64, (height, width, 3), dtype=np.uint8)
+    scale = height / 240
+    for i in range(n_frames):
+        frame = background.copy()
+        center = (int(width/2 + width/3*np.cos(i/30)),
+                  int(height/2 + height/3*np.sin(i/30)))
+        cv2.circle(frame, center, int(20*scale), (255,255,255), -1)
+        cv2.putText(frame, str(i), (int(10*scale), int(60*scale)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 2*scale, (0,255,0),
+                    max(int(3*scale),1))
+        for d in range(INDEX_DIGITS):
+            digit = (i >> (4*d)) & 0xF
+            x = d * INDEX_BLOCK
+            frame[0:INDEX_BLOCK, x:x+INDEX_BLOCK] = digit*16 + 8
+        writer.write(frame)
+    writer.release()
+    return vid_name
+
+def frame_index(image:np.array):
+    """Reads the index encoded by make_video()
+
+    image : (WIDTH, HEIGHT, 3) -> Pygame notation, as Engine sends it
+    """
+    index = 0
+    for d in range(INDEX_DIGITS):
+        x = d * INDEX_BLOCK
+        # Only the center of a block, edges bleed with compression
+        block = image[x+4:x+INDEX_BLOCK-4, 4:INDEX_BLOCK-4]
+        digit = int(np.clip(np.round((block.mean()-8)/16), 0, 15))
+        index |= digit << (4*d)
+    return index
@@ -1,22 +1,39 @@
-from sources.console import Console
-from sources.viewer import Viewer
-from sources.engine import Engine
 from multiprocessing import Queue, set_start_method, freeze_support
-from sources.common.constants import *
 
+# With spawn, every child process imports this module again as __mp_main__.
+# Processes are imported only here, so that each child imports just its own
+# module (e.g. Console never imports cv2 or pygame).
 if __name__ == '__main__':
+    import os
+    import time
+    os.environ.setdefault('MOUSE_CHASER_START', str(time.time()))
     set_start_method('spawn')
     freeze_support()
+    from sources.console import Console
+    from sources.viewer import Viewer
+    from sources.engine import Engine
+    from sources.tracker import Tracker
     imgQ = Queue()
     evntQ = Queue()
     etcQ = Queue()
     termQ =Queue()
     to_ConsoleQ = Queue()
     to_EngineQ = Queue()
+    to_TrackerQ = Queue()
+    from_TrackerQ = Queue()
     console_test = Console(to_ConsoleQ, to_EngineQ, termQ)
     viewer_test = Viewer(720, 300, evntQ, imgQ, etcQ, termQ)
-    engine_test = Engine(to_EngineQ, to_ConsoleQ, imgQ, evntQ, etcQ)
+    # Videos are opened once Viewer's window is up, so decoding does not
+    # slow down its startup
+    engine_test = Engine(to_EngineQ, to_ConsoleQ, imgQ, evntQ, etcQ,
+                         max_display_size=(1920, 1080),
+                         to_TrackerQ=to_TrackerQ,
+                         from_TrackerQ=from_TrackerQ,
+                         wait_for_viewer=10.0)
+    # Engine is a daemon and cannot start processes itself
+    tracker_test = Tracker(to_TrackerQ, from_TrackerQ, ahead=30)
     viewer_test.start()
     console_test.start()
     engine_test.start()
-    termQ.get()
\ No newline at end of file
+    tracker_test.start()
+    termQ.get()
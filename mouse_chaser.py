@@ -0,0 +1,11 @@
+"""Command line tools without the GUI
+
+    python mouse_chaser.py export <records folder> --out <folder>
+
+See sources/batch.py. Run main.py for the labeling GUI.
+"""
+import sys
+from sources.batch import main
+
+if __name__ == '__main__':
+    sys.exit(main())
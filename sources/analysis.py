@@ -0,0 +1,98 @@
+"""Behavioral metrics over whole-session marker arrays
+
+Every function takes arrays in the layout of sources/saves.py (as returned
+by saves.load_annotations() or AnnotationStore.to_arrays()) and works on
+all frames at once, without per-frame Python loops.
+
+Positions are in pixels, (WIDTH, HEIGHT) -> Pygame notation.
+Frames without any food pin get NaN for food distances.
+"""
+import numpy as np
+from .common.constants import MULTIPLE_MARKERS
+from .saves import frame_count
+
+def food_count(arrays, name:str='food'):
+    """Number of pins of a multiple marker per frame, (n_frames,)"""
+    return np.diff(arrays[name+'_offsets'])
+
+def distance(arrays, a:str, b:str):
+    """Distance between two single markers per frame, (n_frames,)"""
+    diff = arrays[a].astype(np.float64) - arrays[b]
+    return np.hypot(diff[:, 0], diff[:, 1])
+
+def nearest_pin_distance(arrays, marker:str='nose', pins:str='food'):
+    """Distance from a single marker to the nearest pin of each frame
+
+    Each pin is compared with the marker of its own frame, and the
+    minimum is taken per frame with np.minimum.reduceat over the
+    offsets, so a variable number of pins needs no padding.
+
+    Return
+    ------
+    dist : (n_frames,) float64
+        NaN for frames without any pin
+    """
+    offsets = arrays[pins+'_offsets']
+    counts = np.diff(offsets)
+    frame_of_pin = np.repeat(np.arange(len(counts)), counts)
+    diff = (arrays[pins] - arrays[marker][frame_of_pin]).astype(np.int64)
+    dist2 = np.einsum('ij,ij->i', diff, diff)
+    dist = np.full(len(counts), np.nan)
+    # reduceat needs non-empty segments
+    has_pin = counts > 0
+    dist[has_pin] = np.sqrt(
+        np.minimum.reduceat(dist2, offsets[:-1][has_pin]))
+    return dist
+
+def speed(arrays, marker:str, fps:float=1.0):
+    """Speed of a single marker in pixels per second, (n_frames,)
+
+    With the default fps of 1, it is the displacement per frame.
+    The first frame has no previous frame, so it is NaN.
+    """
+    step = np.diff(arrays[marker].astype(np.float64), axis=0)
+    result = np.empty(len(arrays[marker]))
+    result[0:1] = np.nan
+    result[1:] = np.hypot(step[:, 0], step[:, 1]) * fps
+    return result
+
+def near(arrays, marker:str, target:str, radius:float):
+    """Frames where marker is within radius of target, (n_frames,) bool
+
+    target can be a single marker or a multiple marker, in which case
+    the nearest pin counts.
+    """
+    if target in MULTIPLE_MARKERS:
+        dist = nearest_pin_distance(arrays, marker, target)
+        # NaN compares False, so frames without pins are never near
+        with np.errstate(invalid='ignore'):
+            return dist <= radius
+    return distance(arrays, marker, target) <= radius
+
+def time_near(arrays, marker:str, target:str, radius:float,
+              fps:float=1.0):
+    """Time spent with marker within radius of target
+
+    With the default fps of 1, it is the number of frames.
+    """
+    return float(np.count_nonzero(near(arrays, marker, target, radius))) / fps
+
+def summary(arrays, fps:float=1.0, radius:float=20.0):
+    """Common metrics of a session in a dict of scalars"""
+    nose_food = nearest_pin_distance(arrays, 'nose', 'food')
+    counts = food_count(arrays)
+    has_food = ~np.isnan(nose_food)
+    result = {
+        'frames' : frame_count(arrays),
+        'food_min' : int(counts.min(initial=0)),
+        'food_max' : int(counts.max(initial=0)),
+        'nose_food_mean' : float(nose_food[has_food].mean())
+            if has_food.any() else float('nan'),
+        'time_near_water' : time_near(arrays, 'nose', 'water', radius, fps),
+        'time_near_food' : time_near(arrays, 'nose', 'food', radius, fps),
+    }
+    for name in ('head', 'tail'):
+        s = speed(arrays, name, fps)[1:]
+        result[f'{name}_speed_mean'] = float(s.mean()) if len(s) \
+            else float('nan')
+    return result
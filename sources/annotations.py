@@ -0,0 +1,285 @@
+import numpy as np
+from .common.constants import SINGLE_MARKERS, MULTIPLE_MARKERS
+
+INTERP_METHODS = ('linear', 'spline')
+
+class AnnotationStore():
+    """Columnar storage of every frame's markers
+
+    Frames 0 ~ len(store)-1 are labeled. Positions are
+        Order : (WIDTH, HEIGHT) -> Pygame notation
+
+    Data structure
+        singles : (capacity, len(SINGLE_MARKERS), 2) int32
+            Single markers, in the order of SINGLE_MARKERS
+        multi[name] : (capacity, multi_capacity, 2) int32
+            Multiple markers (e.g. food), padded per frame
+        multi_count[name] : (capacity,) int32
+            Number of valid multiple markers of each frame
+        manual : (capacity, len(SINGLE_MARKERS)) bool
+            True where a single marker was pinned by hand (a keyframe)
+        interpolated : (capacity, len(SINGLE_MARKERS)) bool
+            True where a single marker was filled in between keyframes
+        proposed : (capacity, len(SINGLE_MARKERS)) bool
+            True where a single marker was set from a tracker proposal.
+            Interpolation never overwrites it
+
+    Images are never stored; a frame is referred by its index only.
+    """
+    def __init__(self, dummy_datum:dict, capacity:int=1024,
+                 multi_capacity:int=4):
+        """
+        Arguments
+        ---------
+        dummy_datum : dict
+            Markers of a frame that is created from nothing
+        capacity : int
+            Initial number of frames to allocate. It grows when needed,
+            so the frame number of the video is a good choice.
+        multi_capacity : int
+            Initial number of multiple markers per frame to allocate
+        """
+        capacity = max(capacity, 1)
+        self._n = 0
+        self._dummy_singles = np.array(
+            [dummy_datum[name] for name in SINGLE_MARKERS], dtype=np.int32)
+        self._dummy_multi = {
+            name : np.array(dummy_datum[name], dtype=np.int32).reshape(-1,2)
+            for name in MULTIPLE_MARKERS
+        }
+        self.singles = np.zeros((capacity, len(SINGLE_MARKERS), 2),
+                                dtype=np.int32)
+        self.manual = np.zeros((capacity, len(SINGLE_MARKERS)), dtype=bool)
+        self.interpolated = np.zeros_like(self.manual)
+        self.proposed = np.zeros_like(self.manual)
+        self.multi = {}
+        self.multi_count = {}
+        for name in MULTIPLE_MARKERS:
+            cap = max(multi_capacity, len(self._dummy_multi[name]))
+            self.multi[name] = np.zeros((capacity, cap, 2), dtype=np.int32)
+            self.multi_count[name] = np.zeros(capacity, dtype=np.int32)
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def nbytes(self):
+        """Memory used by the arrays"""
+        return self.singles.nbytes + self.manual.nbytes \
+            + self.interpolated.nbytes + self.proposed.nbytes + sum(
+            self.multi[n].nbytes + self.multi_count[n].nbytes
+            for n in MULTIPLE_MARKERS)
+
+    def _grow(self, n_frames:int):
+        """Makes room for at least n_frames frames"""
+        capacity = len(self.singles)
+        if n_frames <= capacity:
+            return
+        new_capacity = max(n_frames, capacity * 2)
+        pad = new_capacity - capacity
+        self.singles = np.concatenate(
+            [self.singles, np.zeros((pad,)+self.singles.shape[1:],
+                                    dtype=np.int32)])
+        flags_pad = np.zeros((pad, len(SINGLE_MARKERS)), dtype=bool)
+        self.manual = np.concatenate([self.manual, flags_pad])
+        self.interpolated = np.concatenate([self.interpolated, flags_pad])
+        self.proposed = np.concatenate([self.proposed, flags_pad])
+        for name in MULTIPLE_MARKERS:
+            self.multi[name] = np.concatenate(
+                [self.multi[name], np.zeros((pad,)+self.multi[name].shape[1:],
+                                            dtype=np.int32)])
+            self.multi_count[name] = np.concatenate(
+                [self.multi_count[name], np.zeros(pad, dtype=np.int32)])
+
+    def _grow_multi(self, name:str, count:int):
+        """Makes room for at least count multiple markers per frame"""
+        arr = self.multi[name]
+        if count <= arr.shape[1]:
+            return
+        new_cap = max(count, arr.shape[1] * 2)
+        pad = np.zeros((arr.shape[0], new_cap-arr.shape[1], 2),
+                       dtype=np.int32)
+        self.multi[name] = np.concatenate([arr, pad], axis=1)
+
+    def _set_dummy(self, frames:slice):
+        self.singles[frames] = self._dummy_singles
+        for name in MULTIPLE_MARKERS:
+            dummy = self._dummy_multi[name]
+            self.multi[name][frames, :len(dummy)] = dummy
+            self.multi_count[name][frames] = len(dummy)
+
+    def append(self, src:int=-1):
+        """Appends a new frame as a copy of frame src
+
+        If src is negative, the new frame gets the dummy markers.
+        It is an O(markers) copy.
+        """
+        self.extend(self._n+1, src)
+
+    def extend(self, n_frames:int, src:int=-1):
+        """Appends frames up to n_frames, all copies of frame src"""
+        if n_frames <= self._n:
+            return
+        self._grow(n_frames)
+        new = slice(self._n, n_frames)
+        # Copies are neither keyframes, interpolated nor proposed
+        self.manual[new] = False
+        self.interpolated[new] = False
+        self.proposed[new] = False
+        if src < 0:
+            self._set_dummy(new)
+        else:
+            self.singles[new] = self.singles[src]
+            for name in MULTIPLE_MARKERS:
+                self.multi[name][new] = self.multi[name][src]
+                self.multi_count[name][new] = self.multi_count[name][src]
+        self._n = n_frames
+
+    def get(self, frame:int, marker_type:str):
+        """Position of a single marker, or list of positions"""
+        if marker_type in MULTIPLE_MARKERS:
+            count = self.multi_count[marker_type][frame]
+            return [tuple(p) for p in
+                    self.multi[marker_type][frame, :count].tolist()]
+        idx = SINGLE_MARKERS.index(marker_type)
+        return tuple(self.singles[frame, idx].tolist())
+
+    def set(self, frame:int, marker_type:str, pos):
+        """Sets a single marker by hand, making the frame its keyframe"""
+        idx = SINGLE_MARKERS.index(marker_type)
+        self.singles[frame, idx] = pos
+        self.manual[frame, idx] = True
+        self.interpolated[frame, idx] = False
+        self.proposed[frame, idx] = False
+
+    def propose(self, frame:int, marker_type:str, pos):
+        """Sets a single marker from a guess (e.g. tracking), not a keyframe"""
+        idx = SINGLE_MARKERS.index(marker_type)
+        self.singles[frame, idx] = pos
+        self.interpolated[frame, idx] = False
+        self.proposed[frame, idx] = True
+
+    def is_keyframe(self, frame:int, marker_type:str):
+        return bool(self.manual[frame, SINGLE_MARKERS.index(marker_type)])
+
+    def keyframes(self, marker_type:str):
+        """Sorted frames where the single marker was set by hand"""
+        idx = SINGLE_MARKERS.index(marker_type)
+        return np.flatnonzero(self.manual[:self._n, idx])
+
+    def interpolated_markers(self, frame:int):
+        """Names of the single markers that are interpolated in frame"""
+        return [name for name, flag in
+                zip(SINGLE_MARKERS, self.interpolated[frame]) if flag]
+
+    def interpolate(self, marker_type:str, around:int, method:str='linear'):
+        """Fills frames between keyframes near the keyframe `around`
+
+        Every frame between two adjacent keyframes whose values depend on
+        `around` is overwritten, except for tracker proposals. That is the gaps on both sides of it for
+        'linear', and two gaps on each side for 'spline', which is a cubic
+        Hermite spline with Catmull-Rom tangents (centered differences
+        scaled by the uneven keyframe spacing).
+        A whole gap is filled with a few array operations.
+        """
+        idx = SINGLE_MARKERS.index(marker_type)
+        keys = self.keyframes(marker_type)
+        j = np.searchsorted(keys, around)
+        if j == len(keys) or keys[j] != around:
+            return
+        reach = 1 if method == 'linear' else 2
+        pos = self.singles[:, idx]
+        for g in range(max(j-reach, 0), min(j+reach, len(keys)-1)):
+            start, stop = int(keys[g]), int(keys[g+1])
+            if stop - start < 2:
+                continue
+            frames = np.arange(start+1, stop)
+            t = ((frames - start) / (stop - start))[:, None]
+            p0 = pos[start].astype(np.float64)
+            p1 = pos[stop].astype(np.float64)
+            if method == 'linear':
+                values = p0 + t * (p1 - p0)
+            else:
+                prev = int(keys[g-1]) if g > 0 else start
+                after = int(keys[g+2]) if g+2 < len(keys) else stop
+                # Tangents in position per frame, one sided at the ends
+                m0 = (p1 - pos[prev]) / (stop - prev)
+                m1 = (pos[after] - p0) / (after - start)
+                h = stop - start
+                t2, t3 = t*t, t*t*t
+                values = ((2*t3 - 3*t2 + 1) * p0 + (t3 - 2*t2 + t) * h * m0
+                          + (-2*t3 + 3*t2) * p1 + (t3 - t2) * h * m1)
+            fill = ~self.proposed[start+1:stop, idx]
+            pos[start+1:stop][fill] = np.rint(values[fill])
+            self.interpolated[start+1:stop, idx] = fill
+
+    def count(self, frame:int, marker_type:str):
+        """Number of multiple markers in the frame"""
+        return int(self.multi_count[marker_type][frame])
+
+    def set_multi(self, frame:int, marker_type:str, idx:int, pos):
+        """Sets idx-th marker of a multiple marker"""
+        self.multi[marker_type][frame, idx] = pos
+
+    def add(self, frame:int, marker_type:str, pos):
+        """Appends a multiple marker"""
+        count = self.count(frame, marker_type)
+        self._grow_multi(marker_type, count+1)
+        self.multi[marker_type][frame, count] = pos
+        self.multi_count[marker_type][frame] = count + 1
+
+    def pop(self, frame:int, marker_type:str):
+        """Removes the last multiple marker. Returns False if none left"""
+        count = self.count(frame, marker_type)
+        if count == 0:
+            return False
+        self.multi_count[marker_type][frame] = count - 1
+        return True
+
+    def datum(self, frame:int):
+        """Markers of a frame as a dict, same as the old per-frame data"""
+        datum = {}
+        for i, name in enumerate(SINGLE_MARKERS):
+            datum[name] = tuple(self.singles[frame, i].tolist())
+        for name in MULTIPLE_MARKERS:
+            datum[name] = self.get(frame, name)
+        return datum
+
+    def to_arrays(self):
+        """Arrays in the layout of sources/saves.py"""
+        n = self._n
+        arrays = {}
+        for i, name in enumerate(SINGLE_MARKERS):
+            arrays[name] = self.singles[:n, i].copy()
+        arrays['manual'] = self.manual[:n].copy()
+        arrays['interpolated'] = self.interpolated[:n].copy()
+        arrays['proposed'] = self.proposed[:n].copy()
+        for name in MULTIPLE_MARKERS:
+            counts = self.multi_count[name][:n]
+            offsets = np.zeros(n+1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            valid = np.arange(self.multi[name].shape[1]) < counts[:,None]
+            arrays[name] = self.multi[name][:n][valid]
+            arrays[name+'_offsets'] = offsets
+        return arrays
+
+    def load_arrays(self, arrays:dict):
+        """Replaces everything with arrays in the layout of sources/saves.py"""
+        n = len(arrays[MULTIPLE_MARKERS[0]+'_offsets']) - 1
+        self._grow(n)
+        for i, name in enumerate(SINGLE_MARKERS):
+            self.singles[:n, i] = arrays[name]
+        # Older saves have no flags
+        self.manual[:n] = arrays.get('manual', False)
+        self.interpolated[:n] = arrays.get('interpolated', False)
+        self.proposed[:n] = arrays.get('proposed', False)
+        for name in MULTIPLE_MARKERS:
+            offsets = arrays[name+'_offsets']
+            counts = np.diff(offsets).astype(np.int32)
+            self._grow_multi(name, int(counts.max(initial=0)))
+            self.multi_count[name][:n] = counts
+            # Position of each pin inside its own frame
+            frame_of_pin = np.repeat(np.arange(n), counts)
+            pin_idx = np.arange(offsets[-1]) - offsets[frame_of_pin]
+            self.multi[name][frame_of_pin, pin_idx] = arrays[name]
+        self._n = n
@@ -0,0 +1,206 @@
+"""Headless export of saves into per-frame marker tables
+
+Scans a records tree for saves (<video folder>/save/<n>.npz, and old
+<n>.pck with --pck) and writes one table per save, in a process pool.
+Each worker holds only one save's arrays; images are never loaded,
+except that old .pck saves have to be unpickled as a whole.
+
+Table columns, one row per labeled frame
+    frame
+    <single marker>_x, <single marker>_y for each SINGLE_MARKERS
+    <multiple marker>_n
+    <multiple marker><i>_x, <multiple marker><i>_y, -1 if there is none
+    <single marker>_interp, 1 if interpolated between keyframes
+        (only for saves that have the flags)
+
+Formats
+    csv : <stem>.csv
+    npz : <stem>.npz with one array per column
+    parquet : <stem>.parquet, only if pyarrow is installed
+
+Use
+    python mouse_chaser.py export <records folder> --out <folder>
+"""
+import numpy as np
+import os
+import sys
+import time
+import pickle
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .common.constants import SINGLE_MARKERS, MULTIPLE_MARKERS
+from . import saves
+
+FORMATS = ('csv', 'npz', 'parquet')
+
+def find_saves(root, pck:bool=False):
+    """Every save under root, sorted
+
+    Only files directly in a 'save' folder count, so journal
+    snapshots (save/journal/*.snap.npz) are skipped.
+    A .pck with a .npz of the same stem next to it was converted already
+    (see saves.convert_pck), and is skipped; both would export to the
+    same table.
+    """
+    suffixes = (saves.SAVE_EXT, '.pck') if pck else (saves.SAVE_EXT,)
+    found = []
+    for dirpath, _, filenames in os.walk(root):
+        if os.path.basename(dirpath) != 'save':
+            continue
+        names = set(filenames)
+        for f in filenames:
+            stem, suffix = os.path.splitext(f)
+            if suffix not in suffixes or not stem.isdigit():
+                continue
+            if suffix == '.pck' and stem + saves.SAVE_EXT in names:
+                continue
+            found.append(Path(dirpath) / f)
+    return sorted(found)
+
+def load_arrays(save_name):
+    """Marker arrays of a .npz or an old .pck save"""
+    save_name = Path(save_name)
+    if save_name.suffix == '.pck':
+        with open(save_name, 'rb') as f:
+            data = pickle.load(f)
+        return saves.data_to_arrays([saves._legacy_datum(d) for d in data])
+    return saves.load_annotations(save_name)
+
+def marker_table(arrays):
+    """Per-frame columns of a save
+
+    Parameters
+    ----------
+    arrays : dict
+        Returned by load_annotations() or data_to_arrays()
+
+    Return
+    ------
+    columns : dict
+        Column name -> (n_frames,) int array, in column order
+    """
+    n = saves.frame_count(arrays)
+    columns = {'frame' : np.arange(n, dtype=np.int32)}
+    for name in SINGLE_MARKERS:
+        columns[name+'_x'] = arrays[name][:, 0]
+        columns[name+'_y'] = arrays[name][:, 1]
+    if 'interpolated' in arrays:
+        for i, name in enumerate(SINGLE_MARKERS):
+            columns[name+'_interp'] = \
+                arrays['interpolated'][:, i].astype(np.int32)
+    for name in MULTIPLE_MARKERS:
+        offsets = arrays[name+'_offsets']
+        counts = np.diff(offsets)
+        columns[name+'_n'] = counts.astype(np.int32)
+        width = int(counts.max(initial=0))
+        padded = np.full((n, width, 2), -1, dtype=np.int32)
+        valid = np.arange(width) < counts[:, None]
+        padded[valid] = arrays[name]
+        for i in range(width):
+            columns[f'{name}{i}_x'] = padded[:, i, 0]
+            columns[f'{name}{i}_y'] = padded[:, i, 1]
+    return columns
+
+def write_table(columns:dict, out_name, fmt:str):
+    """Writes columns to out_name in the format fmt"""
+    out_name = Path(out_name)
+    out_name.parent.mkdir(parents=True, exist_ok=True)
+    tmp_name = out_name.with_name(out_name.name + '.tmp')
+    if fmt == 'csv':
+        table = np.column_stack(list(columns.values()))
+        np.savetxt(tmp_name, table, fmt='%d', delimiter=',',
+                   header=','.join(columns), comments='')
+    elif fmt == 'npz':
+        with open(tmp_name, 'wb') as f:
+            np.savez(f, **columns)
+    elif fmt == 'parquet':
+        import pyarrow
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(pyarrow.table(columns), tmp_name)
+    else:
+        raise ValueError(f'Unknown format {fmt}')
+    os.replace(tmp_name, out_name)
+
+def export_save(save_name, root, out_dir, fmt:str):
+    """Exports a single save. Runs in a worker process
+
+    The table goes to <out_dir>/<save path relative to root>.<fmt>
+
+    Return
+    ------
+    save_name, n_frames, out_name
+    """
+    save_name = Path(save_name)
+    rel = save_name.relative_to(root).with_suffix('.' + fmt)
+    out_name = Path(out_dir) / rel
+    columns = marker_table(load_arrays(save_name))
+    write_table(columns, out_name, fmt)
+    return save_name, len(columns['frame']), out_name
+
+def export_all(root, out_dir, fmt:str='csv', workers:int=None,
+               pck:bool=False):
+    """Exports every save under root in a process pool
+
+    Progress and throughput are printed as each save finishes.
+
+    Return
+    ------
+    failed : list of (save_name, error message)
+    """
+    root = Path(root)
+    save_names = find_saves(root, pck)
+    print(f'{len(save_names)} saves found in {root}')
+    failed = []
+    n_frames = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(export_save, s, root, out_dir, fmt) : s
+                   for s in save_names}
+        for i, future in enumerate(as_completed(futures), 1):
+            save_name = futures[future]
+            try:
+                _, n, out_name = future.result()
+            except Exception as e:
+                failed.append((save_name, f'{type(e).__name__}: {e}'))
+                print(f'[{i}/{len(futures)}] {save_name} failed : {e}')
+                continue
+            n_frames += n
+            elapsed = time.perf_counter() - start
+            print(f'[{i}/{len(futures)}] {save_name} -> {out_name} '
+                  f'({n} frames, {i/elapsed:.1f} saves/s, '
+                  f'{n_frames/elapsed:.0f} frames/s)')
+    elapsed = time.perf_counter() - start
+    print(f'{len(save_names)-len(failed)} saves, {n_frames} frames '
+          f'exported in {elapsed:.1f}s')
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='mouse_chaser',
+        description='Headless tools for Mouse Chaser saves')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser(
+        'export', help='export every save under a folder as marker tables')
+    export_parser.add_argument('root', help='records folder to scan')
+    export_parser.add_argument('--out', required=True,
+                               help='folder to write tables in')
+    export_parser.add_argument('--format', choices=FORMATS, default='csv')
+    export_parser.add_argument('--workers', type=int, default=None,
+                               help='number of processes (default: cpus)')
+    export_parser.add_argument('--pck', action='store_true',
+                               help='also export old .pck saves')
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        if args.format == 'parquet':
+            try:
+                import pyarrow
+            except ImportError:
+                parser.error('parquet format needs pyarrow installed')
+        failed = export_all(args.root, args.out, args.format,
+                            args.workers, args.pck)
+        return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,6 +12,19 @@ TERMINATE = -1
 
 NEWVID = 101
 SAVE = 102
+# Video to open in the background, expected to be the next NEWVID
+PRELOAD = 103
+# Move to a frame number
+JUMP = 104
+# Move to a frame number once it is decoded in the background.
+# A newer SCRUB supersedes an older one that is not shown yet
+SCRUB = 105
+# (video, save file[, force]) to open with the markers of a save
+RESUME = 106
+
+# Marker names
+SINGLE_MARKERS = ('nose', 'head', 'tail', 'water', 'block')
+MULTIPLE_MARKERS = ('food',)
 
 
 
@@ -22,7 +35,10 @@ MOUSEDOWN = 401
 MOUSEUP = 402
 MOUSEPOS = 403
 MOUSEDOWN_RIGHT = 404
-
+# Move by N frames (negative for backward). Coalesced K_1 / K_2
+SEEK_BY = 405
+# Sent once when the window is open
+VIEWER_READY = 406
 
 # Keys
 # Use same numbers as pygame.K_* + 1000
@@ -41,9 +57,28 @@ K_Q = 1113
 K_I = 1105
 K_L = 1108
 
+# Tracker Constants ###########################################################
+TRACK_VIDEO = 701
+TRACK_FROM = 702
+TRACK_PAUSE = 703
+TRACK_RESUME = 704
+TRACK_PROPOSAL = 705
+# Markers the tracker follows
+TRACKED_MARKERS = ('nose', 'head', 'tail')
+
+# Trace Constants #############################################################
+# Key of timestamps in any message, see common/trace.py
+TRACE = 901
+
 # Console Constants ###########################################################
 VIDEO_FORMATS = ('.h264','.mpg','mp4')
 
 MESSAGE_BOX = 601
 FRAMEIDX = 602
 MARKERIDX = 603
+CACHE_STAT = 604
+# (frame index, frame number) as ints, for the timeline
+FRAMEPOS = 605
+# (video, save file, journal frames, save frames) of a RESUME that would
+# drop newer journal edits. Console asks, and sends RESUME with force
+CONFIRM_RESUME = 606
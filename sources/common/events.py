@@ -0,0 +1,53 @@
+from .constants import *
+
+# Keys that move a single marker. Only the last move of each counts.
+SINGLE_MARKER_KEYS = (K_E, K_R, K_D, K_W, K_Q)
+# Events that are overwritten by the next one of the same kind
+LAST_ONLY_KEYS = SINGLE_MARKER_KEYS + (MOUSEPOS,)
+
+def _nav_step(k, v):
+    """Frames moved by a navigation event, or None if it is not one"""
+    if k == K_1:
+        return -1
+    elif k == K_2:
+        return 1
+    elif k == SEEK_BY:
+        return v
+    return None
+
+def coalesce(events:list):
+    """Merges events from Viewer that can be merged, keeping their effect
+
+    Parameters
+    ----------
+    events : list of dict
+        Events in the order they happened
+
+    Return
+    ------
+    events : list of dict
+        - Consecutive K_1 / K_2 / SEEK_BY become a single {SEEK_BY: n}
+        - Between two navigations, only the last move of each single
+          marker (and the last MOUSEPOS) is kept
+        - Everything else is kept in order
+    """
+    merged = []
+    # Index in `merged` of the last event of each LAST_ONLY_KEYS
+    last_move = {}
+    for event in events:
+        for k, v in event.items():
+            step = _nav_step(k, v)
+            if step is not None:
+                if merged and SEEK_BY in merged[-1]:
+                    merged[-1][SEEK_BY] += step
+                else:
+                    merged.append({SEEK_BY:step})
+                last_move = {}
+            elif k in LAST_ONLY_KEYS:
+                if k in last_move:
+                    merged[last_move[k]] = None
+                last_move[k] = len(merged)
+                merged.append({k:v})
+            else:
+                merged.append({k:v})
+    return [m for m in merged if m is not None and m.get(SEEK_BY) != 0]
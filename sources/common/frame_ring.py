@@ -0,0 +1,70 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+class FrameRing():
+    """Ring buffer of frame slots in shared memory
+
+    Engine writes each new frame into the next slot and only sends
+    the slot number through the queue. Viewer attaches to the same buffer
+    by its name and reads the slot in place, so frames are never pickled.
+
+    Slots are reused in order, so a reader that falls behind by more than
+    n_slots frames may see a newer frame than the one it was told about.
+    A slot number alone does not tell whether the frame in it changed,
+    since the same number comes back every n_slots writes; Engine sends a
+    frame sequence number along for that.
+    """
+    def __init__(self, frame_shape:tuple, n_slots:int=4, name:str=None):
+        """
+        Arguments
+        ---------
+        frame_shape : tuple
+            Shape of a single frame, (WIDTH, HEIGHT, 3)
+        n_slots : int
+            Number of slots in the ring
+        name : str
+            Name of an existing ring to attach to.
+            If None, a new shared memory block is created.
+        """
+        self.frame_shape = tuple(frame_shape)
+        self.n_slots = n_slots
+        nbytes = int(np.prod(self.frame_shape)) * n_slots
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self._owner = True
+        else:
+            # Processes started by spawn share one resource tracker,
+            # so attaching does not register the block a second time
+            self._shm = shared_memory.SharedMemory(name=name)
+            self._owner = False
+        self._array = np.ndarray((n_slots,)+self.frame_shape,
+                                 dtype=np.uint8, buffer=self._shm.buf)
+        self._next_slot = 0
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def info(self):
+        """Everything needed to attach to this ring from another process"""
+        return (self.name, self.frame_shape, self.n_slots)
+
+    def write(self, image:np.array):
+        """Copy image to the next slot and returns the slot number"""
+        slot = self._next_slot
+        self._array[slot] = image
+        self._next_slot = (slot + 1) % self.n_slots
+        return slot
+
+    def view(self, slot:int):
+        """Returns the frame in the slot without copying"""
+        return self._array[slot]
+
+    def close(self):
+        """Detach from the shared memory. The creator also unlinks it."""
+        # ndarray holds the buffer; release it before closing
+        self._array = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
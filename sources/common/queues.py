@@ -0,0 +1,34 @@
+import time
+import queue
+from multiprocessing.connection import wait
+
+def wait_queues(queues:list, timeout:float=None):
+    """Blocks until any of the queues has a message, or until timeout
+
+    Works with multiprocessing.Queue by waiting on its underlying pipe,
+    so the caller wakes up as soon as a message arrives.
+    queue.Queue (e.g. a headless Engine in a benchmark) is polled instead.
+
+    Return
+    ------
+    ready : bool
+        True if any queue seems to have a message
+    """
+    readers = [getattr(q, '_reader', None) for q in queues]
+    if all(r is not None for r in readers):
+        return len(wait(readers, timeout)) > 0
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        if any(not q.empty() for q in queues):
+            return True
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        time.sleep(0.001)
+
+def drain(q):
+    """Yields every message that is already in the queue, without blocking"""
+    while True:
+        try:
+            yield q.get_nowait()
+        except queue.Empty:
+            return
@@ -0,0 +1,36 @@
+"""Startup time of each process
+
+main.py sets MOUSE_CHASER_START to its own start time (time.time()), which
+child processes inherit, so every process can tell how long after launch
+it reached each stage. Each process prints one line when it is ready, e.g.
+    startup viewer : imported 0.31s, window 0.45s, first_frame 2.10s
+        (loaded numpy, pygame)
+"""
+import os
+import sys
+import time
+
+START = float(os.environ.get('MOUSE_CHASER_START', 0)) or time.time()
+
+# Modules that take long to import; listed if a process has loaded them
+HEAVY_MODULES = ('numpy', 'cv2', 'pygame', 'tkinter')
+
+class StartupReport():
+    """Stages of a process' startup, in seconds since launch"""
+    def __init__(self, name:str):
+        self.name = name
+        self.done = False
+        self._stages = []
+
+    def mark(self, stage:str):
+        self._stages.append((stage, time.time() - START))
+
+    def report(self):
+        """Prints the stages and the heavy modules loaded, only once"""
+        if self.done:
+            return
+        self.done = True
+        stages = ', '.join(f'{s} {t:.2f}s' for s, t in self._stages)
+        modules = ', '.join(m for m in HEAVY_MODULES if m in sys.modules)
+        print(f'startup {self.name} : {stages} (loaded {modules or "none"})',
+              flush=True)
@@ -0,0 +1,138 @@
+"""Optional latency tracing across processes
+
+Set the environment variable MOUSE_CHASER_TRACE to a folder to turn it on,
+e.g.
+    MOUSE_CHASER_TRACE=traces python main.py
+Child processes inherit it. When it is not set, ENABLED is False and every
+call site is skipped by an `if trace.ENABLED:` check, so it costs nothing.
+
+A message carries its stamps under the TRACE key
+    {..., TRACE : [(stage, time), ...]}
+Times are time.perf_counter() seconds, which is a system-wide monotonic
+clock on Linux and Windows, so stamps of different processes compare.
+A chain of stamps follows a key press from Viewer, through Engine, back to
+Viewer, which records it with a Tracer.
+
+On exit, each process with a Tracer writes into the folder
+    trace-<name>.json : Chrome trace events, for chrome://tracing or
+                        https://ui.perfetto.dev
+    latency-<name>.txt : per-stage latency histograms
+"""
+import os
+import json
+import time
+from collections import defaultdict
+from .constants import TRACE
+
+TRACE_DIR = os.environ.get('MOUSE_CHASER_TRACE', '')
+ENABLED = bool(TRACE_DIR)
+
+# Upper edges of histogram buckets, in ms
+BUCKETS = (0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, float('inf'))
+
+def stamp(msg:dict, stage:str):
+    """Appends (stage, now) to the stamps of msg. Returns msg"""
+    msg.setdefault(TRACE, []).append((stage, time.perf_counter()))
+    return msg
+
+def pop_stamps(msgs:list):
+    """Removes stamps from every message
+
+    Return
+    ------
+    stamps : list
+        Stamps of the oldest message that had any, which is the one the
+        user has been waiting for the longest. Empty if none had any.
+    """
+    oldest = []
+    for msg in msgs:
+        stamps = msg.pop(TRACE, None)
+        if stamps and (not oldest or stamps[0][1] < oldest[0][1]):
+            oldest = stamps
+    return oldest
+
+
+class Tracer():
+    """Collects chains of stamps in a process, and writes them on close"""
+    def __init__(self, name:str, trace_dir:str=None, max_events:int=200000):
+        """
+        Arguments
+        ---------
+        name : str
+            Process name, used in file names
+        trace_dir : str
+            Folder to write into. Defaults to MOUSE_CHASER_TRACE
+        max_events : int
+            Trace events to keep; older ones are dropped from the json
+            (histograms still count them)
+        """
+        self.name = name
+        self.trace_dir = trace_dir or TRACE_DIR
+        self.max_events = max_events
+        self._events = []
+        self._latencies = defaultdict(list)
+        self._origin = time.perf_counter()
+
+    def add(self, stamps:list):
+        """Records a chain of stamps
+
+        Each consecutive pair becomes a stage '<a> -> <b>', and the whole
+        chain also counts as 'total'.
+        """
+        if len(stamps) < 2:
+            return
+        for (a, t0), (b, t1) in zip(stamps[:-1], stamps[1:]):
+            stage = f'{a} -> {b}'
+            self._latencies[stage].append((t1 - t0) * 1000)
+            self._events.append({
+                'name' : stage, 'ph' : 'X', 'pid' : 1, 'tid' : a,
+                'ts' : (t0 - self._origin) * 1e6,
+                'dur' : (t1 - t0) * 1e6,
+            })
+        self._latencies['total'].append((stamps[-1][1] - stamps[0][1]) * 1000)
+        if len(self._events) > self.max_events * 2:
+            del self._events[:-self.max_events]
+
+    def recent(self, stage:str='total', n:int=100):
+        """Last n latencies of a stage, in ms"""
+        return self._latencies[stage][-n:]
+
+    def histograms(self):
+        """{stage : bucket counts}, with upper edges in BUCKETS"""
+        import numpy as np
+        edges = np.array((0,) + BUCKETS)
+        return {stage : np.histogram(lat, bins=edges)[0].tolist()
+                for stage, lat in self._latencies.items()}
+
+    def summary(self):
+        """Per-stage percentiles and histograms as text"""
+        import numpy as np
+        lines = []
+        histograms = self.histograms()
+        for stage, lat in sorted(self._latencies.items()):
+            lat = np.array(lat)
+            lines.append(f'{stage} : n {len(lat)}  '
+                         f'p50 {np.percentile(lat,50):.2f}ms  '
+                         f'p95 {np.percentile(lat,95):.2f}ms  '
+                         f'p99 {np.percentile(lat,99):.2f}ms  '
+                         f'max {lat.max():.2f}ms')
+            total = max(len(lat), 1)
+            low = 0
+            for high, count in zip(BUCKETS, histograms[stage]):
+                bar = '#' * round(40 * count / total)
+                lines.append(f'  {low:>6g} ~ {high:<6g}ms {count:8d} {bar}')
+                low = high
+        return '\n'.join(lines)
+
+    def write(self):
+        """Writes the trace json and the histograms into trace_dir"""
+        if not self._latencies:
+            return
+        os.makedirs(self.trace_dir, exist_ok=True)
+        with open(os.path.join(self.trace_dir,
+                               f'trace-{self.name}.json'), 'w') as f:
+            json.dump({'traceEvents' : self._events[-self.max_events:],
+                       'displayTimeUnit' : 'ms'}, f)
+        with open(os.path.join(self.trace_dir,
+                               f'latency-{self.name}.txt'), 'w') as f:
+            f.write(self.summary() + '\n')
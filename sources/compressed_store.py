@@ -0,0 +1,171 @@
+"""Decoded frames kept compressed in memory
+
+A long recording does not fit in memory as raw frames, and decoding it
+again on every visit is slow. A CompressedFrameStore keeps every decoded
+frame compressed with a fast codec, and decompresses it on access.
+FrameSource keeps it behind its LRU of decoded frames, which then works as
+a small hot set around the current frame (see FrameSource `compress`).
+
+Codecs
+    zlib : lossless, standard library. Default
+    lz4 : lossless and faster than zlib, only if lz4 is installed
+    png : lossless, with cv2. Often smaller than zlib, but slower
+    jpeg : near-lossless (quality 95, no chroma subsampling by default),
+           several times smaller
+
+Frames are in the same layout as FrameSource
+    Shape : (WIDTH, HEIGHT, 3) -> Pygame notation, RGB
+and are compressed in cv2 layout (HEIGHT, WIDTH, 3), which is how they
+come out of the decoder, so that compressing does not need a copy.
+"""
+import numpy as np
+import zlib
+import time
+from collections import OrderedDict, deque
+
+CODECS = ('zlib', 'lz4', 'png', 'jpeg')
+
+def _codec(name:str, level:int=None):
+    """(encode, decode) functions of a codec
+
+    encode : (HEIGHT, WIDTH, 3) contiguous uint8 RGB -> bytes
+    decode : (bytes, shape) -> (HEIGHT, WIDTH, 3) uint8 RGB
+    """
+    if name == 'zlib':
+        level = 1 if level is None else level
+        return (lambda image: zlib.compress(image, level),
+                lambda data, shape: np.frombuffer(
+                    zlib.decompress(data), np.uint8).reshape(shape))
+    elif name == 'lz4':
+        import lz4.frame
+        level = 0 if level is None else level
+        return (lambda image: lz4.frame.compress(
+                    image, compression_level=level),
+                lambda data, shape: np.frombuffer(
+                    lz4.frame.decompress(data), np.uint8).reshape(shape))
+    elif name == 'png':
+        import cv2
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 1 if level is None else level]
+        # Lossless, so the channel order does not matter
+        return (lambda image: cv2.imencode('.png', image, params)[1],
+                lambda data, shape: cv2.imdecode(data, cv2.IMREAD_UNCHANGED))
+    elif name == 'jpeg':
+        import cv2
+        params = [cv2.IMWRITE_JPEG_QUALITY, 95 if level is None else level]
+        # No chroma subsampling, which would blur colored edges of markers
+        if hasattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR'):
+            params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR,
+                       cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444]
+        return (lambda image: cv2.imencode(
+                    '.jpg', cv2.cvtColor(image, cv2.COLOR_RGB2BGR), params)[1],
+                lambda data, shape: cv2.cvtColor(
+                    cv2.imdecode(data, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB))
+    raise ValueError(f'Unknown codec {name}, one of {CODECS}')
+
+
+class CompressedFrameStore():
+    """Compressed frames by index, with sizes and timings
+
+    It is not thread safe by itself; FrameSource uses it under its lock.
+    """
+    def __init__(self, codec:str='zlib', level:int=None,
+                 max_bytes:int=None):
+        """
+        Arguments
+        ---------
+        codec : str
+            One of CODECS
+        level : int
+            Compression level of zlib / lz4 / png, or jpeg quality.
+            None for a fast default
+        max_bytes : int
+            Maximum bytes of compressed frames. The least recently used
+            frames are dropped beyond it. None for no limit
+        """
+        self.codec = codec
+        self.max_bytes = max_bytes
+        self._encode, self._decode = _codec(codec, level)
+        self._frames = OrderedDict()
+        self._shape = None
+        self.nbytes = 0
+        self.raw_nbytes = 0
+        self.n_puts = 0
+        self.n_gets = 0
+        self._encode_time = 0.0
+        self._decode_time = 0.0
+        # Recent decode times, for percentiles
+        self._recent = deque(maxlen=256)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, idx:int):
+        return idx in self._frames
+
+    def put(self, idx:int, frame:np.array):
+        """Compresses and keeps frame, (WIDTH, HEIGHT, 3)"""
+        start = time.perf_counter()
+        image = np.ascontiguousarray(frame.swapaxes(0,1))
+        data = self._encode(image)
+        self._encode_time += time.perf_counter() - start
+        self.n_puts += 1
+        self._shape = image.shape
+        if idx in self._frames:
+            self.nbytes -= len(self._frames.pop(idx))
+            self.raw_nbytes -= image.nbytes
+        self._frames[idx] = data
+        self.nbytes += len(data)
+        self.raw_nbytes += image.nbytes
+        while self.max_bytes is not None and len(self._frames) > 1 and \
+                self.nbytes > self.max_bytes:
+            _, old = self._frames.popitem(last=False)
+            self.nbytes -= len(old)
+            self.raw_nbytes -= image.nbytes
+
+    def get(self, idx:int):
+        """Decompressed frame at idx, (WIDTH, HEIGHT, 3). KeyError if none"""
+        data = self._frames[idx]
+        self._frames.move_to_end(idx)
+        start = time.perf_counter()
+        image = self._decode(data, self._shape)
+        elapsed = time.perf_counter() - start
+        self._decode_time += elapsed
+        self._recent.append(elapsed)
+        self.n_gets += 1
+        return image.swapaxes(0,1)
+
+    def clear(self):
+        self._frames.clear()
+        self.nbytes = 0
+        self.raw_nbytes = 0
+
+    @property
+    def bytes_per_frame(self):
+        return self.nbytes / max(len(self._frames), 1)
+
+    @property
+    def ratio(self):
+        """Raw bytes / compressed bytes"""
+        return self.raw_nbytes / max(self.nbytes, 1)
+
+    @property
+    def encode_ms(self):
+        """Mean time to compress a frame, in ms"""
+        return self._encode_time * 1000 / max(self.n_puts, 1)
+
+    @property
+    def decode_ms(self):
+        """Mean time to decompress a frame, in ms"""
+        return self._decode_time * 1000 / max(self.n_gets, 1)
+
+    def decode_percentile(self, q:float):
+        """Percentile of recent decompression times, in ms"""
+        if not self._recent:
+            return 0.0
+        return float(np.percentile(self._recent, q)) * 1000
+
+    def summary(self):
+        return (f'{self.codec} {len(self)} frames, '
+                f'{self.bytes_per_frame/1024:.0f}KB/frame '
+                f'(x{self.ratio:.1f}), {self.nbytes/(1<<20):.0f}MB, '
+                f'{self.decode_ms:.1f}ms/access')
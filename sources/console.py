@@ -3,6 +3,11 @@ from tkinter import ttk
 from functools import partial
 from multiprocessing import Process, Queue
 from .common.constants import *
+from .common.queues import drain
+from .common import trace
+from . import session_log
+from .common.startup import StartupReport
+import time
 import os
 from tkinter import filedialog, messagebox
 from pathlib import Path
@@ -12,6 +17,9 @@ class Console(Process):
     Console
     All the commands called by buttons, etc. are in console_f.py
     """
+    # Minimum interval between SCRUB messages while dragging the timeline
+    scrub_interval_ms = 50
+
     def __init__(self, to_ConsoleQ:Queue, to_EngineQ:Queue, termQ:Queue):
         """
         Tk objects are not pickleable
@@ -22,6 +30,9 @@ class Console(Process):
         self._to_EngineQ = to_EngineQ
         self._termQ = termQ
         self._vid_name_list=[]
+        self._scrub_target = None
+        self._scrub_scheduled = False
+        self._dragging = False
 
         self._info_str = (
             '1 : prev frame\n'
@@ -34,6 +45,7 @@ class Console(Process):
             'W : pin water\n'
             'I : increase food pin\n'
             'L : decrease food pin\n'
+            'Z : zoom inset\n'
         )
 
     def initiate(self):
@@ -47,6 +59,8 @@ class Console(Process):
         self._vid_name_var = tk.StringVar(value='No video loaded')
         self._frame_idx_var = tk.StringVar(value='No video loaded')
         self._marker_idx_var = tk.StringVar(value='No video loaded')
+        self._cache_stat_var = tk.StringVar(value='')
+        self._jump_var = tk.StringVar(value='')
         self._info_var = tk.StringVar(value=self._info_str)
 
         # # Configure Top-left threshold setting menu ###########################
@@ -58,6 +72,18 @@ class Console(Process):
         self.label_marked_idx = ttk.Label(self.frame_frame,
                                          textvariable=self._marker_idx_var)
         self.label_marked_idx.grid(column=0, row=1, sticky=(tk.W))
+        self.label_cache_stat = ttk.Label(self.frame_frame,
+                                         textvariable=self._cache_stat_var)
+        self.label_cache_stat.grid(column=0, row=2, sticky=(tk.W))
+        self.frame_jump = ttk.Frame(self.frame_frame)
+        self.frame_jump.grid(column=0, row=3, sticky=(tk.W))
+        self.entry_jump = ttk.Entry(self.frame_jump, width=8,
+                                    textvariable=self._jump_var)
+        self.entry_jump.grid(column=0, row=0)
+        self.entry_jump.bind('<Return>', lambda e: self.button_jump_f())
+        self.button_jump = ttk.Button(self.frame_jump, text='Go',
+                                      command=self.button_jump_f)
+        self.button_jump.grid(column=1, row=0)
 
         # Configure Top-Right Prev/Next menu ##################################
         self.frame_prevnext = ttk.Frame(self.root, padding='5 5 5 5')
@@ -92,6 +118,20 @@ class Console(Process):
                                       command=self.button_save_f)
         self.button_save.grid(column=2, row=1, sticky=(tk.E, tk.S))
 
+        # Configure Bottom Timeline #########################################
+        self.frame_timeline = ttk.Frame(self.root, padding='5 5 5 5')
+        self.frame_timeline.grid(column=0, row=2, columnspan=3,
+                                 sticky=(tk.W, tk.E))
+        self.frame_timeline.columnconfigure(0, weight=1)
+        self.scale_timeline = ttk.Scale(self.frame_timeline,
+                                        orient=tk.HORIZONTAL, length=400,
+                                        from_=0, to=0,
+                                        command=self.scale_timeline_f)
+        self.scale_timeline.grid(column=0, row=0, sticky=(tk.W, tk.E))
+        self.scale_timeline.bind('<ButtonPress-1>', self.timeline_press_f)
+        self.scale_timeline.bind('<ButtonRelease-1>',
+                                 self.timeline_release_f)
+
         # Set weights of frames ###############################################
         self.root.columnconfigure(0, weight=1)
         self.root.columnconfigure(1, weight=1)
@@ -101,18 +141,33 @@ class Console(Process):
 
 
     def run(self):
+        startup = StartupReport('console')
+        startup.mark('imported')
+        if trace.ENABLED:
+            self._tracer = trace.Tracer('console')
+        if session_log.ENABLED:
+            self._to_EngineQ = session_log.RecordingQueue(
+                self._to_EngineQ, 'console')
         self.initiate()
+        self.root.update_idletasks()
+        startup.mark('window')
+        startup.report()
         self.button_open_f(ask=False)
         self.root.after(16, self.update)
         self.root.mainloop()
+        if trace.ENABLED:
+            self._tracer.write()
+        if session_log.ENABLED:
+            self._to_EngineQ.close()
         self._termQ.put(TERMINATE)
 
 
 
     def button_open_f(self, ask=True):
         if ask:
-            answer = messagebox.askyesno(message='This will reset everything.'\
-                                                '\n Continue?')
+            answer = messagebox.askyesno(message='Open another folder?'\
+                '\nLabels so far are kept in the journal, and restored'\
+                '\nwhen the same video is opened again.')
             if not answer: return
         dirname = filedialog.askdirectory()
         if dirname == '':
@@ -125,35 +180,103 @@ class Console(Process):
                 if f.endswith(VIDEO_FORMATS):
                     self._vid_name_list.append(f)
             if len(self._vid_name_list) > 0 :
-                self._to_EngineQ.put({
-                    NEWVID:os.path.join(self._vid_folder,
-                            self._vid_name_list[self._vid_idx])
-                })
-                self._vid_name_var.set(self._vid_name_list[self._vid_idx])
+                self.open_vid()
+
+    def open_vid(self):
+        """Lets Engine open the current video, offering to resume a save"""
+        # saves needs numpy, which Console does not load otherwise
+        from .saves import find_save
+        vid_name = os.path.join(self._vid_folder,
+                                self._vid_name_list[self._vid_idx])
+        save = find_save(Path(self._vid_folder) / 'save', vid_name)
+        if save is not None and messagebox.askyesno(
+                message=f'Resume from {save[0].name} '
+                        f'({save[1]} labeled frames)?\n'
+                        'No opens the video with the labels in its journal.'):
+            self._to_EngineQ.put({RESUME:(vid_name, str(save[0]))})
+        else:
+            self._to_EngineQ.put({NEWVID:vid_name})
+        self._vid_name_var.set(self._vid_name_list[self._vid_idx])
+        self.preload_next()
+
+    def confirm_resume(self, vid_name, save_name, journal_frames,
+                       save_frames):
+        """Asks before a resume that would drop newer journal edits"""
+        if messagebox.askyesno(default='no', icon='warning', message=
+                f'The journal of this video ({journal_frames} labeled '
+                f'frames) has edits newer than {Path(save_name).name} '
+                f'({save_frames} labeled frames).\n'
+                'Resume from the save anyway, dropping them?'):
+            self._to_EngineQ.put({RESUME:(vid_name, save_name, True)})
+
+    def preload_next(self):
+        """Lets Engine open the next video in the background"""
+        if len(self._vid_name_list) > 1:
+            next_idx = (self._vid_idx+1)%len(self._vid_name_list)
+            self._to_EngineQ.put({
+                PRELOAD:os.path.join(self._vid_folder,
+                        self._vid_name_list[next_idx])
+            })
 
     def button_next_f(self):
-        answer = messagebox.askyesno(message='All unsaved values will disappear.\
-            \nContinue?')
+        answer = messagebox.askyesno(message='Move to another video?\
+            \nLabels so far are kept in the journal.')
         if answer:
             if len(self._vid_name_list) > 0 :
                 self._vid_idx = (self._vid_idx+1)%len(self._vid_name_list)
-                self._to_EngineQ.put({
-                    NEWVID:os.path.join(self._vid_folder,
-                            self._vid_name_list[self._vid_idx])
-                })
-                self._vid_name_var.set(self._vid_name_list[self._vid_idx])
+                self.open_vid()
 
     def button_prev_f(self):
-        answer = messagebox.askyesno(message='All unsaved values will disappear.\
-            \nContinue?')
+        answer = messagebox.askyesno(message='Move to another video?\
+            \nLabels so far are kept in the journal.')
         if answer:
             if len(self._vid_name_list) > 0 :
                 self._vid_idx = (self._vid_idx-1)%len(self._vid_name_list)
-                self._to_EngineQ.put({
-                    NEWVID:os.path.join(self._vid_folder,
-                            self._vid_name_list[self._vid_idx])
-                })
-                self._vid_name_var.set(self._vid_name_list[self._vid_idx])
+                self.open_vid()
+
+    def button_jump_f(self):
+        try:
+            idx = int(self._jump_var.get())
+        except ValueError:
+            self.message_box('Frame number should be an integer')
+            return
+        self._to_EngineQ.put({JUMP:idx})
+
+    def scale_timeline_f(self, value):
+        """Called on every move of the timeline
+
+        Only the latest position is sent, at most once every
+        scrub_interval_ms, so dragging never floods Engine.
+        """
+        if not self._dragging:
+            # Moved by set_timeline, not by the user
+            return
+        self._scrub_target = int(float(value))
+        if not self._scrub_scheduled:
+            self._scrub_scheduled = True
+            self.root.after(self.scrub_interval_ms, self.send_scrub)
+
+    def send_scrub(self):
+        self._scrub_scheduled = False
+        if self._scrub_target is not None:
+            self._to_EngineQ.put({SCRUB:self._scrub_target})
+            self._scrub_target = None
+
+    def timeline_press_f(self, event):
+        self._dragging = True
+
+    def timeline_release_f(self, event):
+        self._dragging = False
+        # Last position does not wait for the interval
+        self._scrub_target = int(float(self.scale_timeline.get()))
+        self.send_scrub()
+
+    def set_timeline(self, frame_idx:int, frame_num:int):
+        """Shows Engine's position, unless the user is dragging"""
+        if self._dragging:
+            return
+        self.scale_timeline.configure(to=max(frame_num-1, 0))
+        self.scale_timeline.set(frame_idx)
 
     def button_save_f(self):
         self._to_EngineQ.put({SAVE:self._vid_folder})
@@ -163,13 +286,23 @@ class Console(Process):
         messagebox.showinfo(message=string)
 
     def update(self):
-        if not self._to_ConsoleQ.empty():
-            q = self._to_ConsoleQ.get()
+        # Handle every pending message, not just one per call
+        for q in drain(self._to_ConsoleQ):
+            if trace.ENABLED and TRACE in q:
+                stamps = q.pop(TRACE)
+                stamps.append(('console_recv', time.perf_counter()))
+                self._tracer.add(stamps)
             for k,v in q.items():
                 if k == FRAMEIDX:
                     self._frame_idx_var.set(v)
                 elif k == MARKERIDX:
                     self._marker_idx_var.set(v)
+                elif k == CACHE_STAT:
+                    self._cache_stat_var.set(v)
+                elif k == FRAMEPOS:
+                    self.set_timeline(*v)
                 elif k == MESSAGE_BOX:
                     self.message_box(v)
+                elif k == CONFIRM_RESUME:
+                    self.confirm_resume(*v)
         self.root.after(16, self.update)
\ No newline at end of file
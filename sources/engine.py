@@ -3,30 +3,116 @@ from multiprocessing import Process, Queue
 from .common.constants import *
 import os
 from pathlib import Path
-import cv2
-import copy
-import pickle
-
-# To limit loop rate
-from pygame.time import Clock
+import threading
+import time
+from .frame_source import FrameSource, Prefetcher, Preloader, \
+    proxy_level_for
+from .frame_cache import DiskFrameCache, DEFAULT_MAX_BYTES
+from .seek_index import SeekIndex
+from .common.frame_ring import FrameRing
+from .common.queues import wait_queues, drain
+from .common.events import coalesce
+from .common import trace
+from .common.startup import StartupReport
+from . import saves
+from .journal import Journal
+from .annotations import AnnotationStore
 
 class Engine(Process):
     """Main process that calculates all the necessary computations
 
     Data structure
-    [
-        {
-            'image' : np.array of the frame
-                Shape : (WIDTH, HEIGHT, 3) -> Pygame notation
-            'marker name' : pos,
-                Order : (WIDTH, HEIGHT) -> Pygame notation
-        },
-    ]
-    Data will be in order of the actual frame order
+        self._data is an AnnotationStore (see annotations.py), which keeps
+        markers of every labeled frame in arrays, in the actual frame order.
+        Marker positions are
+            Order : (WIDTH, HEIGHT) -> Pygame notation
+    Images are not kept in the data. They are decoded on demand from
+    self._frames, which is a FrameSource with a bounded cache.
+
+    With max_display_size, Viewer gets downscaled proxy frames. Markers are
+    always stored in full resolution, and mapped from / to the display
+    with _to_full / _to_display.
+
+    With a Tracker (see tracker.py), new frames get tracked positions of
+    TRACKED_MARKERS instead of copies of the previous frame. Interpolation
+    between keyframes only fills frames that have no tracked position.
     """
     # If the image is not updated, check if self._updated is switched to True
     def __init__(self, to_EngineQ:Queue, to_ConsoleQ:Queue,
-                 imageQ:Queue, eventQ:Queue, etcQ:Queue):
+                 imageQ:Queue, eventQ:Queue, etcQ:Queue,
+                 cache_frames:int=256, cache_bytes:int=None,
+                 prefetch_ahead:int=32, prefetch_behind:int=16,
+                 journal:bool=True, journal_compact_every:int=4096,
+                 disk_cache_dir:str=None,
+                 disk_cache_bytes:int=DEFAULT_MAX_BYTES,
+                 max_display_size:tuple=None, zoom_size:int=128,
+                 interpolation:str='linear',
+                 to_TrackerQ:Queue=None, from_TrackerQ:Queue=None,
+                 preload_frames:int=None, preload_bytes:int=1<<30,
+                 decode_workers:int=0, seek_index:bool=True,
+                 seek_spacing:int=64, wait_for_viewer:float=None,
+                 frame_store:str=None, frame_store_level:int=None,
+                 frame_store_bytes:int=None):
+        """
+        Arguments
+        ---------
+        cache_frames : int
+            Maximum number of decoded frames to keep in memory
+        cache_bytes : int
+            Maximum bytes of decoded frames to keep in memory
+        prefetch_ahead : int
+            Number of frames to decode in advance in the scrubbing direction
+        prefetch_behind : int
+            Number of frames to decode in advance in the other direction
+            Set both to 0 to disable the background decoder
+        journal : bool
+            If True, every edit is journaled to <vid_folder>/save/journal
+            and recovered when the same video is opened again
+        journal_compact_every : int
+            Number of journal records before compacting into a snapshot
+        disk_cache_dir : str
+            Folder of the persistent decoded-frame cache. None to disable
+        disk_cache_bytes : int
+            Maximum disk usage of the persistent cache
+        max_display_size : tuple
+            (WIDTH, HEIGHT). Larger videos are shown as proxies that are
+            halved until they fit. None to always show full resolution
+        zoom_size : int
+            Size of the full resolution crop shown as the zoom inset
+        interpolation : str
+            'linear' or 'spline'. When a single marker is pinned, frames
+            between it and its neighboring keyframes are interpolated.
+            None to only copy markers forward. Frames with a tracker
+            proposal keep it.
+        to_TrackerQ, from_TrackerQ : Queue
+            Queues of a Tracker process. None to disable tracking
+        preload_frames : int
+            Number of frames of a PRELOAD video to decode in advance.
+            Defaults to cache_frames
+        preload_bytes : int
+            Preloading is cancelled before decoded frames exceed this
+        decode_workers : int
+            If > 0 and there is a disk cache, load_vid decodes the whole
+            video into the cache in the background, with this many
+            threads (see parallel_decode.py). 0 to decode lazily
+        seek_index : bool
+            If True, a SeekIndex of each video is loaded, or built in the
+            background and saved next to the video
+        seek_spacing : int
+            Maximum frames to decode after a seek, for a new SeekIndex
+        wait_for_viewer : float
+            Seconds to hold back Console's commands (e.g. NEWVID) after
+            start, until Viewer sends VIEWER_READY, so that decoding does
+            not compete with opening its window. None to not wait
+        frame_store : str
+            Codec to keep every decoded frame compressed in memory, one of
+            CODECS in compressed_store.py. cache_frames then only needs to
+            be a small hot set (e.g. 64). None to disable
+        frame_store_level : int
+            Compression level of frame_store, or jpeg quality
+        frame_store_bytes : int
+            Maximum bytes of compressed frames. None for no limit
+        """
         super().__init__(daemon=True)
         # Initial dummy frame
         self._frames = [np.zeros((300,300,3),dtype=np.uint8)]
@@ -38,10 +124,64 @@ class Engine(Process):
         self._etcQ = etcQ
 
         self._updated = False
+        self._mainloop = True
+        self._prefetch_ahead = prefetch_ahead
+        self._prefetch_behind = prefetch_behind
+        self._prefetcher = None
+        # Frames are sent to Viewer through shared memory
+        self._ring = None
+        self._ring_slot = None
+        # Counts frames written to the ring, so that Viewer can tell a new
+        # frame from the same slot reused n_slots frames later
+        self._frame_seq = 0
+        self._use_journal = journal
+        self._journal_compact_every = journal_compact_every
+        self._journal = None
+        self._max_display_size = max_display_size
+        self._proxy_level = 0
+        self._zoom_size = zoom_size
+        # Center of the zoom inset in full resolution, None if hidden
+        self._zoom_pos = None
+        self._interpolation = interpolation
+        self._to_TrackerQ = to_TrackerQ
+        self._from_TrackerQ = from_TrackerQ
+        self._track_generation = 0
+        self._tracker_paused = False
+        # Frame -> {marker name : pos} from the tracker
+        self._proposals = {}
+        self._preloader = None
+        self._preload_frames = preload_frames if preload_frames is not None \
+            else (cache_frames or 256)
+        self._preload_bytes = preload_bytes
+        self._decode_workers = decode_workers
+        self._use_seek_index = seek_index
+        self._seek_spacing = seek_spacing
+        self._index_cancel = None
+        self._decode_cancel = None
+        self._decode_thread = None
+        # Latest SCRUB target that is not shown yet
+        self._scrub_target = None
+        # Stamps of the oldest traced event not answered yet
+        self._trace_stamps = None
+        self._wait_for_viewer = wait_for_viewer
+        # While not None, commands are held until this time.monotonic()
+        self._viewer_deadline = None
+        self._held_commands = []
+        self._startup = None
+        # Passed to every FrameSource, including preloaded ones
+        self._source_kwargs = dict(
+            cache_frames=cache_frames,
+            cache_bytes=cache_bytes,
+            compress=frame_store,
+            compress_level=frame_store_level,
+            compress_bytes=frame_store_bytes,
+        )
+        self._disk_cache = None
+        if disk_cache_dir is not None:
+            self._disk_cache = DiskFrameCache(disk_cache_dir,
+                                              disk_cache_bytes)
 
-        self._data = []
         self._dummy_datum = {
-            'image' : np.zeros((300,300,3),dtype=np.uint8),
             'nose' : (0,0),
             'head' : (0,0),
             'tail' : (0,0),
@@ -53,6 +193,7 @@ class Engine(Process):
             # 'ear' : 0,
             'food' : 0,
         }
+        self._data = AnnotationStore(self._dummy_datum)
 
     @property
     def frame_num(self):
@@ -72,8 +213,9 @@ class Engine(Process):
         """
         if len(image.shape) != 3 and image.shape[2] != 3:
             raise TypeError('Inappropriate shape of image')
-        self._image = image.astype(np.uint8)
+        self._image = np.asarray(image, dtype=np.uint8)
         self._shape = self._image.shape
+        self._ring_slot = None
         self._updated = True
 
     @property
@@ -92,30 +234,89 @@ class Engine(Process):
     @frame_idx.setter
     def frame_idx(self, idx:int):
         """Sets current image to the idx"""
-        self._frame_idx = idx
-        self.image=self._frames[idx]
+        if self._prefetcher is not None:
+            self._prefetcher.update(idx)
+        self.image=self._frames.proxy(idx)
+        # Decoding may find out that the video is shorter than reported
+        self._frame_idx = min(idx, self.frame_num-1)
         self._to_ConsoleQ.put(
             {FRAMEIDX:f'{self._frame_idx}/{self.frame_num-1}'}
         )
+        msg = {FRAMEPOS:(self._frame_idx, self.frame_num)}
+        if trace.ENABLED:
+            trace.stamp(msg, 'engine_put')
+        self._to_ConsoleQ.put(msg)
         self.reset_multi_marker_idx()
 
     def next_frame(self):
-        last_idx = self.frame_idx
         self.frame_idx = min(self.frame_idx+1,self.frame_num-1)
-        if self.frame_idx+1 > len(self._data):
-            new_datum = copy.deepcopy(self._data[last_idx])
-            new_datum['image'] = self.image
-            self._data.append(new_datum)
+        self.extend_to(self.frame_idx)
+        self.resume_tracker()
 
     def prev_frame(self):
         self.frame_idx = max(self.frame_idx-1,0)
+        self.pause_tracker()
 
-    def load_vid(self, vid_name):
+    def extend_to(self, idx:int):
+        """Labels frames up to idx, as copies of the labeling front
+
+        Tracker proposals are applied to the new frames.
+        """
+        if idx+1 <= len(self._data):
+            return
+        last_idx = len(self._data)-1
+        if idx == last_idx+1:
+            self._data.append(last_idx)
+            if self._journal is not None:
+                self._journal.new_frame(idx, last_idx)
+        else:
+            self._data.extend(idx+1, last_idx)
+            if self._journal is not None:
+                self._journal.extend(idx+1, last_idx)
+        for frame in range(last_idx+1, idx+1):
+            self.apply_proposal(frame)
+
+    @property
+    def ahead(self):
+        """True if the current frame is past the labeling front"""
+        return self.frame_idx >= len(self._data)
+
+    def seek_by(self, n:int, extend:bool=True):
+        """Moves n frames at once (negative for backward)
+
+        Same as calling next_frame / prev_frame n times, but frames in
+        between are never decoded. New frames on the way get the markers
+        of the last labeled frame, as next_frame would do.
+        With extend False, frames past the labeling front are only viewed,
+        and labeled once they are edited or left with next_frame.
+        """
+        target = min(max(self.frame_idx+n, 0), self.frame_num-1)
+        if target == self.frame_idx:
+            return
+        self.frame_idx = target
+        if extend:
+            self.extend_to(self.frame_idx)
+        if n > 0:
+            self.resume_tracker()
+        else:
+            self.pause_tracker()
+
+    def load_vid(self, vid_name, save_name=None, force=False):
         """Load a video and returns total frame number
+
+        Markers are restored right away, from save_name if given, or else
+        from the journal. Images are still decoded lazily, so resuming a
+        long session does not read the video.
+
         Parameter
         ---------
         vid_name : str
             String of the video's path
+        save_name : str
+            Save file (see saves.py) to resume from. It replaces whatever
+            the journal has, unless the journal is newer (see resume)
+        force : bool
+            Resume even if that drops newer journal edits
 
         Return
         ------
@@ -124,34 +325,305 @@ class Engine(Process):
         """
         print('loading...')
         self._vid_name = vid_name
-        cap = cv2.VideoCapture(vid_name)
-        self._frames = []
-        n = 0
-        while(cap.isOpened()):
-            ret, frame = cap.read()
-            if ret:
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                self._frames.append(frame.swapaxes(0,1))
-                if n % 500 == 0:
-                    self._to_ConsoleQ.put(
-                        {FRAMEIDX:f'loading : {n}frames loaded'}
-                    )
-                n += 1
-            else :
-                break
-        cap.release()
+        self._scrub_target = None
+        self.stop_cache_decode()
+        self.stop_prefetcher()
+        if isinstance(self._frames, FrameSource):
+            self._frames.release()
+        source = None
+        if self._preloader is not None:
+            if self._preloader.vid_name == vid_name:
+                source = self._preloader.take()
+            else:
+                self._preloader.discard()
+            self._preloader = None
+        if source is None:
+            decode_all = self._decode_workers > 0 and \
+                self._disk_cache is not None
+            # Frames are decoded lazily, so this returns almost immediately
+            source = FrameSource(
+                vid_name, disk_cache=None if decode_all else self._disk_cache,
+                **self._source_kwargs)
+            if decode_all:
+                self.decode_into_cache(source, vid_name)
+        self._frames = source
+        self.attach_seek_index(source, vid_name)
+        # Proxies are built by the decoder, so set the level before prefetch
+        self._proxy_level = proxy_level_for(self._frames.shape,
+                                            self._max_display_size)
+        self._frames.proxy_level = self._proxy_level
+        self._zoom_pos = None
+        if self._prefetch_ahead > 0 or self._prefetch_behind > 0:
+            self._prefetcher = Prefetcher(self._frames,
+                                          ahead=self._prefetch_ahead,
+                                          behind=self._prefetch_behind)
+            self._prefetcher.start()
 
         # Reset data
-        self.frame_idx = 0
-        self._data = []
-        new_data = copy.deepcopy(self._dummy_datum)
-        new_data['image'] = self.image
-        self._data.append(new_data)
+        self.close_journal()
+        self._data = AnnotationStore(self._dummy_datum,
+                                     capacity=self.frame_num)
+        if self._use_journal:
+            journal_folder = Path(vid_name).parent / 'save' / 'journal'
+            self._journal = Journal(journal_folder, vid_name,
+                                    self._journal_compact_every)
+            self._journal.recover(self._data)
+        if save_name is not None:
+            self.resume(save_name, force)
+        elif len(self._data) > 0:
+            self._to_ConsoleQ.put({MESSAGE_BOX:
+                f'Recovered {len(self._data)} frames from journal'})
+        if len(self._data) == 0:
+            self._data.append()
+            if self._journal is not None:
+                self._journal.new_frame(0, -1)
+        # Markers may go past the end if the container reported more frames
+        self.frame_idx = min(len(self._data), self.frame_num) - 1
+        if self._to_TrackerQ is not None:
+            self._to_TrackerQ.put({TRACK_VIDEO:vid_name})
+            self.seed_tracker()
 
         print(f'{self.frame_num}frames loaded')
         print(f'shape : {self.shape}')
+        if self._startup is not None and not self._startup.done:
+            self._startup.mark('first_video')
+            self._startup.report()
         return self.frame_num
 
+    def resume(self, save_name, force=False):
+        """Replaces the markers with those of a save of the current video
+
+        If the recovered journal differs from the save, and has more frames
+        or was modified after the save, resuming would drop newer edits.
+        Then the journal is kept, and Console is asked to confirm
+        (CONFIRM_RESUME) unless force is True.
+        """
+        arrays = saves.load_annotations(save_name)
+        if arrays['fingerprint'] and \
+                arrays['fingerprint'] != saves.video_fingerprint(
+                    self._vid_name):
+            self._to_ConsoleQ.put({MESSAGE_BOX:
+                f'{Path(save_name).name} is not a save of this video'})
+            return
+        if not force and self._journal_is_newer(save_name, arrays):
+            self._to_ConsoleQ.put({CONFIRM_RESUME:(
+                self._vid_name, str(save_name), len(self._data),
+                saves.frame_count(arrays))})
+            return
+        self._data = AnnotationStore(
+            self._dummy_datum,
+            capacity=max(self.frame_num, saves.frame_count(arrays)))
+        self._data.load_arrays(arrays)
+        if self._journal is not None:
+            # The journal continues from the save from now on
+            self._journal.compact(self._data)
+        self._to_ConsoleQ.put({MESSAGE_BOX:
+            f'Resumed {len(self._data)} frames from {Path(save_name).name}'})
+
+    def _journal_is_newer(self, save_name, arrays:dict):
+        """True if the recovered markers have edits that the save lacks"""
+        if self._journal is None or len(self._data) == 0:
+            return False
+        current = self._data.to_arrays()
+        if all(name in arrays and np.array_equal(value, arrays[name])
+               for name, value in current.items()):
+            return False
+        return len(self._data) > saves.frame_count(arrays) or \
+            self._journal.modified() > os.path.getmtime(save_name)
+
+    def attach_seek_index(self, source:FrameSource, vid_name:str):
+        """Gives source its SeekIndex, building it in a thread if needed
+
+        If the index is degraded (seeks are never exact), the same thread
+        then decodes the whole video into the frame cache once, so that
+        jumps do not decode from frame 0 every time.
+        """
+        if self._index_cancel is not None:
+            self._index_cancel.set()
+            self._index_cancel = None
+        if not self._use_seek_index:
+            return
+        index = source.seek_index
+        if index is None:
+            index = SeekIndex.load(vid_name)
+        if index is not None:
+            source.set_seek_index(index)
+            if not index.degraded:
+                return
+        cancel = threading.Event()
+        def build():
+            seek_index = index
+            if seek_index is None:
+                seek_index = SeekIndex.load_or_build(vid_name,
+                                                     self._seek_spacing,
+                                                     cancel)
+                if seek_index is None or cancel.is_set():
+                    return
+                source.set_seek_index(seek_index)
+            print(f'seek index of {vid_name} : {seek_index.summary()}')
+            if seek_index.degraded:
+                n = source.fill(cancel)
+                if n > 0:
+                    print(f'decoded {n} frames of {vid_name} into the cache')
+                elif not cancel.is_set():
+                    print(f'no unbounded frame cache for {vid_name}; '
+                          'jumps decode from frame 0')
+        threading.Thread(target=build, daemon=True).start()
+        self._index_cancel = cancel
+
+    def decode_into_cache(self, source:FrameSource, vid_name:str):
+        """Decodes the whole video into the disk cache in a thread
+
+        source decodes frames by itself meanwhile, and uses the cache once
+        the decode is done, so that it never reads unverified frames.
+        Progress is shown in Console.
+        """
+        from .parallel_decode import decode_to_cache
+        cancel = threading.Event()
+        def progress(done, total):
+            self._to_ConsoleQ.put({CACHE_STAT:
+                f'Decoding into cache : {done*100//max(total, 1)}%'})
+        def decode():
+            try:
+                # Engine is a daemon, so threads instead of processes
+                n = decode_to_cache(self._disk_cache, vid_name,
+                                    self._decode_workers, use_threads=True,
+                                    cancel=cancel, progress=progress)
+            except (IOError, RuntimeError) as e:
+                print(f'cannot decode {vid_name} into the cache : {e}')
+                return
+            if cancel.is_set():
+                return
+            source.attach_disk_cache(self._disk_cache)
+            self._to_ConsoleQ.put({CACHE_STAT:
+                f'Decoded {n} frames into cache'})
+        self._decode_thread = threading.Thread(target=decode, daemon=True)
+        self._decode_thread.start()
+        self._decode_cancel = cancel
+
+    def stop_cache_decode(self):
+        """Cancels decode_into_cache, and waits for its workers"""
+        if self._decode_cancel is not None:
+            self._decode_cancel.set()
+            self._decode_thread.join()
+            self._decode_cancel = None
+            self._decode_thread = None
+
+    def jump(self, idx:int):
+        """Moves to frame idx without labeling frames on the way"""
+        self.seek_by(idx - self.frame_idx, extend=False)
+
+    def scrub(self, idx:int):
+        """Moves to frame idx without blocking on its decode
+
+        The prefetcher decodes idx first, and step() jumps there once it
+        is ready. A newer target bumps the prefetcher's generation, so
+        decoding for a stale target stops after the current frame.
+        """
+        idx = min(max(idx, 0), self.frame_num-1)
+        if self._prefetcher is None:
+            self.jump(idx)
+            return
+        self._scrub_target = idx
+        self._prefetcher.update(idx)
+
+    def finish_scrub(self):
+        """Jumps to the scrub target, if it is decoded already"""
+        target = self._scrub_target
+        if target is not None and self._frames.cached(target):
+            self._scrub_target = None
+            self.jump(target)
+
+    def preload(self, vid_name):
+        """Starts opening a video in the background for a later load_vid"""
+        if self._preloader is not None:
+            if self._preloader.vid_name == vid_name:
+                return
+            self._preloader.discard()
+        self._preloader = Preloader(vid_name,
+                                    max_frames=self._preload_frames,
+                                    max_bytes=self._preload_bytes,
+                                    max_display_size=self._max_display_size,
+                                    disk_cache=self._disk_cache,
+                                    **self._source_kwargs)
+        self._preloader.start()
+
+    def stop_preloader(self):
+        if self._preloader is not None:
+            self._preloader.discard()
+            self._preloader = None
+
+    def close_journal(self):
+        """Compacts and closes the journal, if there is any"""
+        if self._journal is not None:
+            self._journal.close(self._data)
+            self._journal = None
+
+    def stop_prefetcher(self):
+        """Stops the background decoder, if there is any"""
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+            self._prefetcher.join()
+            self._prefetcher = None
+
+    def seed_tracker(self):
+        """Restarts tracking from markers of the labeling front
+
+        Proposals made from older markers are dropped.
+        """
+        if self._to_TrackerQ is None:
+            return
+        self._track_generation += 1
+        self._proposals.clear()
+        front = len(self._data) - 1
+        markers = {name : self._data.get(front, name)
+                   for name in TRACKED_MARKERS}
+        self._to_TrackerQ.put(
+            {TRACK_FROM:(self._track_generation, front, markers)})
+        self._tracker_paused = True
+        self.resume_tracker()
+
+    def pause_tracker(self):
+        """Lets decoding for scrubbing have the CPU"""
+        if self._to_TrackerQ is not None and not self._tracker_paused:
+            self._to_TrackerQ.put({TRACK_PAUSE:None})
+            self._tracker_paused = True
+
+    def resume_tracker(self):
+        """Tells the tracker where the labeling front is now"""
+        if self._to_TrackerQ is not None:
+            self._to_TrackerQ.put({TRACK_RESUME:len(self._data)-1})
+            self._tracker_paused = False
+
+    def handle_proposal(self, q:dict):
+        """Handles a message from Tracker"""
+        for k, v in q.items():
+            if k == TRACK_PROPOSAL:
+                generation, frame, markers = v
+                if generation != self._track_generation:
+                    continue
+                self._proposals[frame] = markers
+                # Frame was already created before its proposal arrived
+                if frame < len(self._data):
+                    self.apply_proposal(frame)
+
+    def apply_proposal(self, frame:int):
+        """Moves markers of frame to the tracked positions, if any
+
+        Markers pinned by hand are never moved.
+        """
+        markers = self._proposals.pop(frame, None)
+        if markers is None:
+            return
+        for name, pos in markers.items():
+            if self._data.is_keyframe(frame, name):
+                continue
+            self._data.propose(frame, name, pos)
+            if self._journal is not None:
+                self._journal.propose_marker(frame, name, pos)
+        if frame == self.frame_idx:
+            self._updated = True
+
     def reset_multi_marker_idx(self):
         """Resets all multiple_markers' indices to 0"""
         for k in self._multiple_marker_idx.keys():
@@ -175,123 +647,308 @@ class Engine(Process):
         pos : tuple
             Position of the marker
         """
-        datum = self._data[self.frame_idx]
-        single_markers = [
-            'nose',
-            'tail',
-            'water',
-            'head' ,
-            'block',
-        ]
-        multiple_markers = [
-            # 'ear',
-            'food',
-        ]
-        if marker_type in single_markers:
-            datum[marker_type] = pos
-        elif marker_type in multiple_markers:
-            idx = self._multiple_marker_idx[marker_type] % len(datum[marker_type])
+        self.extend_to(self.frame_idx)
+        if marker_type in SINGLE_MARKERS:
+            self._data.set(self.frame_idx, marker_type, pos)
+            if self._journal is not None:
+                self._journal.set_marker(self.frame_idx, marker_type, pos)
+            tracked = self._to_TrackerQ is not None \
+                and marker_type in TRACKED_MARKERS
+            # Fills frames between keyframes that have no tracked position
+            if self._interpolation is not None:
+                self._data.interpolate(marker_type, self.frame_idx,
+                                       self._interpolation)
+                if self._journal is not None:
+                    self._journal.interpolate(self.frame_idx, marker_type,
+                                              self._interpolation)
+            # Correcting the front makes the tracker start over from it
+            if tracked and self.frame_idx == len(self._data) - 1:
+                self.seed_tracker()
+        elif marker_type in MULTIPLE_MARKERS:
+            count = self._data.count(self.frame_idx, marker_type)
+            if count == 0:
+                return
+            idx = self._multiple_marker_idx[marker_type] % count
             self._multiple_marker_idx[marker_type] = idx
-            datum[marker_type][idx] = pos
+            self._data.set_multi(self.frame_idx, marker_type, idx, pos)
             self._multiple_marker_idx[marker_type] += 1
+            if self._journal is not None:
+                self._journal.set_multi_marker(self.frame_idx, marker_type,
+                                               idx, pos)
+
+        self._updated = True
+
+    def _to_full(self, pos):
+        """Display position -> full resolution position"""
+        return (pos[0] << self._proxy_level, pos[1] << self._proxy_level)
+
+    def _to_display(self, pos):
+        """Full resolution position -> display position"""
+        return (pos[0] >> self._proxy_level, pos[1] >> self._proxy_level)
 
+    def toggle_zoom(self, pos):
+        """Shows the zoom inset around pos (display), or hides it"""
+        if self._zoom_pos is None:
+            self._zoom_pos = self._to_full(pos)
+        else:
+            self._zoom_pos = None
         self._updated = True
 
+    def move_zoom(self, pos):
+        """Moves the zoom inset to pos (display), if it is shown"""
+        if self._zoom_pos is not None:
+            self._zoom_pos = self._to_full(pos)
+            self._updated = True
+
+    def zoom_image(self):
+        """Full resolution crop around the zoom position
+
+        Return
+        ------
+        crop : np.array
+            (zoom_size, zoom_size, 3), black outside the frame.
+            None if the inset is hidden.
+        """
+        if self._zoom_pos is None:
+            return None
+        full = self._frames[self.frame_idx]
+        size = self._zoom_size
+        crop = np.zeros((size, size, 3), dtype=np.uint8)
+        # Pad outside the frame, so that the zoom position stays centered
+        x0, y0 = self._zoom_pos[0]-size//2, self._zoom_pos[1]-size//2
+        sx, sy = max(x0, 0), max(y0, 0)
+        ex = min(x0+size, full.shape[0])
+        ey = min(y0+size, full.shape[1])
+        if sx < ex and sy < ey:
+            crop[sx-x0:ex-x0, sy-y0:ey-y0] = full[sx:ex, sy:ey]
+        return crop
+
     def add_food_marker(self, pos):
-        self._data[self.frame_idx]['food'].append(pos)
+        self.extend_to(self.frame_idx)
+        self._data.add(self.frame_idx, 'food', pos)
+        if self._journal is not None:
+            self._journal.add_marker(self.frame_idx, 'food', pos)
         self._updated = True
 
     def pop_food_marker(self):
-        if len(self._data[self.frame_idx]['food']) >0:
-            self._data[self.frame_idx]['food'].pop()
+        self.extend_to(self.frame_idx)
+        if self._data.pop(self.frame_idx, 'food'):
+            if self._journal is not None:
+                self._journal.pop_marker(self.frame_idx, 'food')
             self._updated = True
 
     def put_datum(self):
-        self._imageQ.put(self._data[self.frame_idx])
+        """Sends current markers to Viewer
+
+        The image itself is written to the shared FrameRing, and only
+        the slot is sent. If only markers changed, the same slot is reused.
+        'slot' is (ring info, slot, frame sequence number); the sequence
+        number changes exactly when a new frame is written.
+        """
+        if self._ring is None or self._ring.frame_shape != self.shape:
+            self.close_ring()
+            self._ring = FrameRing(self.shape)
+        if self._ring_slot is None:
+            self._ring_slot = self._ring.write(self._image)
+            self._frame_seq += 1
+        # Past the labeling front, markers of the front are shown, all as
+        # not pinned, until the frame is labeled
+        shown = min(self.frame_idx, len(self._data)-1)
+        datum = self._data.datum(shown)
+        if self._proxy_level > 0:
+            for name, pos in datum.items():
+                if name in MULTIPLE_MARKERS:
+                    datum[name] = [self._to_display(p) for p in pos]
+                else:
+                    datum[name] = self._to_display(pos)
+        if self.ahead:
+            datum['interpolated'] = list(SINGLE_MARKERS)
+        else:
+            datum['interpolated'] = self._data.interpolated_markers(shown)
+        datum['slot'] = (self._ring.info, self._ring_slot, self._frame_seq)
+        datum['zoom'] = self.zoom_image()
+        if trace.ENABLED and self._trace_stamps is not None:
+            # Pickling is in the next stage, engine_put -> viewer_recv
+            datum[TRACE] = self._trace_stamps
+            trace.stamp(datum, 'engine_put')
+            self._trace_stamps = None
+        self._imageQ.put(datum)
+
+    def close_ring(self):
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
+            self._ring_slot = None
 
     def save_data(self, vid_folder):
-        """Saves to <vid_folder> / save / <n>.pck
-        As every data has its image, there is no need to specify video name.
+        """Saves to <vid_folder> / save / <n>.npz
+        Only markers are saved, with the video's path and fingerprint.
+        See sources/saves.py for the format.
         """
         vid_folder = Path(vid_folder)
         save_folder = vid_folder / 'save'
         if not save_folder.exists():
             save_folder.mkdir()
-        
-        start_num = len(os.listdir(str(save_folder)))
-        data_name = str(start_num) + '.pck'
 
-        filename_data = save_folder/data_name
-        
-        with open(str(filename_data), 'wb') as f:
-            pickle.dump(self._data, f)
-        
+        filename_data = saves.next_save_name(save_folder)
+        saves.save_annotations(filename_data, self._data.to_arrays(),
+                               self._vid_name)
+
         self._to_ConsoleQ.put({MESSAGE_BOX:'saved'})
 
+    def handle_command(self, q:dict):
+        """Handles a message from Console"""
+        for k, v in q.items():
+            if k == TERMINATE:
+                self._mainloop = False
+
+            elif k == NEWVID:
+                self.load_vid(v)
+
+            elif k == RESUME:
+                self.load_vid(*v)
+
+            elif k == SAVE:
+                self.save_data(v)
+
+            elif k == PRELOAD:
+                self.preload(v)
+
+            elif k == JUMP:
+                self._scrub_target = None
+                self.jump(v)
+
+            elif k == SCRUB:
+                self.scrub(v)
+
+    def release_commands(self):
+        """Stops waiting for Viewer, and handles the held commands"""
+        self._viewer_deadline = None
+        held, self._held_commands = self._held_commands, []
+        for q in held:
+            self.handle_command(q)
+
+    def handle_event(self, q:dict):
+        """Handles a message from Viewer"""
+        for k,v in q.items():
+            if k in (K_F, K_E, K_R, K_D, K_W, K_Q, K_I):
+                # Viewer shows the proxy; markers are kept in full resolution
+                v = self._to_full(v)
+            if k == MOUSEDOWN:
+                pass
+            elif k == MOUSEDOWN_RIGHT:
+                pass
+            elif k == MOUSEUP:
+                pass
+            elif k == MOUSEPOS:
+                self.move_zoom(v)
+            elif k == VIEWER_READY:
+                self.release_commands()
+            # Keyboard events
+            elif k == K_Z:
+                self.toggle_zoom(v)
+            elif k == K_ENTER:
+                pass
+
+            # Markers
+            elif k == K_F:
+                self.update_marker_pos('food',v)
+            elif k == K_E:
+                # self.update_marker_pos('ear',v)
+                self.update_marker_pos('head',v)
+            elif k == K_R:
+                self.update_marker_pos('nose',v)
+            elif k == K_D:
+                self.update_marker_pos('tail',v)
+            elif k == K_W:
+                self.update_marker_pos('water',v)
+            elif k == K_Q:
+                self.update_marker_pos('block',v)
+
+            elif k == K_I:
+                self.add_food_marker(v)
+            elif k == K_L:
+                self.pop_food_marker()
+
+            # Prev / Next frame. Keys win over a pending scrub
+            elif k in (K_1, K_2, SEEK_BY) and self._scrub_target is not None:
+                self._scrub_target = None
+                self.handle_event({k:v})
+            elif k == K_1:
+                self.prev_frame()
+            elif k == K_2:
+                self.next_frame()
+            elif k == SEEK_BY:
+                self.seek_by(v)
+
+    def step(self, timeout:float=None):
+        """One iteration of the main loop
+
+        Sleeps until a message arrives (or timeout), handles every pending
+        message, and then sends at most one update to Viewer and Console.
+        """
+        queues = [self._to_EngineQ, self._eventQ]
+        if self._from_TrackerQ is not None:
+            queues.append(self._from_TrackerQ)
+        wait_queues(queues, timeout)
+        for q in drain(self._to_EngineQ):
+            if self._viewer_deadline is not None and TERMINATE not in q:
+                self._held_commands.append(q)
+                continue
+            self.handle_command(q)
+            if not self._mainloop:
+                return
+        # Proposals first, so that a new frame can use them
+        if self._from_TrackerQ is not None:
+            for q in drain(self._from_TrackerQ):
+                self.handle_proposal(q)
+        events = list(drain(self._eventQ))
+        if trace.ENABLED and events:
+            stamps = trace.pop_stamps(events)
+            if stamps and self._trace_stamps is None:
+                stamps.append(('engine_recv', time.perf_counter()))
+                self._trace_stamps = stamps
+        # Bursts (e.g. a held key) collapse into a few events
+        for q in coalesce(events):
+            self.handle_event(q)
+        if self._viewer_deadline is not None and \
+                time.monotonic() > self._viewer_deadline:
+            print('Viewer is not ready, opening videos anyway')
+            self.release_commands()
+        self.finish_scrub()
+
+        if self._journal is not None and self._journal.needs_compaction:
+            self._journal.compact(self._data)
+
+        if self._updated:
+            self.put_datum()
+            marked = f'Marked until {len(self._data)-1} (idx)'
+            if self.ahead:
+                marked += ', viewing unlabeled frame'
+            self._to_ConsoleQ.put({MARKERIDX:marked})
+            if isinstance(self._frames, FrameSource):
+                stat = f'Cache hit rate : {self._frames.hit_rate*100:.1f}%'
+                if self._frames.store is not None:
+                    stat += f'\nStore : {self._frames.store.summary()}'
+                self._to_ConsoleQ.put({CACHE_STAT:stat})
+            self._updated = False
+
     def run(self):
-        mainloop = True
-        self._clock = Clock()
-        while mainloop:
-            self._clock.tick(60)
-            if not self._to_EngineQ.empty():
-                q = self._to_EngineQ.get()
-                for k, v in q.items():
-                    if k == TERMINATE:
-                        mainloop = False
-
-                    elif k == NEWVID:
-                        self.load_vid(v)
-
-                    elif k == SAVE:
-                        self.save_data(v)
-
-            if not self._eventQ.empty():
-                q = self._eventQ.get()
-                for k,v in q.items():
-                    if k == MOUSEDOWN:
-                        pass
-                    elif k == MOUSEDOWN_RIGHT:
-                        pass
-                    elif k == MOUSEUP:
-                        pass
-                    elif k == MOUSEPOS:
-                        pass
-                    # Keyboard events
-                    elif k == K_Z:
-                        pass
-                    elif k == K_ENTER:
-                        pass
-
-                    # Markers
-                    elif k == K_F:
-                        self.update_marker_pos('food',v)
-                    elif k == K_E:
-                        # self.update_marker_pos('ear',v)
-                        self.update_marker_pos('head',v)
-                    elif k == K_R:
-                        self.update_marker_pos('nose',v)
-                    elif k == K_D:
-                        self.update_marker_pos('tail',v)
-                    elif k == K_W:
-                        self.update_marker_pos('water',v)
-                    elif k == K_Q:
-                        self.update_marker_pos('block',v)
-
-                    elif k == K_I:
-                        self.add_food_marker(v)
-                    elif k == K_L:
-                        self.pop_food_marker()
-
-                    # Prev / Next frame
-                    elif k == K_1:
-                        self.prev_frame()
-                    elif k == K_2:
-                        self.next_frame()
-
-
-            if self._updated:
-                self.put_datum()
-                self._to_ConsoleQ.put(
-                    {MARKERIDX:f'Marked until {len(self._data)-1} (idx)'}
-                )
-                self._updated = False
\ No newline at end of file
+        self._startup = StartupReport('engine')
+        self._startup.mark('imported')
+        if self._wait_for_viewer is not None:
+            self._viewer_deadline = time.monotonic() + self._wait_for_viewer
+        self._mainloop = True
+        while self._mainloop:
+            # Timeout only to notice a dead parent, or to check a pending
+            # scrub; no polling otherwise
+            self.step(timeout=1.0 if self._scrub_target is None else 0.005)
+        if self._to_TrackerQ is not None:
+            self._to_TrackerQ.put({TERMINATE:None})
+        self.close_journal()
+        self.stop_preloader()
+        self.stop_cache_decode()
+        self.stop_prefetcher()
+        if self._index_cancel is not None:
+            self._index_cancel.set()
+        self.close_ring()
@@ -0,0 +1,252 @@
+"""Persistent cache of decoded frames on disk
+
+Decoded RGB frames of each video are kept in a raw file that is opened as
+np.memmap, so re-opening a video serves frames straight from the page cache.
+Each video has three files under the cache folder
+    <key>.frames : raw uint8 array, (frame_num, WIDTH, HEIGHT, 3)
+    <key>.filled : raw uint8 array, (frame_num,), 1 if the frame is written
+    <key>.json : meta info, also used for LRU eviction across videos
+The key depends on the video's path, size and mtime, so a modified video
+is never served from a stale cache.
+
+Pre-warm a whole folder with
+    python -m sources.frame_cache warm <folder> [--cache-dir DIR]
+"""
+import numpy as np
+import os
+import json
+import time
+import hashlib
+import argparse
+from pathlib import Path
+from .common.constants import VIDEO_FORMATS
+
+DEFAULT_CACHE_DIR = Path.home() / '.cache' / 'mouse_chaser' / 'frames'
+DEFAULT_MAX_BYTES = 64 << 30
+
+class CacheEntry():
+    """Decoded frames of a single video"""
+    def __init__(self, cache, key:str, meta:dict, mode:str):
+        self._cache = cache
+        self.key = key
+        self.meta = meta
+        shape = (meta['frame_num'],) + tuple(meta['frame_shape'])
+        self.frames = np.memmap(cache.path(key, '.frames'), dtype=np.uint8,
+                                mode=mode, shape=shape)
+        self.filled = np.memmap(cache.path(key, '.filled'), dtype=np.uint8,
+                                mode=mode, shape=(meta['frame_num'],))
+
+    def __len__(self):
+        return len(self.filled)
+
+    @property
+    def complete(self):
+        return bool(self.filled.all())
+
+    def has(self, idx:int):
+        return 0 <= idx < len(self.filled) and bool(self.filled[idx])
+
+    def get(self, idx:int):
+        """Returns the frame without copying"""
+        return self.frames[idx]
+
+    def put(self, idx:int, frame:np.array):
+        if 0 <= idx < len(self.filled) and frame.shape == self.frames.shape[1:]:
+            self.frames[idx] = frame
+            # Flag is written after the frame, so a reader never sees
+            # a flagged but half written frame
+            self.filled[idx] = 1
+
+    def close(self):
+        self.frames.flush()
+        self.filled.flush()
+        self._cache.touch(self.key)
+        self.frames = None
+        self.filled = None
+
+
+class DiskFrameCache():
+    """Folder of CacheEntry, limited in total size by LRU eviction"""
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR,
+                 max_bytes:int=DEFAULT_MAX_BYTES):
+        """
+        Arguments
+        ---------
+        cache_dir : str or Path
+            Folder to keep cached frames in
+        max_bytes : int
+            Maximum disk usage of the whole cache
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def path(self, key:str, suffix:str):
+        return self.cache_dir / (key + suffix)
+
+    @staticmethod
+    def key(vid_name:str):
+        """Cache key of a video, from its path, size and mtime"""
+        vid_name = os.path.abspath(vid_name)
+        stat = os.stat(vid_name)
+        ident = f'{vid_name}|{stat.st_size}|{stat.st_mtime_ns}'
+        return hashlib.sha1(ident.encode()).hexdigest()
+
+    def _read_meta(self, key:str):
+        try:
+            with open(self.path(key, '.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, key:str, meta:dict):
+        meta_name = self.path(key, '.json')
+        tmp_name = meta_name.with_suffix('.json.tmp')
+        with open(tmp_name, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_name, meta_name)
+
+    def touch(self, key:str):
+        """Marks the entry as recently used"""
+        meta = self._read_meta(key)
+        if meta is not None:
+            meta['last_access'] = time.time()
+            self._write_meta(key, meta)
+
+    def entries(self):
+        """Returns [(last_access, key, bytes on disk), ...]"""
+        result = []
+        for meta_name in self.cache_dir.glob('*.json'):
+            key = meta_name.stem
+            meta = self._read_meta(key)
+            if meta is None:
+                continue
+            size = 0
+            for suffix in ('.frames', '.filled'):
+                try:
+                    # Files are sparse; count only what is really used
+                    size += os.stat(self.path(key, suffix)).st_blocks * 512
+                except OSError:
+                    pass
+            result.append((meta['last_access'], key, size))
+        return result
+
+    def remove(self, key:str):
+        for suffix in ('.json', '.frames', '.filled'):
+            try:
+                os.unlink(self.path(key, suffix))
+            except FileNotFoundError:
+                pass
+
+    def evict(self, needed_bytes:int, keep:str=None):
+        """Removes least recently used entries until needed_bytes fits
+
+        Return
+        ------
+        fits : bool
+            False if needed_bytes does not fit even after evicting
+        """
+        entries = sorted(self.entries())
+        total = sum(e[2] for e in entries)
+        for _, key, size in entries:
+            if total + needed_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total -= size
+        return total + needed_bytes <= self.max_bytes
+
+    def open(self, vid_name:str, frame_num:int, frame_shape:tuple):
+        """Opens the entry of a video, creating it if necessary
+
+        Parameters
+        ----------
+        vid_name : str
+        frame_num : int
+            Used only when the entry is created
+        frame_shape : tuple
+            (WIDTH, HEIGHT, 3). Used only when the entry is created
+
+        Return
+        ------
+        entry : CacheEntry
+            None if the video does not fit in the cache
+        """
+        key = self.key(vid_name)
+        meta = self._read_meta(key)
+        if meta is not None:
+            meta['last_access'] = time.time()
+            self._write_meta(key, meta)
+            return CacheEntry(self, key, meta, 'r+')
+
+        nbytes = frame_num * int(np.prod(frame_shape))
+        if not self.evict(nbytes, keep=key):
+            return None
+        meta = {
+            'vid_path' : os.path.abspath(vid_name),
+            'frame_num' : int(frame_num),
+            'frame_shape' : [int(s) for s in frame_shape],
+            'last_access' : time.time(),
+        }
+        # Create the arrays first, so that meta never points to nothing
+        entry = CacheEntry(self, key, meta, 'w+')
+        self._write_meta(key, meta)
+        return entry
+
+
+def warm(cache:DiskFrameCache, vid_name:str):
+    """Decodes every frame of a video into the cache
+
+    Return
+    ------
+    n : int
+        Number of frames newly written
+    """
+    from .frame_source import FrameSource
+    frames = FrameSource(vid_name, cache_frames=1, disk_cache=cache)
+    entry = frames.disk_entry
+    n = 0
+    try:
+        if entry is None:
+            print(f'{vid_name} does not fit in the cache, skipped')
+            return 0
+        for idx in range(len(entry)):
+            if not entry.has(idx):
+                frames.fetch(idx)
+                # The video turned out to be shorter than reported
+                if idx >= len(frames):
+                    break
+                n += 1
+    finally:
+        frames.release()
+    return n
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m sources.frame_cache')
+    parser.add_argument('--cache-dir', default=str(DEFAULT_CACHE_DIR))
+    parser.add_argument('--max-gb', type=float,
+                        default=DEFAULT_MAX_BYTES / (1 << 30))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    warm_parser = subparsers.add_parser(
+        'warm', help='decode every video in folders into the cache')
+    warm_parser.add_argument('folder', nargs='+')
+    subparsers.add_parser('list', help='show cached videos')
+    args = parser.parse_args()
+
+    cache = DiskFrameCache(args.cache_dir, int(args.max_gb * (1 << 30)))
+    if args.command == 'warm':
+        for folder in args.folder:
+            for f in sorted(os.listdir(folder)):
+                if not f.endswith(VIDEO_FORMATS):
+                    continue
+                vid_name = os.path.join(folder, f)
+                start = time.perf_counter()
+                n = warm(cache, vid_name)
+                print(f'{vid_name} : {n} frames decoded in '
+                      f'{time.perf_counter()-start:.1f}s')
+    elif args.command == 'list':
+        for last_access, key, size in sorted(cache.entries(), reverse=True):
+            meta = cache._read_meta(key)
+            print(f'{time.ctime(last_access)} {size/(1<<20):10.1f}MB '
+                  f'{meta["vid_path"]}')
@@ -0,0 +1,552 @@
+import numpy as np
+import cv2
+import threading
+from collections import OrderedDict
+from .compressed_store import CompressedFrameStore
+
+class FrameSource():
+    """Decodes frames of a video on demand
+
+    Frames are returned in the same layout as Engine used to keep them
+        Shape : (WIDTH, HEIGHT, 3) -> Pygame notation, RGB
+
+    Decoded frames are kept in a bounded LRU cache. The size of the cache
+    can be limited by number of frames, by bytes, or both.
+    Sequential access (idx, idx+1, ...) never seeks.
+
+    It is safe to access from multiple threads (e.g. a Prefetcher),
+    as every decode is done while holding a lock.
+
+    With a DiskFrameCache, every decoded frame is also written to disk,
+    and frames found there are returned as memmap views without decoding.
+
+    With proxy_level > 0, a downscaled copy of each frame (level-th step of
+    an image pyramid) is built right after decoding, for display.
+
+    With a SeekIndex, seeks go to the nearest verified anchor and grab
+    forward, so they are exact and bounded, and the frame count is exact.
+
+    With `compress`, every decoded frame is also kept compressed in memory
+    (see compressed_store.py), and the LRU cache works as a small hot set
+    of decompressed frames. Frames already on disk are not compressed.
+    """
+    # Forward gaps smaller than this are skipped with grab() instead of a seek
+    max_grab_gap = 30
+
+    def __init__(self, vid_name:str, cache_frames:int=256,
+                 cache_bytes:int=None, disk_cache=None, proxy_level:int=0,
+                 compress:str=None, compress_level:int=None,
+                 compress_bytes:int=None):
+        """
+        Arguments
+        ---------
+        vid_name : str
+            Path of the video
+        cache_frames : int
+            Maximum number of decoded frames to keep. None for no limit
+        cache_bytes : int
+            Maximum bytes of decoded frames to keep. None for no limit
+        disk_cache : DiskFrameCache
+            Persistent cache to read from and write to. None to disable
+        proxy_level : int
+            Each level halves the width and height of proxy frames.
+            0 to disable proxies.
+        compress : str
+            Codec of the compressed store, one of CODECS in
+            compressed_store.py. None to disable
+        compress_level : int
+            Compression level, or jpeg quality. None for the default
+        compress_bytes : int
+            Maximum bytes of the compressed store. None for no limit
+        """
+        self._vid_name = vid_name
+        self._cap = cv2.VideoCapture(vid_name)
+        if not self._cap.isOpened():
+            raise IOError(f'Cannot open video {vid_name}')
+        self._frame_num = int(self._cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        # Index of the frame that the next read() will return
+        self._next_read = 0
+
+        self.cache_frames = cache_frames
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        self.proxy_level = proxy_level
+        self._proxies = OrderedDict()
+        self._seek_index = None
+        self._store = None
+        if compress is not None:
+            self._store = CompressedFrameStore(compress, compress_level,
+                                               compress_bytes)
+        self._lock = threading.RLock()
+        self._released = False
+        self.hits = 0
+        self.misses = 0
+
+        # Frame count reported by containers can be wrong. Trust the first
+        # frame at least, so that there is always something to show.
+        if self._frame_num <= 0:
+            self._frame_num = 1
+        self._disk_entry = None
+        if disk_cache is not None:
+            self.attach_disk_cache(disk_cache)
+        first = self[0]
+        self._frame_shape = first.shape
+
+    def attach_disk_cache(self, disk_cache):
+        """Reads from and writes to disk_cache from now on
+
+        Engine attaches it late when it decodes the whole video into the
+        cache first (see parallel_decode.py). Does nothing once released.
+        """
+        with self._lock:
+            if self._released or self._disk_entry is not None:
+                return
+            width = int(self._cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(self._cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            self._disk_entry = disk_cache.open(self._vid_name,
+                                               self._frame_num,
+                                               (width, height, 3))
+
+    @property
+    def vid_name(self):
+        return self._vid_name
+
+    @property
+    def shape(self):
+        """Shape of a single frame, (WIDTH, HEIGHT, 3)"""
+        return self._frame_shape
+
+    @property
+    def disk_entry(self):
+        """CacheEntry of the DiskFrameCache, or None"""
+        return self._disk_entry
+
+    @property
+    def store(self):
+        """CompressedFrameStore, or None"""
+        return self._store
+
+    @property
+    def cache_size(self):
+        """Total bytes of currently cached frames"""
+        return self._cache_size
+
+    @property
+    def hit_rate(self):
+        """Ratio of __getitem__ calls served from the cache"""
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return self.hits / total
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self._frame_num
+
+    def __getitem__(self, idx:int):
+        with self._lock:
+            if idx < 0:
+                idx += self._frame_num
+            if self.cached(idx):
+                self.hits += 1
+            else:
+                self.misses += 1
+            return self.fetch(idx)
+
+    def proxy(self, idx:int):
+        """Downscaled frame at idx. Same as self[idx] if proxy_level is 0"""
+        if self.proxy_level == 0:
+            return self[idx]
+        with self._lock:
+            if idx < 0:
+                idx += self._frame_num
+            if idx in self._proxies:
+                self.hits += 1
+                self._proxies.move_to_end(idx)
+                return self._proxies[idx]
+            frame = self[idx]
+            # Decoding builds the proxy; frames from disk do not have it yet
+            if idx not in self._proxies:
+                self._put_proxy(idx, pyramid(frame, self.proxy_level))
+            return self._proxies[idx]
+
+    def cached(self, idx:int):
+        """Returns True if the frame at idx is decoded already"""
+        if idx in self._cache:
+            return True
+        entry = self._disk_entry
+        return entry is not None and entry.has(idx)
+
+    def fetch(self, idx:int):
+        """Same as self[idx], but does not count as a cache hit or miss"""
+        with self._lock:
+            if idx < 0 or idx >= self._frame_num:
+                raise IndexError('frame index out of range')
+            if idx in self._cache:
+                self._cache.move_to_end(idx)
+                return self._cache[idx]
+            entry = self._disk_entry
+            if entry is not None and entry.has(idx):
+                return entry.get(idx)
+            store = self._store
+            if store is not None and idx in store:
+                frame = store.get(idx)
+            else:
+                frame = self._decode(idx)
+                # Container reported more frames than it actually has;
+                # walk down to the last frame that decodes
+                while frame is None:
+                    idx = self._frame_num - 1
+                    if idx in self._cache:
+                        return self._cache[idx]
+                    frame = self._decode(idx)
+                if entry is not None:
+                    entry.put(idx, frame)
+                elif store is not None:
+                    store.put(idx, frame)
+            self._put_cache(idx, frame)
+            if self.proxy_level > 0:
+                self._put_proxy(idx, pyramid(frame, self.proxy_level))
+            return frame
+
+    @property
+    def seek_index(self):
+        return self._seek_index
+
+    def set_seek_index(self, index):
+        """Uses a SeekIndex of this video from now on"""
+        with self._lock:
+            self._seek_index = index
+            self._frame_num = index.frame_count
+
+    def fill(self, cancel=None):
+        """Decodes every frame in one sequential pass into the disk cache,
+        or else into the compressed store if it has no size limit
+
+        For videos whose seeks are never exact (a degraded SeekIndex), so
+        that random access does not decode from frame 0 every time. Meant
+        to run in a thread: it has its own VideoCapture, and only takes the
+        lock to store a frame. Stops when cancel is set or on release().
+
+        Return
+        ------
+        n : int
+            Number of frames stored, 0 if there is nowhere to store them
+        """
+        with self._lock:
+            if self._disk_entry is None and (
+                    self._store is None or self._store.max_bytes is not None):
+                return 0
+        cap = cv2.VideoCapture(self._vid_name)
+        n = 0
+        try:
+            for idx in range(self._frame_num):
+                if cancel is not None and cancel.is_set():
+                    break
+                with self._lock:
+                    if self._released:
+                        break
+                    entry = self._disk_entry
+                    done = entry.has(idx) if entry is not None \
+                        else idx in self._store
+                if done:
+                    if not cap.grab():
+                        break
+                    continue
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB).swapaxes(0,1)
+                with self._lock:
+                    if self._released:
+                        break
+                    if entry is not None:
+                        entry.put(idx, frame)
+                    else:
+                        self._store.put(idx, frame)
+                n += 1
+        finally:
+            cap.release()
+        return n
+
+    def _decode(self, idx:int):
+        """Decode the frame at idx, seeking only when necessary
+
+        Returns None if there is no such frame, and fixes the frame number.
+        """
+        gap = idx - self._next_read
+        if self._seek_index is not None:
+            anchor = self._seek_index.anchor(idx)
+            # Reading on is never longer than from the anchor
+            if gap < 0 or self._next_read < anchor:
+                self._seek(anchor)
+            for _ in range(idx - self._next_read):
+                self._cap.grab()
+        elif gap < 0 and idx <= self.max_grab_gap:
+            self._seek(0)
+            for _ in range(idx):
+                self._cap.grab()
+        elif gap < 0 or gap > self.max_grab_gap:
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+        else:
+            for _ in range(gap):
+                self._cap.grab()
+        ret, frame = self._cap.read()
+        if not ret:
+            self._frame_num = max(idx, 1)
+            self._next_read = idx
+            if idx == 0:
+                raise IOError(f'Cannot decode video {self._vid_name}')
+            return None
+        self._next_read = idx + 1
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        return frame.swapaxes(0,1)
+
+    def _seek(self, idx:int):
+        """Moves so that the next read() returns frame idx"""
+        if idx == 0:
+            # Seeking to the start is not exact for some containers (.mpg),
+            # but opening the video again always is
+            self._cap.release()
+            self._cap = cv2.VideoCapture(self._vid_name)
+        else:
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+        self._next_read = idx
+
+    def _put_cache(self, idx:int, frame:np.array):
+        self._cache[idx] = frame
+        self._cache_size += frame.nbytes
+        while len(self._cache) > 1 and (
+            (self.cache_frames is not None
+                and len(self._cache) > self.cache_frames)
+            or (self.cache_bytes is not None
+                and self._cache_size > self.cache_bytes)
+        ):
+            _, old = self._cache.popitem(last=False)
+            self._cache_size -= old.nbytes
+
+    def _put_proxy(self, idx:int, proxy:np.array):
+        self._proxies[idx] = proxy
+        limit = self.cache_frames if self.cache_frames is not None else 256
+        while len(self._proxies) > max(limit, 1):
+            self._proxies.popitem(last=False)
+
+    def release(self):
+        with self._lock:
+            self._released = True
+            self._cap.release()
+            self._cache.clear()
+            self._proxies.clear()
+            self._cache_size = 0
+            if self._store is not None:
+                self._store.clear()
+            if self._disk_entry is not None:
+                self._disk_entry.close()
+                self._disk_entry = None
+
+
+def pyramid(frame:np.array, level:int):
+    """Downscales frame by 2**level with cv2.pyrDown
+
+    frame : (WIDTH, HEIGHT, 3) -> Pygame notation
+    """
+    # cv2 works on (HEIGHT, WIDTH, 3)
+    image = np.ascontiguousarray(frame.swapaxes(0,1))
+    for _ in range(level):
+        image = cv2.pyrDown(image)
+    return image.swapaxes(0,1)
+
+def proxy_level_for(frame_shape:tuple, max_size:tuple):
+    """Smallest pyramid level that fits frame_shape into max_size
+
+    frame_shape : (WIDTH, HEIGHT, ...)
+    max_size : (WIDTH, HEIGHT), or None for no limit
+    """
+    if max_size is None:
+        return 0
+    level = 0
+    width, height = frame_shape[0], frame_shape[1]
+    while width > max_size[0] or height > max_size[1]:
+        # Same rounding as cv2.pyrDown
+        width, height = (width+1)//2, (height+1)//2
+        level += 1
+    return level
+
+
+class Prefetcher(threading.Thread):
+    """Decodes frames around the current index in the background
+
+    The window follows the scrubbing direction: when moving forward,
+    `ahead` frames after the current index are decoded first, and when
+    moving backward the frames behind are decoded first.
+    Frames behind are decoded in short ascending chunks, because decoding
+    backward one by one would seek on every frame.
+    Every move restarts the plan from the new index, so work queued for a
+    stale position (e.g. after a jump) is dropped.
+    """
+    chunk = 8
+
+    def __init__(self, source:FrameSource, ahead:int=32, behind:int=16):
+        """
+        Arguments
+        ---------
+        source : FrameSource
+            Frame source to fill
+        ahead : int
+            Number of frames to decode in the scrubbing direction
+        behind : int
+            Number of frames to decode in the other direction
+        """
+        super().__init__(daemon=True)
+        self._source = source
+        # Window should never evict itself out of the cache
+        if source.cache_frames is not None:
+            limit = max(source.cache_frames - 1, 0)
+            ahead = min(ahead, limit)
+            behind = min(behind, limit - ahead)
+        self.ahead = ahead
+        self.behind = behind
+        self._cond = threading.Condition()
+        self._idx = 0
+        self._direction = 1
+        self._generation = 0
+        self._done = -1
+        self._quit = False
+
+    def update(self, idx:int):
+        """Tell the prefetcher that current index moved to idx"""
+        with self._cond:
+            diff = idx - self._idx
+            if diff == 0:
+                return
+            self._direction = 1 if diff > 0 else -1
+            self._idx = idx
+            self._generation += 1
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._quit = True
+            self._generation += 1
+            self._cond.notify()
+
+    def _plan(self, idx:int, direction:int):
+        """List of indices to decode, most urgent first
+
+        idx itself comes first, for a seek that waits for it (a scrub).
+        """
+        if direction > 0:
+            n_after, n_before = self.ahead, self.behind
+        else:
+            n_after, n_before = self.behind, self.ahead
+        after = list(range(idx+1, min(idx+1+n_after, len(self._source))))
+        before = []
+        lowest = max(idx - n_before, 0)
+        end = idx
+        # Chunks are nearest-first, but each chunk is ascending
+        while end > lowest:
+            start = max(end - self.chunk, lowest)
+            before.extend(range(start, end))
+            end = start
+        if direction > 0:
+            return [idx] + after + before
+        return [idx] + before + after
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._generation == self._done and not self._quit:
+                    self._cond.wait()
+                if self._quit:
+                    return
+                generation = self._generation
+                plan = self._plan(self._idx, self._direction)
+            for i in plan:
+                if self._generation != generation:
+                    break
+                if not self._source.cached(i):
+                    try:
+                        self._source.fetch(i)
+                    except IndexError:
+                        continue
+            else:
+                self._done = generation
+
+
+class Preloader(threading.Thread):
+    """Opens a video and decodes its first frames in the background
+
+    Used to get the next video ready while the current one is labeled.
+    Decoding stops after `max_frames` frames, or is cancelled when the
+    decoded frames would take more than `max_bytes` of memory. Frames
+    decoded so far are kept either way, and the FrameSource is handed
+    over with take().
+    """
+    def __init__(self, vid_name:str, max_frames:int=256,
+                 max_bytes:int=1<<30, max_display_size:tuple=None,
+                 **source_kwargs):
+        """
+        Arguments
+        ---------
+        vid_name : str
+            Path of the video
+        max_frames : int
+            Number of frames to decode from the start
+        max_bytes : int
+            Memory limit of the decoded frames
+        max_display_size : tuple
+            Same as Engine's, so that proxies are built while decoding
+        source_kwargs
+            Passed to FrameSource
+        """
+        super().__init__(daemon=True)
+        self.vid_name = vid_name
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self._max_display_size = max_display_size
+        self._source_kwargs = source_kwargs
+        self.source = None
+        self.cancelled = False
+        self.n_decoded = 0
+        self._quit = False
+
+    def stop(self):
+        self._quit = True
+
+    def take(self):
+        """Stops decoding and returns the FrameSource, or None on failure"""
+        self.stop()
+        self.join()
+        source, self.source = self.source, None
+        return source
+
+    def discard(self):
+        """Stops decoding and frees everything"""
+        source = self.take()
+        if source is not None:
+            source.release()
+
+    def run(self):
+        try:
+            source = FrameSource(self.vid_name, **self._source_kwargs)
+        except IOError:
+            return
+        source.proxy_level = proxy_level_for(source.shape,
+                                             self._max_display_size)
+        self.source = source
+        frame_bytes = int(np.prod(source.shape))
+        for idx in range(1, min(self.max_frames, len(source))):
+            if self._quit:
+                return
+            used = source.cache_size
+            if source.store is not None:
+                used += source.store.nbytes
+            if used + frame_bytes > self.max_bytes:
+                self.cancelled = True
+                return
+            source.fetch(idx)
+            self.n_decoded = idx + 1
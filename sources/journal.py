@@ -0,0 +1,206 @@
+"""Write-ahead journal of annotation edits
+
+Every edit is appended to <journal folder>/<video key>.<gen>.wal as a fixed
+size record, so a crashed session loses nothing. Every `compact_every`
+records, the whole data is written to <video key>.snap.npz (same format as
+sources/saves.py) and a new journal generation is started.
+
+The snapshot records which journal generation follows it, so recovery is
+    load snapshot -> replay <video key>.<gen>.wal
+and a crash during compaction can never apply a record twice.
+"""
+import numpy as np
+import os
+import struct
+from pathlib import Path
+from .common.constants import SINGLE_MARKERS, MULTIPLE_MARKERS
+from .annotations import INTERP_METHODS
+from . import saves
+
+# op, marker, sub index, frame, x, y
+RECORD = struct.Struct('<BBHiii')
+RECORD_DTYPE = np.dtype([
+    ('op', '<u1'),
+    ('marker', '<u1'),
+    ('sub', '<u2'),
+    ('frame', '<i4'),
+    ('x', '<i4'),
+    ('y', '<i4'),
+])
+
+OP_SET = 1
+OP_SET_MULTI = 2
+OP_ADD = 3
+OP_POP = 4
+# New frame appended; x is the frame it was copied from, -1 for dummy
+OP_NEWFRAME = 5
+# Frames appended up to `frame` frames in total, all copies of x
+OP_EXTEND = 6
+# Frames around keyframe `frame` interpolated, sub is the method
+OP_INTERP = 7
+# Single marker set from a tracker proposal, not a keyframe
+OP_PROPOSE = 8
+
+class Journal():
+    """Append-only journal of one video's annotation edits"""
+    def __init__(self, journal_folder, vid_name, compact_every:int=4096):
+        """
+        Arguments
+        ---------
+        journal_folder : str or Path
+            Folder to keep journals and snapshots in
+        vid_name : str
+            Path of the video. Journals are keyed by its name and
+            fingerprint, so a replaced file with the same name starts fresh.
+        compact_every : int
+            Number of records before the journal is compacted into a snapshot
+        """
+        self._folder = Path(journal_folder)
+        self._folder.mkdir(parents=True, exist_ok=True)
+        self._vid_name = vid_name
+        self._fingerprint = saves.video_fingerprint(vid_name)
+        self._key = f'{Path(vid_name).stem}-{self._fingerprint[:12]}'
+        self.compact_every = compact_every
+        self._snap_name = self._folder / f'{self._key}.snap.npz'
+        self._gen = 0
+        self._fd = None
+        self._n_records = 0
+
+    def _wal_name(self, gen):
+        return self._folder / f'{self._key}.{gen}.wal'
+
+    def _open(self, gen):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._gen = gen
+        self._fd = os.open(self._wal_name(gen),
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def modified(self):
+        """Last modification time of the snapshot or journal, 0 if none"""
+        names = [self._snap_name, *self._folder.glob(f'{self._key}.*.wal')]
+        return max((n.stat().st_mtime for n in names if n.exists()),
+                   default=0)
+
+    @property
+    def needs_compaction(self):
+        return self._n_records >= self.compact_every
+
+    def recover(self, store):
+        """Rebuilds data from the snapshot and the journal into store
+
+        Also opens the journal for appending, so call this once
+        before any edit.
+
+        Parameters
+        ----------
+        store : AnnotationStore
+            An empty store to fill. Nothing is added if there was
+            nothing to recover.
+        """
+        gen = 0
+        if self._snap_name.exists():
+            arrays = saves.load_annotations(self._snap_name)
+            store.load_arrays(arrays)
+            gen = int(arrays['journal_gen'])
+
+        wal_name = self._wal_name(gen)
+        if wal_name.exists():
+            with open(wal_name, 'rb') as f:
+                buf = f.read()
+            # A torn record at the end is from a crash during write
+            n = len(buf) // RECORD.size
+            records = np.frombuffer(buf, dtype=RECORD_DTYPE, count=n)
+            self._replay(store, records.tolist())
+            if len(buf) != n * RECORD.size:
+                with open(wal_name, 'r+b') as f:
+                    f.truncate(n * RECORD.size)
+            self._n_records = n
+
+        self._open(gen)
+        # Journals of older generations are already in the snapshot
+        for old in self._folder.glob(f'{self._key}.*.wal'):
+            if old.suffixes[-2] != f'.{gen}':
+                old.unlink()
+
+    @staticmethod
+    def _replay(store, records):
+        for op, marker, sub, frame, x, y in records:
+            if op == OP_NEWFRAME:
+                # Never append the same frame twice
+                if frame == len(store):
+                    store.append(x)
+            elif op == OP_EXTEND:
+                store.extend(frame, x)
+            elif op == OP_SET:
+                store.set(frame, SINGLE_MARKERS[marker], (x, y))
+            elif op == OP_SET_MULTI:
+                store.set_multi(frame, MULTIPLE_MARKERS[marker], sub, (x, y))
+            elif op == OP_ADD:
+                store.add(frame, MULTIPLE_MARKERS[marker], (x, y))
+            elif op == OP_POP:
+                store.pop(frame, MULTIPLE_MARKERS[marker])
+            elif op == OP_PROPOSE:
+                store.propose(frame, SINGLE_MARKERS[marker], (x, y))
+            elif op == OP_INTERP:
+                store.interpolate(SINGLE_MARKERS[marker], frame,
+                                  INTERP_METHODS[sub])
+
+    def _append(self, op, marker, sub, frame, x, y):
+        os.write(self._fd, RECORD.pack(op, marker, sub, frame, x, y))
+        self._n_records += 1
+
+    def new_frame(self, frame:int, src:int):
+        """frame was appended as a copy of src (-1 for the dummy datum)"""
+        self._append(OP_NEWFRAME, 0, 0, frame, src, 0)
+
+    def extend(self, n_frames:int, src:int):
+        """Frames were appended up to n_frames, as copies of src"""
+        self._append(OP_EXTEND, 0, 0, n_frames, src, 0)
+
+    def set_marker(self, frame:int, marker_type:str, pos):
+        self._append(OP_SET, SINGLE_MARKERS.index(marker_type), 0,
+                     frame, pos[0], pos[1])
+
+    def propose_marker(self, frame:int, marker_type:str, pos):
+        self._append(OP_PROPOSE, SINGLE_MARKERS.index(marker_type), 0,
+                     frame, pos[0], pos[1])
+
+    def set_multi_marker(self, frame:int, marker_type:str, idx:int, pos):
+        self._append(OP_SET_MULTI, MULTIPLE_MARKERS.index(marker_type), idx,
+                     frame, pos[0], pos[1])
+
+    def add_marker(self, frame:int, marker_type:str, pos):
+        self._append(OP_ADD, MULTIPLE_MARKERS.index(marker_type), 0,
+                     frame, pos[0], pos[1])
+
+    def pop_marker(self, frame:int, marker_type:str):
+        self._append(OP_POP, MULTIPLE_MARKERS.index(marker_type), 0,
+                     frame, 0, 0)
+
+    def interpolate(self, frame:int, marker_type:str, method:str):
+        self._append(OP_INTERP, SINGLE_MARKERS.index(marker_type),
+                     INTERP_METHODS.index(method), frame, 0, 0)
+
+    def compact(self, store):
+        """Writes store as a snapshot and starts a new journal generation"""
+        new_gen = self._gen + 1
+        old_wal = self._wal_name(self._gen)
+        os.fsync(self._fd)
+        self._open(new_gen)
+        saves.save_annotations(self._snap_name, store.to_arrays(),
+                               self._vid_name,
+                               fingerprint=self._fingerprint,
+                               journal_gen=new_gen)
+        if old_wal.exists():
+            old_wal.unlink()
+        self._n_records = 0
+
+    def close(self, store=None):
+        """Closes the journal, compacting it first if store is given"""
+        if self._fd is None:
+            return
+        if store is not None and self._n_records > 0:
+            self.compact(store)
+        os.close(self._fd)
+        self._fd = None
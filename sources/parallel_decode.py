@@ -0,0 +1,252 @@
+"""Decoding a whole video in parallel, segment by segment
+
+The video is split into contiguous segments, and each worker seeks to the
+start of its segment and decodes it sequentially into a shared raw buffer
+(the .frames / .filled files of a DiskFrameCache entry, or any np.memmap
+of the same layout).
+Seeking relies on the backend seeking to the keyframe before the target
+and decoding forward, which is not exact for every container. So every
+worker also decodes one frame past its segment, and its hash is compared
+with the first frame of the next segment.
+A segment is verified if its first frame matches the overlap of the
+previous segment, which was verified itself; the first segment never
+seeks, so it is always right. A segment that does not match is decoded
+again, sequentially from the seek point of the last verified segment
+(frame 0 at worst), and checked again. So the result is identical to
+decoding from the first frame, as far as frame hashes can tell.
+Frames are marked filled only once their segment is verified, so a
+cancelled or failed decode never leaves wrong frames in the cache.
+
+Frames are in the same layout as FrameSource
+    Shape : (WIDTH, HEIGHT, 3) -> Pygame notation, RGB
+
+Decode a video into the cache from the command line with
+    python -m sources.parallel_decode <video> [--workers N] [--threads]
+"""
+import numpy as np
+import os
+import time
+import hashlib
+import argparse
+import threading
+import cv2
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+def split(frame_num:int, n_segments:int):
+    """[(start, stop), ...] of n_segments contiguous segments"""
+    n_segments = max(min(n_segments, frame_num), 1)
+    bounds = np.linspace(0, frame_num, n_segments+1).astype(int)
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+def _digest(frame:np.array):
+    return hashlib.sha1(np.ascontiguousarray(frame)).hexdigest()
+
+def _open_buffers(frames_name, filled_name, frame_num:int, frame_shape):
+    frames = np.memmap(frames_name, dtype=np.uint8, mode='r+',
+                       shape=(frame_num,)+tuple(frame_shape))
+    filled = np.memmap(filled_name, dtype=np.uint8, mode='r+',
+                       shape=(frame_num,))
+    return frames, filled
+
+def decode_segment(vid_name:str, frames_name, filled_name, frame_num:int,
+                   frame_shape:tuple, start:int, stop:int, seek_from:int=None,
+                   mark_filled:bool=True, cancel=None, progress=None):
+    """Decodes frames start ~ stop-1 into the buffers. Runs in a worker
+
+    Parameters
+    ----------
+    seek_from : int
+        Frame to seek to, and decode forward from. Defaults to start.
+        Frames before start are decoded but not written.
+    mark_filled : bool
+        Sets the filled flags of written frames. False to leave that to
+        the caller, once the segment is verified
+    cancel : threading.Event
+        Decoding stops when it is set. Only with threads
+    progress : callable
+        Called with the number of frames written since the last call.
+        Only with threads
+
+    Return
+    ------
+    first : str
+        Hash of frame start as decoded here
+    overlap : str
+        Hash of frame stop as decoded here, None if it is the last segment
+    n_written : int
+        Frames written. Less than stop-start if the video ended early
+    """
+    if seek_from is None:
+        seek_from = start
+    frames, filled = _open_buffers(frames_name, filled_name,
+                                   frame_num, frame_shape)
+    cap = cv2.VideoCapture(vid_name)
+    if seek_from > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, seek_from)
+    first = overlap = None
+    n_written = 0
+    try:
+        last = min(stop+1, frame_num)
+        for idx in range(seek_from, last):
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if cancel is not None and cancel.is_set():
+                break
+            if idx < start:
+                continue
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB).swapaxes(0,1)
+            if idx == stop:
+                overlap = _digest(frame)
+                break
+            if idx == start:
+                first = _digest(frame)
+            frames[idx] = frame
+            if mark_filled:
+                filled[idx] = 1
+            n_written += 1
+            if progress is not None and n_written % 64 == 0:
+                progress(64)
+    finally:
+        if progress is not None:
+            progress(n_written % 64)
+        cap.release()
+        frames.flush()
+        filled.flush()
+    return first, overlap, n_written
+
+def decode_parallel(vid_name:str, frames_name, filled_name, frame_num:int,
+                    frame_shape:tuple, workers:int=None,
+                    use_threads:bool=False, cancel=None, progress=None):
+    """Decodes every frame of a video into the buffers, in parallel
+
+    Parameters
+    ----------
+    frames_name, filled_name : str or Path
+        Raw files of (frame_num,)+frame_shape and (frame_num,) uint8,
+        as in a DiskFrameCache entry. They must exist already.
+    workers : int
+        Number of workers and segments. Defaults to the number of cpus
+    use_threads : bool
+        Use threads instead of processes. cv2 releases the GIL while
+        decoding, so threads also scale, and they work inside daemonic
+        processes (e.g. Engine) that cannot have children.
+    cancel : threading.Event
+        Decoding stops when it is set, keeping what is verified so far.
+        Only with threads
+    progress : callable
+        Called as progress(frames decoded, frame_num) from the workers.
+        Only with threads
+
+    Return
+    ------
+    n_frames : int
+        Number of frames actually decoded. Less than frame_num if the
+        container reported more frames than it has
+    n_redone : int
+        Number of segments that did not line up and were decoded again
+        Raises RuntimeError if a redone segment still does not line up
+    """
+    workers = workers or os.cpu_count() or 1
+    segments = split(frame_num, workers)
+    args = (vid_name, str(frames_name), str(filled_name), frame_num,
+            tuple(frame_shape))
+    extra = {'mark_filled' : False}
+    if use_threads:
+        lock = threading.Lock()
+        done = [0]
+        def count(n):
+            with lock:
+                done[0] += n
+                total = done[0]
+            if progress is not None:
+                progress(total, frame_num)
+        extra.update(cancel=cancel, progress=count)
+    Executor = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+    with Executor(max_workers=len(segments)) as pool:
+        futures = [pool.submit(decode_segment, *args, start, stop, **extra)
+                   for start, stop in segments]
+        results = [f.result() for f in futures]
+    _, filled = _open_buffers(*args[1:])
+
+    n_redone = 0
+    n_frames = 0
+    # Last seek that landed exactly; frame 0 is opened, never seeked
+    verified_seek = 0
+    for k, (start, stop) in enumerate(segments):
+        if cancel is not None and cancel.is_set():
+            break
+        first, overlap, n_written = results[k]
+        if k > 0:
+            prev_overlap = results[k-1][1]
+            if first == prev_overlap:
+                verified_seek = start
+            else:
+                # Decoding on from an exact seek is always correct
+                first, overlap, n_written = decode_segment(
+                    *args, start, stop, seek_from=verified_seek,
+                    mark_filled=False, cancel=cancel)
+                results[k] = (first, overlap, n_written)
+                n_redone += 1
+                if cancel is not None and cancel.is_set():
+                    break
+                if first != prev_overlap:
+                    raise RuntimeError(
+                        f'Cannot decode {vid_name} consistently '
+                        f'around frame {start}')
+        filled[start:start+n_written] = 1
+        filled.flush()
+        n_frames += n_written
+        if n_written < stop - start:
+            break
+    return n_frames, n_redone
+
+def decode_to_cache(cache, vid_name:str, workers:int=None,
+                    use_threads:bool=False, cancel=None, progress=None):
+    """Decodes a whole video into its DiskFrameCache entry, in parallel
+
+    cancel and progress are passed to decode_parallel.
+
+    Return
+    ------
+    n_frames : int
+        Number of frames in the entry, 0 if it does not fit in the cache
+    """
+    cap = cv2.VideoCapture(vid_name)
+    if not cap.isOpened():
+        raise IOError(f'Cannot open video {vid_name}')
+    frame_num = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 1)
+    frame_shape = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                   int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), 3)
+    cap.release()
+    entry = cache.open(vid_name, frame_num, frame_shape)
+    if entry is None:
+        return 0
+    try:
+        if entry.complete:
+            return len(entry)
+        frame_num = len(entry)
+        frame_shape = entry.frames.shape[1:]
+        frames_name = cache.path(entry.key, '.frames')
+        filled_name = cache.path(entry.key, '.filled')
+        n_frames, _ = decode_parallel(vid_name, frames_name, filled_name,
+                                      frame_num, frame_shape, workers,
+                                      use_threads, cancel, progress)
+    finally:
+        entry.close()
+    return n_frames
+
+if __name__ == '__main__':
+    from .frame_cache import DiskFrameCache, DEFAULT_CACHE_DIR
+    parser = argparse.ArgumentParser(prog='python -m sources.parallel_decode')
+    parser.add_argument('video', nargs='+')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threads', action='store_true',
+                        help='use threads instead of processes')
+    parser.add_argument('--cache-dir', default=str(DEFAULT_CACHE_DIR))
+    args = parser.parse_args()
+    cache = DiskFrameCache(args.cache_dir)
+    for vid_name in args.video:
+        start = time.perf_counter()
+        n = decode_to_cache(cache, vid_name, args.workers, args.threads)
+        print(f'{vid_name} : {n} frames in {time.perf_counter()-start:.1f}s')
@@ -0,0 +1,266 @@
+"""Annotation-only save files
+
+A save is a single .npz file holding
+    'version' : int
+    'vid_path' : str, absolute path of the labeled video
+    'fingerprint' : str, see video_fingerprint()
+    '<single marker>' : (n_frames, 2) int32 array for each SINGLE_MARKERS
+        Order : (WIDTH, HEIGHT) -> Pygame notation
+    'food' : (n_food_total, 2) int32 array of every food pin
+    'food_offsets' : (n_frames+1,) int64 array
+        Food pins of frame i are food[food_offsets[i]:food_offsets[i+1]]
+    'manual', 'interpolated', 'proposed' :
+        (n_frames, len(SINGLE_MARKERS)) bool arrays
+        Whether each single marker was pinned by hand, interpolated
+        between keyframes, or proposed by the tracker.
+        Optional; older saves do not have them.
+
+Images are not saved. Use read_images() to read them from the video.
+find_save() looks up the latest save of a video without loading it, so
+that a session can be resumed (see Engine.load_vid).
+
+Convert old <n>.pck saves with
+    python -m sources.saves convert <n>.pck [--video <video path>]
+"""
+import numpy as np
+import os
+import hashlib
+import pickle
+import argparse
+import warnings
+from pathlib import Path
+from .common.constants import SINGLE_MARKERS, MULTIPLE_MARKERS
+
+SAVE_VERSION = 1
+SAVE_EXT = '.npz'
+# Bytes read from each end of the video for the fingerprint
+FINGERPRINT_BYTES = 1 << 20
+
+def video_fingerprint(vid_name):
+    """Cheap identity of a video file
+
+    sha1 of the file size and the first/last FINGERPRINT_BYTES bytes.
+    Does not read the whole file, so it stays fast on huge videos.
+    """
+    size = os.path.getsize(vid_name)
+    h = hashlib.sha1(str(size).encode())
+    with open(vid_name, 'rb') as f:
+        h.update(f.read(FINGERPRINT_BYTES))
+        if size > FINGERPRINT_BYTES:
+            f.seek(max(size - FINGERPRINT_BYTES, FINGERPRINT_BYTES))
+            h.update(f.read(FINGERPRINT_BYTES))
+    return h.hexdigest()
+
+def next_save_name(save_folder, ext=SAVE_EXT):
+    """Returns <save_folder>/<n><ext> with n larger than any existing save"""
+    save_folder = Path(save_folder)
+    numbers = [int(f.stem) for f in save_folder.iterdir() if f.stem.isdigit()]
+    n = max(numbers) + 1 if numbers else 0
+    return save_folder / f'{n}{ext}'
+
+def find_save(save_folder, vid_name):
+    """Latest save of a video in save_folder
+
+    A save belongs to the video if it has the same fingerprint, wherever
+    the video was (e.g. the folder was moved). Saves without a fingerprint
+    need the same path. Only meta info and food_offsets are read, so it
+    stays fast with many large saves.
+
+    Return
+    ------
+    save : (Path, int) or None
+        Save file and its number of labeled frames. None if there is none
+    """
+    save_folder = Path(save_folder)
+    if not save_folder.is_dir():
+        return None
+    vid_path = os.path.abspath(vid_name)
+    fingerprint = video_fingerprint(vid_name)
+    names = sorted((f for f in save_folder.iterdir()
+                    if f.suffix == SAVE_EXT and f.stem.isdigit()),
+                   key=lambda f: int(f.stem), reverse=True)
+    for name in names:
+        try:
+            with np.load(name) as npz:
+                saved = str(npz['fingerprint'])
+                if saved != fingerprint and \
+                        (saved or str(npz['vid_path']) != vid_path):
+                    continue
+                return name, len(npz['food_offsets']) - 1
+        except (OSError, ValueError, KeyError):
+            continue
+    return None
+
+def data_to_arrays(data):
+    """Converts Engine's list of marker dicts into arrays
+
+    Return
+    ------
+    arrays : dict
+        Arrays in the same layout as the save file, without meta info
+    """
+    arrays = {}
+    for name in SINGLE_MARKERS:
+        arrays[name] = np.array([d[name] for d in data],
+                                dtype=np.int32).reshape(-1, 2)
+    for name in MULTIPLE_MARKERS:
+        counts = [len(d[name]) for d in data]
+        offsets = np.zeros(len(data)+1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        pins = [p for d in data for p in d[name]]
+        arrays[name] = np.array(pins, dtype=np.int32).reshape(-1, 2)
+        arrays[name+'_offsets'] = offsets
+    return arrays
+
+def arrays_to_data(arrays):
+    """Inverse of data_to_arrays. Returns a list of marker dicts"""
+    n_frames = len(arrays['food_offsets']) - 1
+    data = []
+    for i in range(n_frames):
+        datum = {}
+        for name in SINGLE_MARKERS:
+            datum[name] = tuple(int(v) for v in arrays[name][i])
+        for name in MULTIPLE_MARKERS:
+            offsets = arrays[name+'_offsets']
+            datum[name] = [tuple(int(v) for v in p)
+                           for p in arrays[name][offsets[i]:offsets[i+1]]]
+        data.append(datum)
+    return data
+
+def save_annotations(filename, data, vid_name, fingerprint=None, **extra):
+    """Saves markers of data to filename as a compact .npz
+
+    Parameters
+    ----------
+    filename : str or Path
+    data : list of dict
+        Engine's marker data, or arrays from data_to_arrays()
+    vid_name : str
+        Path of the labeled video. Empty string if unknown.
+    fingerprint : str
+        If None, it is computed from vid_name
+    extra
+        Any other arrays to save along
+    """
+    if isinstance(data, dict):
+        arrays = data
+    else:
+        arrays = data_to_arrays(data)
+    if fingerprint is None:
+        fingerprint = video_fingerprint(vid_name) if vid_name else ''
+    if vid_name:
+        vid_name = os.path.abspath(vid_name)
+    # Write to a temporary file first, so that a crash never leaves
+    # a broken save behind
+    filename = Path(filename)
+    tmp_name = filename.with_name(filename.name + '.tmp')
+    with open(tmp_name, 'wb') as f:
+        np.savez(f, version=SAVE_VERSION, vid_path=vid_name,
+                 fingerprint=fingerprint, **arrays, **extra)
+    os.replace(tmp_name, filename)
+
+def load_annotations(filename):
+    """Loads a save file
+
+    Return
+    ------
+    arrays : dict
+        'vid_path' and 'fingerprint' as str, 'version' as int,
+        and every marker array as np.ndarray
+    """
+    arrays = {}
+    with np.load(filename) as npz:
+        for k in npz.files:
+            arrays[k] = npz[k]
+    arrays['vid_path'] = str(arrays['vid_path'])
+    arrays['fingerprint'] = str(arrays['fingerprint'])
+    arrays['version'] = int(arrays['version'])
+    return arrays
+
+def frame_count(arrays):
+    """Number of labeled frames in loaded arrays"""
+    return len(arrays['food_offsets']) - 1
+
+def read_images(arrays, indices=None, vid_name=None):
+    """Reads images of the labeled frames from the video
+
+    Parameters
+    ----------
+    arrays : dict
+        Returned by load_annotations()
+    indices : iterable of int
+        Frames to read. If None, every labeled frame is read.
+    vid_name : str
+        Overrides arrays['vid_path'], e.g. when the video has moved
+
+    Yields
+    ------
+    idx, image
+        image is in shape of (WIDTH, HEIGHT, 3), RGB
+    """
+    from .frame_source import FrameSource
+    if vid_name is None:
+        vid_name = arrays['vid_path']
+    if arrays['fingerprint'] and \
+            video_fingerprint(vid_name) != arrays['fingerprint']:
+        warnings.warn(f'{vid_name} does not match the saved fingerprint')
+    if indices is None:
+        indices = range(frame_count(arrays))
+    frames = FrameSource(vid_name, cache_frames=1)
+    try:
+        for idx in indices:
+            yield idx, frames[idx]
+    finally:
+        frames.release()
+
+def _legacy_datum(datum):
+    """Marker dict of an old .pck datum, without the image"""
+    datum = dict(datum)
+    datum.pop('image', None)
+    # Very old saves have two ear pins instead of a head pin
+    if 'head' not in datum and 'ear' in datum:
+        datum['head'] = tuple(np.round(
+            np.mean(datum['ear'], axis=0)).astype(np.int32))
+    for name in SINGLE_MARKERS:
+        datum.setdefault(name, (0,0))
+    for name in MULTIPLE_MARKERS:
+        datum.setdefault(name, [])
+    return datum
+
+def convert_pck(pck_name, vid_name=None, out_name=None):
+    """Converts an old <n>.pck save (with images) to a .npz save
+
+    Parameters
+    ----------
+    pck_name : str or Path
+    vid_name : str
+        Video the save was labeled on. Old saves do not record it.
+    out_name : str or Path
+        Defaults to pck_name with .npz suffix
+
+    Return
+    ------
+    out_name : Path
+    """
+    pck_name = Path(pck_name)
+    if out_name is None:
+        out_name = pck_name.with_suffix(SAVE_EXT)
+    with open(pck_name, 'rb') as f:
+        data = pickle.load(f)
+    data = [_legacy_datum(d) for d in data]
+    save_annotations(out_name, data, vid_name or '')
+    return Path(out_name)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m sources.saves')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert_parser = subparsers.add_parser(
+        'convert', help='convert old .pck saves to .npz')
+    convert_parser.add_argument('pck', nargs='+')
+    convert_parser.add_argument('--video', default=None,
+                                help='video the saves were labeled on')
+    args = parser.parse_args()
+    if args.command == 'convert':
+        for pck in args.pck:
+            out = convert_pck(pck, args.video)
+            print(f'{pck} -> {out}')
@@ -0,0 +1,178 @@
+"""Seek index of a video, for random access in bounded decode time
+
+Seeking with CAP_PROP_POS_FRAMES is not exact for every container
+(e.g. .mpg, raw .h264). A seek index lists anchor frames where such a seek
+was tested to land exactly, so any frame is reached by
+    seek to the nearest anchor before it -> grab() forward
+which decodes at most `spacing` frames, and is always exact.
+
+Some containers never seek exactly, and their index only has anchor 0.
+Such an index is `degraded`: it is still exact, but reaching a frame
+decodes up to `max_gap` frames, i.e. the whole video. Engine then decodes
+the video once into its frame cache (see FrameSource.fill).
+
+It is built once with a single sequential pass, which also gives the
+exact frame count (containers may report a wrong one), and saved next to
+the video as <video>.seekidx.npz.
+
+Build indices of videos from the command line with
+    python -m sources.seek_index <video> [<video> ...]
+"""
+import numpy as np
+import os
+import hashlib
+import argparse
+import cv2
+
+INDEX_SUFFIX = '.seekidx.npz'
+INDEX_VERSION = 1
+
+class SeekIndex():
+    """Verified anchor frames of a video"""
+    def __init__(self, frame_count:int, anchors:np.array, spacing:int):
+        """
+        Arguments
+        ---------
+        frame_count : int
+            Exact number of frames
+        anchors : np.array
+            Sorted frames that can be seeked to exactly. Always has 0
+        spacing : int
+            Distance between candidate anchors
+        """
+        self.frame_count = frame_count
+        self.anchors = np.asarray(anchors, dtype=np.int64)
+        self.spacing = spacing
+
+    def __len__(self):
+        return self.frame_count
+
+    def anchor(self, idx:int):
+        """Nearest anchor at or before idx"""
+        i = np.searchsorted(self.anchors, idx, side='right') - 1
+        return int(self.anchors[max(i, 0)])
+
+    @property
+    def max_gap(self):
+        """Most frames decoded to reach a frame from its anchor"""
+        return int(np.diff(np.append(self.anchors, self.frame_count)).max())
+
+    @property
+    def degraded(self):
+        """True if too few anchors verified to bound decoding by spacing"""
+        return self.max_gap > 4 * self.spacing
+
+    def summary(self):
+        text = f'{self.frame_count} frames, {len(self.anchors)} anchors'
+        if self.degraded:
+            text += (f', degraded : seeks are not exact, up to '
+                     f'{self.max_gap} frames decoded per seek')
+        return text
+
+    @staticmethod
+    def index_name(vid_name):
+        return vid_name + INDEX_SUFFIX
+
+    @staticmethod
+    def _stamp(vid_name):
+        stat = os.stat(vid_name)
+        return stat.st_size, stat.st_mtime_ns
+
+    @classmethod
+    def build(cls, vid_name:str, spacing:int=64, cancel=None):
+        """Builds the index with a sequential pass and seek tests
+
+        Parameters
+        ----------
+        spacing : int
+            Every spacing-th frame is tested as an anchor
+        cancel : threading.Event
+            Building stops and returns None when it is set
+
+        Return
+        ------
+        index : SeekIndex
+        """
+        cap = cv2.VideoCapture(vid_name)
+        if not cap.isOpened():
+            raise IOError(f'Cannot open video {vid_name}')
+        try:
+            # grab() skips color conversion; only candidates are retrieved
+            digests = {}
+            n = 0
+            while cap.grab():
+                if n % spacing == 0:
+                    _, frame = cap.retrieve()
+                    digests[n] = hashlib.sha1(frame).hexdigest()
+                    if cancel is not None and cancel.is_set():
+                        return None
+                n += 1
+            if n == 0:
+                raise IOError(f'Cannot decode video {vid_name}')
+
+            anchors = [0]
+            for candidate in sorted(digests)[1:]:
+                if cancel is not None and cancel.is_set():
+                    return None
+                cap.set(cv2.CAP_PROP_POS_FRAMES, candidate)
+                ret, frame = cap.read()
+                if ret and hashlib.sha1(frame).hexdigest() == \
+                        digests[candidate]:
+                    anchors.append(candidate)
+        finally:
+            cap.release()
+        return cls(n, anchors, spacing)
+
+    def save(self, vid_name:str):
+        """Saves next to the video. Returns False if it cannot be written"""
+        size, mtime_ns = self._stamp(vid_name)
+        index_name = self.index_name(vid_name)
+        tmp_name = index_name + '.tmp'
+        try:
+            with open(tmp_name, 'wb') as f:
+                np.savez(f, version=INDEX_VERSION, size=size,
+                         mtime_ns=mtime_ns, frame_count=self.frame_count,
+                         anchors=self.anchors, spacing=self.spacing)
+            os.replace(tmp_name, index_name)
+        except OSError:
+            return False
+        return True
+
+    @classmethod
+    def load(cls, vid_name:str):
+        """Loads the saved index, or None if there is no valid one
+
+        An index of a modified video (size or mtime) is not valid.
+        """
+        try:
+            with np.load(cls.index_name(vid_name)) as npz:
+                if int(npz['version']) != INDEX_VERSION or \
+                        (int(npz['size']), int(npz['mtime_ns'])) != \
+                        cls._stamp(vid_name):
+                    return None
+                return cls(int(npz['frame_count']), npz['anchors'],
+                           int(npz['spacing']))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @classmethod
+    def load_or_build(cls, vid_name:str, spacing:int=64, cancel=None):
+        """Loads the saved index, building and saving it if necessary"""
+        index = cls.load(vid_name)
+        if index is None:
+            index = cls.build(vid_name, spacing, cancel)
+            if index is not None:
+                index.save(vid_name)
+        return index
+
+if __name__ == '__main__':
+    import time
+    parser = argparse.ArgumentParser(prog='python -m sources.seek_index')
+    parser.add_argument('video', nargs='+')
+    parser.add_argument('--spacing', type=int, default=64)
+    args = parser.parse_args()
+    for vid_name in args.video:
+        start = time.perf_counter()
+        index = SeekIndex.load_or_build(vid_name, args.spacing)
+        print(f'{vid_name} : {index.summary()}, '
+              f'{time.perf_counter()-start:.1f}s')
@@ -0,0 +1,239 @@
+"""Recording and replaying labeling sessions
+
+Set the environment variable MOUSE_CHASER_SESSION to a folder to record,
+e.g.
+    MOUSE_CHASER_SESSION=sessions python main.py
+Viewer records every event it sends to Engine (eventQ), and Console every
+command (to_EngineQ), each into its own file in the folder
+    session-viewer.pck, session-console.pck
+Each file is a stream of pickled records
+    (time, source, message)
+with time.perf_counter() seconds, which compare across processes (see
+common/trace.py). Trace stamps are not recorded.
+
+A replay feeds the merged records into a headless Engine, either at the
+original pace (or `speed` times it), or as fast as possible, and measures
+how long each message waited until Engine had handled it.
+SAVE commands are redirected to a temporary folder, so replaying never
+touches real saves, and the journal is off.
+Tracker proposals are not recorded, so a replay runs without a Tracker.
+
+Replay from the command line with
+    python -m sources.session_log replay <folder or files> [--fast]
+        [--speed 1.0] [--out result.json]
+"""
+import os
+import glob
+import json
+import time
+import pickle
+import argparse
+import tempfile
+from .common.constants import TRACE, SAVE
+
+SESSION_DIR = os.environ.get('MOUSE_CHASER_SESSION', '')
+ENABLED = bool(SESSION_DIR)
+
+# Processes that record
+SOURCES = ('viewer', 'console')
+
+class SessionRecorder():
+    """Appends messages of a process to session-<name>.pck"""
+    def __init__(self, name:str, session_dir:str=None):
+        self.name = name
+        session_dir = session_dir or SESSION_DIR
+        os.makedirs(session_dir, exist_ok=True)
+        self.path = os.path.join(session_dir, f'session-{name}.pck')
+        self._file = open(self.path, 'wb')
+
+    def record(self, msg:dict):
+        msg = {k : v for k, v in msg.items() if k != TRACE}
+        pickle.dump((time.perf_counter(), self.name, msg), self._file)
+        # Keep what was recorded so far even if the process dies
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class RecordingQueue():
+    """Queue wrapper that records every message put into it"""
+    def __init__(self, q, name:str, session_dir:str=None):
+        self._q = q
+        self.recorder = SessionRecorder(name, session_dir)
+
+    def put(self, msg, *args, **kwargs):
+        self.recorder.record(msg)
+        self._q.put(msg, *args, **kwargs)
+
+    def close(self):
+        self.recorder.close()
+
+    def __getattr__(self, name):
+        return getattr(self._q, name)
+
+
+def load_session(paths):
+    """Records of session files, merged in time order
+
+    Parameters
+    ----------
+    paths : str or list
+        Session files, or folders with session-*.pck
+
+    Return
+    ------
+    records : list
+        [(time, source, message), ...]
+    """
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path,
+                                                       'session-*.pck'))))
+        else:
+            files.append(path)
+    records = []
+    for name in files:
+        with open(name, 'rb') as f:
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except EOFError:
+                    break
+                except pickle.UnpicklingError:
+                    # Last record of a killed process may be cut
+                    break
+    records.sort(key=lambda r: r[0])
+    return records
+
+def replay(records:list, speed:float=1.0, **engine_kwargs):
+    """Feeds records into a headless Engine
+
+    Parameters
+    ----------
+    records : list
+        From load_session
+    speed : float
+        Pace relative to the recording, e.g. 2.0 for twice as fast.
+        None to feed as fast as possible: one message per Engine step
+    engine_kwargs
+        Passed to Engine. journal is always False
+
+    Return
+    ------
+    result : dict
+        n_messages, n_steps, wall_s, busy_s (time inside Engine.step),
+        messages_per_s (per busy second), and latency percentiles (ms) of
+        a message from when it was due until Engine had handled it
+    """
+    import queue
+    import numpy as np
+    from .engine import Engine
+    from .common.queues import drain
+    to_EngineQ, to_ConsoleQ, imageQ, eventQ, etcQ = \
+        (queue.Queue() for _ in range(5))
+    engine_kwargs.setdefault('max_display_size', (1920, 1080))
+    engine = Engine(to_EngineQ, to_ConsoleQ, imageQ, eventQ, etcQ,
+                    journal=False, **engine_kwargs)
+    queues = {'viewer' : eventQ, 'console' : to_EngineQ}
+    latencies = []
+    busy = 0
+    n_steps = 0
+    n_messages = 0
+
+    with tempfile.TemporaryDirectory() as save_dir:
+        t0 = records[0][0] if records else 0
+        start = time.perf_counter()
+        i = 0
+        while i < len(records) and engine._mainloop:
+            due = []
+            if speed is None:
+                due.append(time.perf_counter())
+                batch = [records[i]]
+                i += 1
+            else:
+                wait = start + (records[i][0]-t0)/speed - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                batch = []
+                now = time.perf_counter()
+                # Everything that arrived by now, as a real Engine sees it
+                while i < len(records) and \
+                        start + (records[i][0]-t0)/speed <= now:
+                    due.append(start + (records[i][0]-t0)/speed)
+                    batch.append(records[i])
+                    i += 1
+            for _, source, msg in batch:
+                msg = dict(msg)
+                if SAVE in msg:
+                    msg[SAVE] = save_dir
+                queues[source].put(msg)
+            n_messages += len(batch)
+
+            step_start = time.perf_counter()
+            engine.step(timeout=0)
+            step_end = time.perf_counter()
+            busy += step_end - step_start
+            n_steps += 1
+            latencies.extend(step_end - d for d in due)
+            # Nobody reads them; only keep the queues from growing
+            for q in (imageQ, to_ConsoleQ):
+                for _ in drain(q):
+                    pass
+        wall = time.perf_counter() - start
+
+        engine.stop_preloader()
+        engine.stop_cache_decode()
+        engine.stop_prefetcher()
+        if engine._index_cancel is not None:
+            engine._index_cancel.set()
+        engine.close_ring()
+        if hasattr(engine._frames, 'release'):
+            engine._frames.release()
+
+    lat = np.array(latencies or [0]) * 1000
+    return {
+        'n_messages' : n_messages,
+        'n_steps' : n_steps,
+        'wall_s' : wall,
+        'busy_s' : busy,
+        'messages_per_s' : n_messages / max(busy, 1e-9),
+        'mean_ms' : float(lat.mean()),
+        'p50_ms' : float(np.percentile(lat, 50)),
+        'p95_ms' : float(np.percentile(lat, 95)),
+        'p99_ms' : float(np.percentile(lat, 99)),
+        'max_ms' : float(lat.max()),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m sources.session_log')
+    sub = parser.add_subparsers(dest='command', required=True)
+    info_parser = sub.add_parser('info')
+    info_parser.add_argument('session', nargs='+')
+    replay_parser = sub.add_parser('replay')
+    replay_parser.add_argument('session', nargs='+',
+                               help='folder or session-*.pck files')
+    replay_parser.add_argument('--fast', action='store_true',
+                               help='as fast as possible')
+    replay_parser.add_argument('--speed', type=float, default=1.0)
+    replay_parser.add_argument('--out', help='json file of the result')
+    args = parser.parse_args()
+
+    records = load_session(args.session)
+    if args.command == 'info':
+        counts = {source : sum(r[1] == source for r in records)
+                  for source in SOURCES}
+        duration = records[-1][0] - records[0][0] if records else 0
+        print(f'{len(records)} messages in {duration:.1f}s, {counts}')
+    else:
+        result = replay(records, None if args.fast else args.speed)
+        for k, v in result.items():
+            print(f'{k:>14} : {v:.2f}' if isinstance(v, float)
+                  else f'{k:>14} : {v}')
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(result, f, indent=1)
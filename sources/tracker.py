@@ -0,0 +1,200 @@
+import numpy as np
+from multiprocessing import Process, Queue
+from .common.constants import *
+from .common.queues import drain
+from .common.startup import StartupReport
+import os
+import queue
+import cv2
+from collections import OrderedDict
+
+class Tracker(Process):
+    """Proposes marker positions of frames ahead, with optical flow
+
+    Starting from markers of a seed frame, it tracks them forward frame by
+    frame with pyramidal Lucas-Kanade, and sends a proposal for each frame
+    to Engine. It runs at most `ahead` frames past Engine's labeling front.
+
+    Messages from Engine (to_TrackerQ)
+        TRACK_VIDEO : vid_name
+            Opens a video; stops any tracking
+        TRACK_FROM : (generation, frame, {marker name : pos})
+            Starts tracking from markers of a frame
+        TRACK_PAUSE : None
+            Stops decoding, e.g. while Engine is scrubbing backward
+        TRACK_RESUME : front
+            Index of Engine's labeling front. Tracking goes up to
+            front + ahead
+        TERMINATE
+    Messages to Engine (from_TrackerQ)
+        TRACK_PROPOSAL : (generation, frame, {marker name : pos})
+
+    Positions are in full resolution, (WIDTH, HEIGHT) -> Pygame notation.
+    It runs with a lower priority, so decoding for display comes first.
+
+    Seeding must start from exactly the frame the user pinned. Frames
+    tracked recently are kept as gray images, and others are decoded with
+    the video's SeekIndex (built by Engine). Until that index exists, they
+    are decoded forward from frame 0, as seeking may not be exact.
+    """
+    def __init__(self, to_TrackerQ:Queue, from_TrackerQ:Queue,
+                 ahead:int=30, nice:int=10, win_size:int=21,
+                 max_level:int=3):
+        """
+        Arguments
+        ---------
+        ahead : int
+            Number of frames to track past Engine's labeling front
+        nice : int
+            Added to the process' niceness. 0 to keep the priority
+        win_size : int
+            Search window of Lucas-Kanade, in pixels
+        max_level : int
+            Number of pyramid levels of Lucas-Kanade
+        """
+        super().__init__(daemon=True)
+        self._to_TrackerQ = to_TrackerQ
+        self._from_TrackerQ = from_TrackerQ
+        self.ahead = ahead
+        self._nice = nice
+        self._lk_params = dict(
+            winSize=(win_size, win_size),
+            maxLevel=max_level,
+            criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+                      20, 0.03),
+        )
+        self._frames = None
+        self._exact_index = False
+        # Recently tracked gray images by frame, at most ahead + 2
+        self._grays = OrderedDict()
+        self._generation = 0
+        # Last tracked frame, its gray image and marker positions
+        self._frame = -1
+        self._gray = None
+        self._names = []
+        self._points = None
+        self._front = 0
+        self._paused = False
+
+    def _to_gray(self, idx:int):
+        """Grayscale frame in cv2 layout (HEIGHT, WIDTH)"""
+        gray = self._grays.get(idx)
+        if gray is None:
+            frame = np.ascontiguousarray(self._frames[idx].swapaxes(0,1))
+            gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        self._grays[idx] = gray
+        self._grays.move_to_end(idx)
+        while len(self._grays) > self.ahead + 2:
+            self._grays.popitem(last=False)
+        return gray
+
+    def attach_seek_index(self):
+        """Gives the FrameSource a SeekIndex, so that every frame is exact
+
+        Without the saved index yet, one with only frame 0 as an anchor
+        makes the FrameSource decode forward instead of seeking.
+        """
+        from .seek_index import SeekIndex
+        if self._exact_index:
+            return
+        index = SeekIndex.load(self._frames.vid_name)
+        self._exact_index = index is not None
+        if index is None:
+            index = SeekIndex(len(self._frames), [0], len(self._frames))
+        self._frames.set_seek_index(index)
+
+    def open_video(self, vid_name):
+        from .frame_source import FrameSource
+        if self._frames is not None:
+            self._frames.release()
+        # Only sequential access, so a tiny cache is enough
+        self._frames = FrameSource(vid_name, cache_frames=2)
+        self._exact_index = False
+        self.attach_seek_index()
+        self._grays.clear()
+        self._frame = -1
+        self._gray = None
+
+    def seed(self, generation:int, frame:int, markers:dict):
+        """Starts tracking markers from frame"""
+        self._generation = generation
+        self._front = max(self._front, frame)
+        self._names = list(markers.keys())
+        self._points = np.array([markers[n] for n in self._names],
+                                dtype=np.float32).reshape(-1,1,2)
+        self._frame = frame
+        if self._frames is not None:
+            # Engine may have finished building the index by now
+            self.attach_seek_index()
+            self._gray = self._to_gray(frame)
+        else:
+            self._gray = None
+
+    def track_next(self):
+        """Tracks markers into the next frame and sends a proposal"""
+        idx = self._frame + 1
+        gray = self._to_gray(idx)
+        # The video may be shorter than reported
+        if idx >= len(self._frames):
+            self._gray = None
+            return
+        points, status, _ = cv2.calcOpticalFlowPyrLK(
+            self._gray, gray, self._points, None, **self._lk_params)
+        # Lost points stay where they were
+        lost = status.reshape(-1) == 0
+        points[lost] = self._points[lost]
+        self._points = points
+        self._gray = gray
+        self._frame = idx
+        proposal = {
+            name : (int(round(float(p[0]))), int(round(float(p[1]))))
+            for name, p in zip(self._names, points.reshape(-1,2))
+        }
+        self._from_TrackerQ.put(
+            {TRACK_PROPOSAL:(self._generation, idx, proposal)})
+
+    @property
+    def has_work(self):
+        return (not self._paused
+                and self._gray is not None
+                and len(self._names) > 0
+                and self._frame + 1 < len(self._frames)
+                and self._frame < self._front + self.ahead)
+
+    def handle(self, q:dict):
+        """Handles a message from Engine. Returns False to terminate"""
+        for k, v in q.items():
+            if k == TERMINATE:
+                return False
+            elif k == TRACK_VIDEO:
+                self.open_video(v)
+            elif k == TRACK_FROM:
+                self.seed(*v)
+            elif k == TRACK_PAUSE:
+                self._paused = True
+            elif k == TRACK_RESUME:
+                self._paused = False
+                self._front = v
+        return True
+
+    def run(self):
+        startup = StartupReport('tracker')
+        startup.mark('imported')
+        startup.report()
+        if self._nice and hasattr(os, 'nice'):
+            os.nice(self._nice)
+        mainloop = True
+        while mainloop:
+            if self.has_work:
+                # Messages first, so a new seed never waits for old work
+                for q in drain(self._to_TrackerQ):
+                    mainloop = mainloop and self.handle(q)
+                if mainloop and self.has_work:
+                    self.track_next()
+            else:
+                try:
+                    mainloop = self.handle(self._to_TrackerQ.get(timeout=1.0))
+                except queue.Empty:
+                    pass
+        if self._frames is not None:
+            self._frames.release()
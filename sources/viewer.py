@@ -2,10 +2,20 @@ import pygame
 import numpy as np
 from multiprocessing import Queue, Process
 from .common.constants import *
+from .common.frame_ring import FrameRing
+from .common.queues import wait_queues, drain
+from .common.events import coalesce
+from .common import trace
+from . import session_log
+from .common.startup import StartupReport
 import os
-import cv2
+import threading
+import time
 from pathlib import Path
 
+# Posted by the queue watcher thread when Engine sent something
+QUEUE_READY = pygame.USEREVENT
+
 class Viewer(Process):
     """
     This module shows a numpy array(3D) on a display
@@ -36,93 +46,236 @@ class Viewer(Process):
         self._put_mouse_pos = False
         self._termQ = termQ
         self._icon_dir = Path('sources/icons')
+        self._ring = None
+        self._shown_slot = None
+        # While the zoom inset is shown, mouse moves are sent to Engine
+        self._zooming = False
+        # Measured time to draw and update the screen, in ms
+        self.render_time = 0.0
+        self._caption_time = 0.0
 
     def run(self) :
         """
         Run viewer's mainloop
         """
         mainloop = True
+        self._startup = StartupReport('viewer')
+        self._startup.mark('imported')
         pygame.init()
         self._clock = pygame.time.Clock()
         self._screen = pygame.display.set_mode(self.size, pygame.RESIZABLE)
+        pygame.display.flip()
+        self._startup.mark('window')
         self._background = pygame.Surface(self.size)
         self._allgroup = pygame.sprite.LayeredDirty()
+        # LayeredDirty falls back to full screen updates when a draw is slow,
+        # which a new large frame always is. Always use dirty rects instead.
+        self._allgroup.set_timing_threshold(float('inf'))
         self._cursor = Cursor()
         self._cursor.add(self._allgroup)
         self._initiate_markers(self._allgroup)
+        self._inset = Inset()
+        self._allgroup.add(self._inset, layer=1)
+        if trace.ENABLED:
+            self._tracer = trace.Tracer('viewer')
+            self._overlay = Overlay()
+            self._allgroup.add(self._overlay, layer=2)
+        if session_log.ENABLED:
+            self._event_queue = session_log.RecordingQueue(
+                self._event_queue, 'viewer')
+        # Engine holds back opening videos until the window is up
+        self._event_queue.put({VIEWER_READY:None})
         self._mouse_prev = pygame.mouse.get_pos()
+        self._queue_ready = threading.Event()
+        watcher = threading.Thread(target=self._watch_queues, daemon=True)
+        watcher.start()
         while mainloop :
-            self._clock.tick(self._fps)
-            if not self._image_queue.empty():
-                datum = self._image_queue.get()
-                image = datum.pop('image')
-                if image.shape[0:2] != self.size:
-                    self.size = image.shape[0:2]
-                    self._screen = pygame.display.set_mode(self.size)
-                    self._background = pygame.Surface(self.size)
-                pygame.surfarray.blit_array(self._background, image)
-                self._screen.blit(self._background, (0,0))
-
-                # update markers
-                for m_name, pos in datum.items():
-                    self.update_marker_pos(m_name, pos)
-            if not self._etc_queue.empty():
-                q = self._etc_queue.get()
-                for k, v in q.items():
-                    if k == TERMINATE:
-                        mainloop=False
+            # Sleep until there is any input or any message from Engine
+            events = [pygame.event.wait(1000)] + pygame.event.get()
+            if trace.ENABLED:
+                woke = time.perf_counter()
+            datum = None
+            outgoing = []
+            for event in events :
+                if event.type == QUEUE_READY:
+                    # Every datum has all markers, so only the latest matters
+                    for datum in drain(self._image_queue):
+                        pass
+                    if trace.ENABLED:
+                        received = time.perf_counter()
+                    for q in drain(self._etc_queue):
+                        for k, v in q.items():
+                            if k == TERMINATE:
+                                mainloop=False
+                    self._queue_ready.set()
             # close
-            for event in pygame.event.get() :
-                if event.type == pygame.QUIT :
+                elif event.type == pygame.QUIT :
                     mainloop = False
             ######################################
             # Keyboard events
                 elif event.type == pygame.KEYDOWN :
                     if event.key == pygame.K_z:
-                        self._event_queue.put({K_Z:None})
+                        self._zooming = not self._zooming
+                        outgoing.append({K_Z:pygame.mouse.get_pos()})
                     elif event.key == pygame.K_RETURN:
-                        self._event_queue.put({K_ENTER:None})
+                        outgoing.append({K_ENTER:None})
 
                     # Prev / Next frame
                     elif event.key == pygame.K_1:
-                        self._event_queue.put({K_1:None})
+                        outgoing.append({K_1:None})
                     elif event.key == pygame.K_2:
-                        self._event_queue.put({K_2:None})
+                        outgoing.append({K_2:None})
 
                     # Markers
                     elif event.key == pygame.K_e:
-                        self._event_queue.put({K_E:pygame.mouse.get_pos()})
+                        outgoing.append({K_E:pygame.mouse.get_pos()})
                     elif event.key == pygame.K_r:
-                        self._event_queue.put({K_R:pygame.mouse.get_pos()})
+                        outgoing.append({K_R:pygame.mouse.get_pos()})
                     elif event.key == pygame.K_d:
-                        self._event_queue.put({K_D:pygame.mouse.get_pos()})
+                        outgoing.append({K_D:pygame.mouse.get_pos()})
                     elif event.key == pygame.K_f:
-                        self._event_queue.put({K_F:pygame.mouse.get_pos()})
+                        outgoing.append({K_F:pygame.mouse.get_pos()})
                     elif event.key == pygame.K_w:
-                        self._event_queue.put({K_W:pygame.mouse.get_pos()})
+                        outgoing.append({K_W:pygame.mouse.get_pos()})
                     elif event.key == pygame.K_q:
-                        self._event_queue.put({K_Q:pygame.mouse.get_pos()})
+                        outgoing.append({K_Q:pygame.mouse.get_pos()})
 
                     elif event.key == pygame.K_i:
-                        self._event_queue.put({K_I:pygame.mouse.get_pos()})
+                        outgoing.append({K_I:pygame.mouse.get_pos()})
                     elif event.key == pygame.K_l:
-                        self._event_queue.put({K_L:pygame.mouse.get_pos()})
+                        outgoing.append({K_L:pygame.mouse.get_pos()})
 
             # Mouse events
                 elif event.type == pygame.MOUSEBUTTONDOWN:
                     if pygame.mouse.get_pressed()[0]:
-                        self._event_queue.put({MOUSEDOWN:pygame.mouse.get_pos()})
+                        outgoing.append({MOUSEDOWN:pygame.mouse.get_pos()})
                     elif pygame.mouse.get_pressed()[2]:
-                        self._event_queue.put({MOUSEDOWN_RIGHT:pygame.mouse.get_pos()})
+                        outgoing.append({MOUSEDOWN_RIGHT:pygame.mouse.get_pos()})
                 elif event.type == pygame.MOUSEBUTTONUP:
-                    self._event_queue.put({MOUSEUP:None})
+                    outgoing.append({MOUSEUP:None})
+                elif event.type == pygame.MOUSEMOTION:
+                    if self._zooming:
+                        outgoing.append({MOUSEPOS:event.pos})
 
-            self._allgroup.update()
-            self._allgroup.clear(self._screen, self._background)
-            self._allgroup.draw(self._screen)
-            pygame.display.flip()
+            # Send a burst of key presses as a few merged events
+            for e in coalesce(outgoing):
+                if trace.ENABLED:
+                    e[TRACE] = [('viewer_key', woke)]
+                    trace.stamp(e, 'viewer_send')
+                self._event_queue.put(e)
+
+            stamps = None
+            if datum is not None:
+                if trace.ENABLED:
+                    # Only data caused by a traced key press have stamps
+                    stamps = trace.pop_stamps([datum])
+                    stamps.append(('viewer_recv', received))
+                self._apply_datum(datum)
+                if not self._startup.done:
+                    self._startup.mark('first_frame')
+                    self._startup.report()
+                if trace.ENABLED:
+                    stamps.append(('viewer_blit', time.perf_counter()))
+            else:
+                # Cursor-only redraws are limited to fps
+                self._clock.tick(self._fps)
+            self._render()
+            if trace.ENABLED and stamps and stamps[0][0] == 'viewer_key':
+                stamps.append(('viewer_flip', time.perf_counter()))
+                self._tracer.add(stamps)
+                self._overlay.frame_shown(self._tracer)
+        if trace.ENABLED:
+            self._tracer.write()
+        if session_log.ENABLED:
+            self._event_queue.close()
+        if self._ring is not None:
+            self._ring.close()
         self._termQ.put(TERMINATE)
 
+    def _watch_queues(self):
+        """Posts QUEUE_READY whenever Engine sends something
+
+        Runs in a thread, so that the main loop can sleep in
+        pygame.event.wait() and still wake up on a new frame.
+        It waits until the main loop drains the queues before posting again.
+        """
+        while True:
+            if wait_queues([self._image_queue, self._etc_queue], 1.0):
+                self._queue_ready.clear()
+                pygame.event.post(pygame.event.Event(QUEUE_READY))
+                self._queue_ready.wait()
+
+    def _render(self):
+        """Draws only what changed and updates only those areas
+
+        The background is repainted only after _apply_datum marked the
+        whole screen dirty, i.e. when the frame itself changed.
+        """
+        start = time.perf_counter()
+        self._allgroup.update()
+        self._allgroup.clear(self._screen, self._background)
+        rects = self._allgroup.draw(self._screen)
+        if rects:
+            pygame.display.update(rects)
+            elapsed = (time.perf_counter() - start) * 1000
+            # Exponential moving average, in ms
+            self.render_time += (elapsed - self.render_time) * 0.1
+            now = time.monotonic()
+            if now - self._caption_time > 0.5:
+                pygame.display.set_caption(
+                    f'Mouse Chaser - render {self.render_time:.2f}ms')
+                self._caption_time = now
+
+    def _apply_datum(self, datum):
+        """Shows the frame and markers of a datum from Engine"""
+        slot = datum.pop('slot')
+        self._inset.set_crop(datum.pop('zoom', None), self.size)
+        # Engine reuses the slot when only markers moved. Slots also come
+        # back every n_slots frames, so the frame sequence number decides
+        if slot != self._shown_slot:
+            ring_info, ring_slot, _ = slot
+            image = self._ring_image(ring_info, ring_slot)
+            if image is not None:
+                if image.shape[0:2] != self.size:
+                    self.size = image.shape[0:2]
+                    self._screen = pygame.display.set_mode(self.size)
+                    self._background = pygame.Surface(self.size)
+                pygame.surfarray.blit_array(self._background, image)
+                self._allgroup.repaint_rect(self._screen.get_rect())
+                self._shown_slot = slot
+            # A view into shared memory must not outlive the ring
+            del image
+
+        # Interpolated markers are drawn faded
+        interpolated = datum.pop('interpolated', ())
+        for m_name, marker in (('nose', self._marker_nose),
+                               ('head', self._marker_head),
+                               ('tail', self._marker_tail),
+                               ('water', self._marker_water),
+                               ('block', self._marker_block)):
+            marker.set_faded(m_name in interpolated)
+
+        # update markers
+        for m_name, pos in datum.items():
+            self.update_marker_pos(m_name, pos)
+
+    def _ring_image(self, ring_info, slot):
+        """Returns the frame in the slot of the FrameRing, without copying
+
+        ring_info : (name, frame_shape, n_slots) from FrameRing.info
+        If the ring was already replaced by Engine, returns None.
+        """
+        if self._ring is None or self._ring.name != ring_info[0]:
+            if self._ring is not None:
+                self._ring.close()
+                self._ring = None
+            name, frame_shape, n_slots = ring_info
+            try:
+                self._ring = FrameRing(frame_shape, n_slots, name=name)
+            except FileNotFoundError:
+                return None
+        return self._ring.view(slot)
+
     @property
     def size(self):
         """
@@ -274,8 +427,10 @@ class Cursor(pygame.sprite.DirtySprite):
         self.visible = True
     
     def update(self):
-        self.rect.center = pygame.mouse.get_pos()
-        self.dirty = 1
+        pos = pygame.mouse.get_pos()
+        if pos != self.rect.center:
+            self.rect.center = pos
+            self.dirty = 1
 
     def change_color(self, color):
         self.image.fill(color)
@@ -296,15 +451,81 @@ class Marker(pygame.sprite.DirtySprite):
         super().__init__()
         if isinstance(img_path, Path):
             img_path = str(img_path)
-        img = cv2.imread(img_path)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB).swapaxes(0,1)
-        self.image = pygame.Surface(img.shape[:2])
-        pygame.surfarray.blit_array(self.image, img)
+        # Without alpha, so that black is transparent by the colorkey
+        self.image = pygame.image.load(img_path).convert()
         self.image.set_colorkey((0,0,0))
         self.rect = self.image.get_rect()
         self.rect.center = (pos[0]+15, pos[1])
         self.visible = True
+        self._faded = False
+
+    def set_faded(self, faded:bool):
+        """Draws the marker half transparent, e.g. when interpolated"""
+        if faded != self._faded:
+            self._faded = faded
+            self.image.set_alpha(128 if faded else None)
+            self.dirty = 1
     
     def change_pos(self, pos):
-        self.rect.center = (pos[0]+15, pos[1])
-        self.dirty = True
\ No newline at end of file
+        center = (pos[0]+15, pos[1])
+        if center != self.rect.center:
+            self.rect.center = center
+            self.dirty = True
+
+class Inset(pygame.sprite.DirtySprite):
+    """Full resolution crop around the cursor, magnified in a corner"""
+    size = 256
+
+    def __init__(self):
+        super().__init__()
+        self.image = pygame.Surface((self.size, self.size))
+        self.rect = self.image.get_rect()
+        self.visible = False
+
+    def set_crop(self, crop, screen_size):
+        """Shows crop (WIDTH, HEIGHT, 3) array, or hides if crop is None"""
+        if crop is None:
+            if self.visible:
+                self.visible = False
+                self.dirty = 1
+            return
+        surface = pygame.surfarray.make_surface(crop)
+        self.image = pygame.transform.scale(surface, (self.size, self.size))
+        center = (self.size//2, self.size//2)
+        pygame.draw.line(self.image, CURSOR, (center[0]-8, center[1]),
+                         (center[0]+8, center[1]))
+        pygame.draw.line(self.image, CURSOR, (center[0], center[1]-8),
+                         (center[0], center[1]+8))
+        self.rect = self.image.get_rect(topright=(screen_size[0], 0))
+        self.visible = True
+        self.dirty = 1
+
+class Overlay(pygame.sprite.DirtySprite):
+    """FPS and latency text at the top left, only when tracing"""
+    interval = 0.5
+
+    def __init__(self):
+        super().__init__()
+        self._font = pygame.font.Font(None, 20)
+        self._shown = []
+        self._last_update = 0.0
+        self.image = self._font.render('', True, CURSOR)
+        self.rect = self.image.get_rect(topleft=(4, 4))
+        self.visible = True
+
+    def frame_shown(self, tracer):
+        """Counts a shown frame, and updates the text every interval"""
+        now = time.monotonic()
+        self._shown.append(now)
+        while self._shown[0] < now - 1.0:
+            self._shown.pop(0)
+        if now - self._last_update < self.interval:
+            return
+        self._last_update = now
+        lat = np.array(tracer.recent('total'))
+        self.image = self._font.render(
+            f'{len(self._shown)} fps  key->flip p50 '
+            f'{np.percentile(lat,50):.1f}ms p95 {np.percentile(lat,95):.1f}ms',
+            True, CURSOR, (0,0,0))
+        self.rect = self.image.get_rect(topleft=(4, 4))
+        self.dirty = 1